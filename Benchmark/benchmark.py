@@ -0,0 +1,796 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks for the Import and Run apps.
+
+Basics
+~~~~~~
+
+Measures the throughput and peak memory of the ``NetworkImporter`` and
+``ModelRunner`` on synthetic prototype networks, against a local stand-in
+for the Hydra server, so neither a live server nor the real workbook is
+needed. Each benchmark is run in its own process so its peak memory can be
+measured on its own.
+Basic usage::
+
+       benchmark.py [-h] [-n sizes] [-b benchmarks] [-l latency]
+
+Options
+~~~~~~~
+
+====================== ====== ============ =======================================
+Option                 Short  Parameter    Description
+====================== ====== ============ =======================================
+``--help``             ``-h``              Show help message and exit.
+``--sizes``            ``-n`` SIZES        Comma separated numbers of nodes in
+                                           the synthetic networks.
+                                           Defaults to 1000,10000,100000.
+``--benchmarks``       ``-b`` BENCHMARKS   Comma separated benchmarks to run.
+                                           Defaults to all of them.
+``--latency``          ``-l`` LATENCY      Seconds the stand-in server waits
+                                           before answering each request.
+``--batch-size``       ``-s`` BATCH-SIZE   Batch size passed to the importer.
+``--stream``           ``-t``              Stream the import requests.
+``--workers``          ``-w`` WORKERS      Processes used by the run_parallel
+                                           benchmark. Defaults to 4.
+``--compact``          ``-k``              Write networks without indentation.
+``--compression``      ``-z`` COMPRESSION  Compress written networks (gzip or
+                                           bz2).
+``--output``           ``-o`` OUTPUT       Write the results to this JSON file.
+``--baseline``         ``-c`` BASELINE     Compare against the results in this
+                                           JSON file, and fail if throughput
+                                           has dropped by more than the
+                                           tolerance.
+``--tolerance``        ``-e`` TOLERANCE    Fraction by which throughput may
+                                           drop. Defaults to 0.2.
+====================== ====== ============ =======================================
+
+"""
+
+import argparse as ap
+import BaseHTTPServer
+import itertools
+import json
+import logging
+import multiprocessing
+import os, sys
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    #Not available on Windows
+    resource = None
+
+#The apps are found beside this file, as it is also imported by the tests.
+global __location__
+__location__ = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(__location__, '..', 'Import'))
+sys.path.insert(0, os.path.join(__location__, '..', 'Run'))
+
+log = logging.getLogger(__name__)
+
+TEMPLATE_ID = 1
+
+#The component types used in the synthetic networks.
+NODE_TYPES  = ['Household', 'Reservoir', 'Junction', 'Demand']
+LINK_TYPES  = ['Pipeline', 'River']
+GROUP_TYPES = ['Utility', 'Governorate']
+
+#The number of nodes in each of the lowest level institutions.
+NODES_PER_INSTITUTION = 100
+
+#The number of institutions in each of the higher level ones.
+INSTITUTIONS_PER_GROUP = 10
+
+#The batch size used by the import_batched benchmark.
+IMPORT_BATCH_SIZE = 2000
+
+#The number of scenarios whose data is fetched by the fetch_data benchmark.
+DATA_SCENARIOS = 4
+
+#The number of simulations, and the timesteps of each, run by the
+#run_serial and run_parallel benchmarks, and the number of updates made to
+#each node in each timestep.
+RUN_SIMULATIONS = 4
+RUN_TIMESTEPS   = 12
+RUN_UPDATES     = 10
+
+class StandInState(object):
+    """
+        The data held by the stand-in server: the template, attributes,
+        projects and networks, along with a source of new IDs.
+    """
+
+    def __init__(self, latency=0):
+        self.latency  = latency
+        self.ids      = itertools.count(1)
+        self.lock     = threading.Lock()
+        self.projects = {}
+        self.networks = {}
+
+        #The number of calls to each function, for reporting.
+        self.calls    = {}
+
+        #The session IDs given by login, and the number of calls made
+        #with each session ID. Requests with an expired one are refused.
+        self.sessions = {}
+        self.expired_sessions = set()
+
+        type_names = NODE_TYPES + LINK_TYPES + GROUP_TYPES + ['Network']
+        self.template = dict(
+            id    = TEMPLATE_ID,
+            name  = 'Benchmark Template',
+            types = [dict(id=i + 1, name=name, template_id=TEMPLATE_ID)
+                     for i, name in enumerate(type_names)],
+        )
+        self.attributes = [dict(id=i + 1, name=name, dimension='dimensionless')
+                           for i, name in enumerate(['flow', 'volume', 'demand'])]
+
+    def next_id(self):
+        with self.lock:
+            return self.ids.next()
+
+    def _save_resources(self, resources, node_id_map=None):
+        for r in resources:
+            temp_id = r.get('id')
+            r['id'] = self.next_id()
+            r.setdefault('attributes', [])
+            if node_id_map is not None:
+                node_id_map[temp_id] = r['id']
+        return resources
+
+    def login(self, username=None, password=None):
+        return dict(session_id="session %s"%self.next_id())
+
+    def add_project(self, project):
+        project['id'] = self.next_id()
+        self.projects[project['id']] = project
+        return project
+
+    def get_project(self, project_id):
+        return self.projects[int(project_id)]
+
+    def get_template(self, template_id):
+        return self.template
+
+    def get_all_attributes(self, template_id=None):
+        return self.attributes
+
+    def add_network(self, net):
+        node_id_map = {}
+        self._save_resources(net.get('nodes', []), node_id_map)
+        self._save_resources(net.get('links', []))
+        self._save_resources(net.get('resourcegroups', []))
+        for link in net.get('links', []):
+            link['node_1_id'] = node_id_map.get(link['node_1_id'], link['node_1_id'])
+            link['node_2_id'] = node_id_map.get(link['node_2_id'], link['node_2_id'])
+
+        net['id'] = self.next_id()
+        net.setdefault('attributes', [])
+        net['scenarios'] = []
+        self.networks[net['id']] = net
+        return net
+
+    def add_nodes(self, network_id, nodes):
+        self._save_resources(nodes)
+        self.networks[network_id]['nodes'].extend(nodes)
+        return nodes
+
+    def add_links(self, network_id, links):
+        self._save_resources(links)
+        self.networks[network_id]['links'].extend(links)
+        return links
+
+    def add_group(self, network_id, group):
+        self._save_resources([group])
+        self.networks[network_id]['resourcegroups'].append(group)
+        return group
+
+    def add_scenario(self, network_id, scen):
+        scen['id'] = self.next_id()
+        for item in scen.get('resourcegroupitems', []):
+            item['id'] = self.next_id()
+        self.networks[int(network_id)]['scenarios'].append(scen)
+        return scen
+
+    def _find(self, key, resource_id):
+        """
+            Return the network holding the node, link or group (by its key
+            in the network) and the resource's position in it.
+        """
+        for net in self.networks.values():
+            for i, resource in enumerate(net[key]):
+                if resource['id'] == int(resource_id):
+                    return net, i
+        raise KeyError("No resource %s in %s"%(resource_id, key))
+
+    def _update(self, key, resource):
+        net, i = self._find(key, resource['id'])
+        resource.setdefault('attributes', [])
+        net[key][i] = resource
+        return resource
+
+    def _delete(self, key, resource_id):
+        net, i = self._find(key, resource_id)
+        del net[key][i]
+        return 'OK'
+
+    def update_node(self, node):
+        return self._update('nodes', node)
+
+    def update_link(self, link):
+        return self._update('links', link)
+
+    def update_group(self, group):
+        return self._update('resourcegroups', group)
+
+    def delete_node(self, node_id):
+        return self._delete('nodes', node_id)
+
+    def delete_link(self, link_id):
+        return self._delete('links', link_id)
+
+    def delete_group(self, group_id):
+        return self._delete('resourcegroups', group_id)
+
+    def _scenario(self, scenario_id):
+        for net in self.networks.values():
+            for scen in net['scenarios']:
+                if scen['id'] == int(scenario_id):
+                    return scen
+        raise KeyError("No scenario %s"%scenario_id)
+
+    def add_resourcegroupitems(self, scenario_id, items):
+        for item in items:
+            item['id'] = self.next_id()
+        self._scenario(scenario_id).setdefault('resourcegroupitems', []).extend(items)
+        return items
+
+    def delete_resourcegroupitems(self, scenario_id, item_ids):
+        scen = self._scenario(scenario_id)
+        item_ids = set(item_ids)
+        scen['resourcegroupitems'] = [item for item in scen.get('resourcegroupitems', [])
+                                      if item['id'] not in item_ids]
+        return 'OK'
+
+    def get_network(self, network_id, scenario_ids=None, include_data='Y',
+                    summary='N', **kwargs):
+        net = self.networks[int(network_id)]
+        if include_data == 'Y' and summary == 'N':
+            return net
+        net = dict(net)
+        net['scenarios'] = [dict(s, resourcescenarios=[]) for s in net['scenarios']]
+        if summary == 'Y':
+            #As Hydra does, leaves out the attributes of the resources.
+            for key in ('nodes', 'links', 'resourcegroups'):
+                net[key] = [dict((k, v) for k, v in r.items() if k != 'attributes')
+                            for r in net[key]]
+        return net
+
+    def get_attribute_datasets(self, attr_id, scenario_id):
+        for net in self.networks.values():
+            for scen in net['scenarios']:
+                if scen['id'] == int(scenario_id):
+                    return [rs for rs in scen.get('resourcescenarios', [])
+                            if rs['attr_id'] == attr_id]
+        return []
+
+    def update_resourcedata(self, scenario_id, resource_scenarios):
+        return []
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Answers Hydra JSON requests, of the form {function_name: {args}},
+        from a StandInState. Connections are kept alive between requests,
+        as the Hydra server's are.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    #Otherwise the headers and body, written separately, are held up
+    #waiting for the acknowledgement of the previous response.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        state = self.server.state
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        (func, args), = json.loads(body).items()
+
+        state.calls[func] = state.calls.get(func, 0) + 1
+        session_id = self.headers.get('session_id')
+        state.sessions[session_id] = state.sessions.get(session_id, 0) + 1
+        if state.latency > 0:
+            time.sleep(state.latency)
+
+        handler = getattr(state, func, None)
+        if session_id in state.expired_sessions:
+            self.send_response(500)
+            response = json.dumps({'faultcode': 'Server',
+                                   'faultstring': "Session %s has expired"%session_id})
+        elif handler is None:
+            self.send_response(500)
+            response = json.dumps({'faultcode': 'Server',
+                                   'faultstring': "Unknown function %s"%func})
+        else:
+            try:
+                response = json.dumps(handler(**args))
+            except Exception, e:
+                #Reported as the server reports its faults.
+                self.send_response(500)
+                response = json.dumps({'faultcode': 'Server', 'faultstring': str(e)})
+            else:
+                self.send_response(200)
+
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(latency, port_queue):
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    server.state = StandInState(latency)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def start_server(latency=0):
+    """
+        Start a stand-in server on a free local port, in its own process,
+        so the networks it holds are not counted in a benchmark's memory.
+        Returns the process and the URL to connect to.
+    """
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(latency, port_queue))
+    process.daemon = True
+    process.start()
+    return process, "http://127.0.0.1:%s/json"%port_queue.get()
+
+class Component(object):
+    """
+        The parts of a prototype node, link or institution which the apps
+        use.
+    """
+
+    def __init__(self, name, component_type, **kwargs):
+        self.name = name
+        self.component_type = component_type
+        self.__dict__.update(kwargs)
+
+def synthetic_network(num_nodes):
+    """
+        Build a prototype network with num_nodes nodes, each linked to the
+        next, and two levels of institutions: one for every
+        NODES_PER_INSTITUTION nodes and their links, and one for every
+        INSTITUTIONS_PER_GROUP of those.
+    """
+    nodes = [Component("Node %s"%i,
+                       NODE_TYPES[i % len(NODE_TYPES)],
+                       x = i % 1000,
+                       y = (i // 1000) * 1000)
+             for i in xrange(num_nodes)]
+
+    links = [Component("Link %s"%i,
+                       LINK_TYPES[i % len(LINK_TYPES)],
+                       start_node = nodes[i],
+                       end_node   = nodes[i + 1])
+             for i in xrange(num_nodes - 1)]
+
+    institutions = []
+    for i in xrange(0, num_nodes, NODES_PER_INSTITUTION):
+        institutions.append(Component("Institution %s"%len(institutions),
+                                      GROUP_TYPES[0],
+                                      nodes = nodes[i:i + NODES_PER_INSTITUTION],
+                                      links = links[i:i + NODES_PER_INSTITUTION],
+                                      institutions = []))
+
+    groups = []
+    for i in xrange(0, len(institutions), INSTITUTIONS_PER_GROUP):
+        groups.append(Component("Group %s"%len(groups),
+                                GROUP_TYPES[1],
+                                nodes = [],
+                                links = [],
+                                institutions = institutions[i:i + INSTITUTIONS_PER_GROUP]))
+
+    return Component('Synthetic Network', 'Network',
+                     nodes = nodes,
+                     links = links,
+                     institutions = institutions + groups)
+
+class SyntheticModelNetwork(object):
+    """
+        The network of a SyntheticSimulation: num_nodes nodes, each of
+        which updates its demand in every timestep and records it.
+    """
+
+    def __init__(self, num_nodes):
+        self.nodes = [Component("Node %s"%i, NODE_TYPES[i % len(NODE_TYPES)],
+                                demand=float(i % 10), _history={'demand': []})
+                      for i in xrange(num_nodes)]
+        self.links = []
+        self.institutions = []
+        self.exogenous_inputs = Component('Exogenous inputs', 'ExogenousInputs',
+                                          amman_model_user_input_params=[1.0])
+        self._history = {}
+        self.current_timestep = None
+        self.current_timestep_idx = None
+
+    def set_timestep(self, timestep, timestep_index):
+        self.current_timestep = timestep
+        self.current_timestep_idx = timestep_index
+
+    def step(self):
+        factor = self.exogenous_inputs.amman_model_user_input_params[0]
+        for node in self.nodes:
+            demand = node.demand
+            for i in xrange(RUN_UPDATES):
+                demand = (demand * factor + i) ** 0.5
+            node.demand = demand
+            node._history['demand'].append(demand)
+
+class SyntheticSimulation(object):
+    """
+        Stands in for a prototype simulation, so the runner can be
+        benchmarked without the workbook. Like a pynsim simulation, it
+        sets the timestep on its network at the start of each timestep.
+    """
+
+    def __init__(self, name, num_nodes):
+        self.name = name
+        self.timesteps = range(RUN_TIMESTEPS)
+        self.network = SyntheticModelNetwork(num_nodes)
+
+    def start(self):
+        for timestep_index, timestep in enumerate(self.timesteps):
+            self.network.set_timestep(timestep, timestep_index)
+            self.network.step()
+
+def hydra_network(num_nodes):
+    """
+        Build a network as it would be returned by get_network, with a
+        scenario holding a time series for each node.
+    """
+    timestep_names = ["2015-%02d-01 00:00:00"%(m + 1) for m in range(12)]
+    nodes = [dict(id=i, name="Node %s"%i, x=i % 1000, y=i // 1000,
+                  attributes=[dict(id=i, attr_id=1)])
+             for i in xrange(num_nodes)]
+    links = [dict(id=num_nodes + i, name="Link %s"%i, node_1_id=i, node_2_id=i + 1,
+                  attributes=[])
+             for i in xrange(num_nodes - 1)]
+    resourcescenarios = [dict(resource_attr_id=i, attr_id=1,
+                              value=dict(type='timeseries',
+                                         value=json.dumps({'0': dict((t, float(i))
+                                                                     for t in timestep_names)})))
+                         for i in xrange(num_nodes)]
+    return dict(id=1, name='Synthetic Network', nodes=nodes, links=links,
+                resourcegroups=[], attributes=[],
+                scenarios=[dict(id=1, name='Baseline',
+                                resourcescenarios=resourcescenarios)])
+
+def _import(url, network, options):
+    import import_network
+    importer = import_network.NetworkImporter(url=url,
+                                              session_id='benchmark',
+                                              batch_size=options.get('batch_size'),
+                                              stream=options.get('stream', False))
+    importer._network = network
+    importer.get_template(TEMPLATE_ID)
+    return importer
+
+def bench_import(url, num_nodes, options):
+    """
+        Import a network and its scenario into the stand-in server.
+        Returns the time taken.
+    """
+    network  = synthetic_network(num_nodes)
+    importer = _import(url, network, options)
+    start_time = time.time()
+    importer.import_network(TEMPLATE_ID, None)
+    importer.import_scenarios()
+    return time.time() - start_time
+
+def bench_import_streamed(url, num_nodes, options):
+    """
+        Import a network as bench_import does, streaming the requests, so
+        its peak memory can be compared.
+    """
+    return bench_import(url, num_nodes, dict(options, stream=True))
+
+def bench_import_batched(url, num_nodes, options):
+    """
+        Import a network as bench_import does, in batches of
+        IMPORT_BATCH_SIZE unless --batch-size is given, so its peak memory
+        can be compared.
+    """
+    return bench_import(url, num_nodes,
+                        dict(options, batch_size=options.get('batch_size') or IMPORT_BATCH_SIZE))
+
+def bench_group_items(url, num_nodes, options):
+    """
+        Build the scenario's group memberships for an imported network.
+        Returns the time taken.
+    """
+    network  = synthetic_network(num_nodes)
+    importer = _import(url, network, options)
+    importer.build_tables()
+    for table in (importer.node_table, importer.link_table, importer.group_table):
+        for i, name in enumerate(table.names):
+            table.set_id(name, i + 1)
+
+    start_time = time.time()
+    for item in importer.iter_group_items():
+        pass
+    return time.time() - start_time
+
+def bench_fetch(url, num_nodes, options):
+    """
+        Retrieve an imported network as the runner does before a run.
+        Returns the time taken.
+    """
+    import run_model
+    importer = _import(url, synthetic_network(num_nodes), options)
+    network = importer.import_network(TEMPLATE_ID, None)
+    scenario = importer.import_scenarios()[0]
+
+    runner = run_model.ModelRunner(url=url, session_id='benchmark')
+    start_time = time.time()
+    runner.get_network_data(network.id, scenario.id)
+    return time.time() - start_time
+
+def bench_fetch_snapshot(url, num_nodes, options):
+    """
+        Retrieve an imported network from its local snapshot, made by an
+        earlier fetch. Returns the time taken.
+    """
+    import run_model
+    importer = _import(url, synthetic_network(num_nodes), options)
+    network = importer.import_network(TEMPLATE_ID, None)
+    scenario = importer.import_scenarios()[0]
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = run_model.PluginCache(cache_dir=cache_dir)
+        runner = run_model.ModelRunner(url=url, session_id='benchmark',
+                                       cache=cache, local_snapshot=True)
+        runner.get_network_data(network.id, scenario.id)
+
+        runner = run_model.ModelRunner(url=url, session_id='benchmark',
+                                       cache=cache, local_snapshot=True)
+        start_time = time.time()
+        runner.get_network_data(network.id, scenario.id)
+        return time.time() - start_time
+    finally:
+        shutil.rmtree(cache_dir)
+
+def bench_fetch_data(url, num_nodes, options):
+    """
+        Retrieve a network with several scenarios, and then the data of
+        each scenario used by the model, as the runner does with an
+        attribute map. Returns the time taken.
+    """
+    import run_model
+    runner = run_model.ModelRunner(url=url, session_id='benchmark')
+    network = hydra_network(num_nodes)
+    network['types'] = [dict(name='Network', template_id=TEMPLATE_ID)]
+    resourcescenarios = network['scenarios'][0]['resourcescenarios']
+    network_id = runner.call('add_network', {'net':network}).id
+    scenario_ids = [runner.call('add_scenario', {'network_id':network_id,
+                                                 'scen':dict(name="Scenario %s"%i,
+                                                             resourcescenarios=resourcescenarios)}).id
+                    for i in range(DATA_SCENARIOS)]
+
+    runner = run_model.ModelRunner(url=url, session_id='benchmark')
+    runner.attribute_map = {'NODE': {'flow': 'flow'}}
+    start_time = time.time()
+    runner.get_network_data(network_id, scenario_ids)
+    for scenario_data in runner.scenario_data.values():
+        for node in runner.network.nodes:
+            for ra in node.attributes:
+                scenario_data.get(ra.id, ra.attr_id)
+    return time.time() - start_time
+
+def _run(url, num_nodes, num_workers):
+    import run_model
+    runner = run_model.ModelRunner(url=url, session_id='benchmark',
+                                   num_workers=num_workers)
+    runner.preloaded_simulations = [SyntheticSimulation("Simulation %s"%i, num_nodes)
+                                    for i in range(RUN_SIMULATIONS)]
+    start_time = time.time()
+    runner.run_model()
+    elapsed = time.time() - start_time
+    if len(runner.errors) > 0:
+        raise Exception(runner.errors[0])
+    return elapsed
+
+def bench_run_serial(url, num_nodes, options):
+    """
+        Run RUN_SIMULATIONS synthetic simulations one after another.
+        Returns the time taken.
+    """
+    return _run(url, num_nodes, 1)
+
+def bench_run_parallel(url, num_nodes, options):
+    """
+        Run the simulations of bench_run_serial on --workers processes,
+        so the two can be compared. Returns the time taken. The peak
+        memory is only that of the parent process.
+    """
+    return _run(url, num_nodes, options.get('workers', RUN_SIMULATIONS))
+
+def bench_write_network(url, num_nodes, options):
+    """
+        Write a retrieved network, with its scenario data, to a file.
+        Returns the time taken.
+    """
+    import run_model
+    network = hydra_network(num_nodes)
+    runner = run_model.ModelRunner(url=url, session_id='benchmark',
+                                   compact=options.get('compact', False),
+                                   compression=options.get('compression'))
+    target_dir = tempfile.mkdtemp()
+    try:
+        start_time = time.time()
+        runner.write_network(network, target_dir)
+        return time.time() - start_time
+    finally:
+        shutil.rmtree(target_dir)
+
+BENCHMARKS = [
+    ('import',        bench_import),
+    ('import_streamed', bench_import_streamed),
+    ('import_batched', bench_import_batched),
+    ('group_items',   bench_group_items),
+    ('fetch',         bench_fetch),
+    ('fetch_snapshot', bench_fetch_snapshot),
+    ('fetch_data',    bench_fetch_data),
+    ('write_network', bench_write_network),
+    ('run_serial',    bench_run_serial),
+    ('run_parallel',  bench_run_parallel),
+]
+
+def run_benchmark(job, queue):
+    """
+        Run one benchmark in its own process, putting the time taken and
+        the peak memory of the process (in KB on Linux, or None) on the
+        queue, or the error if it failed.
+    """
+    name, url, num_nodes, options = job
+
+    #Keep the apps' progress messages and logging out of the results.
+    sys.stdout = open(os.devnull, 'w')
+    logging.getLogger().addHandler(logging.NullHandler())
+
+    try:
+        elapsed = dict(BENCHMARKS)[name](url, num_nodes, options)
+    except Exception:
+        queue.put(traceback.format_exc())
+        return
+
+    peak_memory = None
+    if resource is not None:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, peak_memory))
+
+def run_benchmarks(names, sizes, latency=0, options=None):
+    """
+        Run each named benchmark at each size, each in a new process,
+        against a stand-in server. Returns a list of results.
+    """
+    results = []
+    for name in names:
+        for num_nodes in sizes:
+            server, url = start_server(latency)
+
+            #Not a pool, as the runner's workers can't be started from a
+            #pool's (daemonic) processes.
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_benchmark,
+                                              args=((name, url, num_nodes, options or {}),
+                                                    queue))
+            try:
+                process.start()
+                result = queue.get()
+                process.join()
+            finally:
+                server.terminate()
+            if not isinstance(result, tuple):
+                raise Exception("Benchmark %s with %s nodes failed:\n%s"%(
+                                                            name, num_nodes, result))
+            elapsed, peak_memory = result
+
+            results.append(dict(
+                benchmark   = name,
+                nodes       = num_nodes,
+                seconds     = elapsed,
+                throughput  = num_nodes / elapsed if elapsed > 0 else None,
+                peak_memory = peak_memory,
+            ))
+            print "%-16s %10s nodes %10.3fs %14.0f nodes/s %12s KB"%(
+                name, num_nodes, elapsed, results[-1]['throughput'] or 0, peak_memory)
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+        Return a message for each result whose throughput has dropped by
+        more than 'tolerance' compared to the same benchmark and size in
+        the baseline.
+    """
+    previous = dict(((r['benchmark'], r['nodes']), r) for r in baseline)
+    regressions = []
+    for r in results:
+        old = previous.get((r['benchmark'], r['nodes']))
+        if old is None or not old['throughput'] or not r['throughput']:
+            continue
+        if r['throughput'] < old['throughput'] * (1 - tolerance):
+            regressions.append("%s with %s nodes: %.0f nodes/s, was %.0f nodes/s"%(
+                r['benchmark'], r['nodes'], r['throughput'], old['throughput']))
+    return regressions
+
+def commandline_parser():
+    parser = ap.ArgumentParser(
+        description="""Benchmark the Import and Run apps against a local
+                    stand-in for the Hydra server.
+        """, epilog="For more information visit www.hydraplatform.org")
+    parser.add_argument('-n', '--sizes', default='1000,10000,100000',
+                        help='''Comma separated numbers of nodes in the
+                        synthetic networks.''')
+    parser.add_argument('-b', '--benchmarks', default=','.join(n for n, f in BENCHMARKS),
+                        help='''Comma separated benchmarks to run.''')
+    parser.add_argument('-l', '--latency', type=float, default=0,
+                        help='''Seconds the stand-in server waits before
+                        answering each request.''')
+    parser.add_argument('-s', '--batch-size', type=int,
+                        help='''Batch size passed to the importer.''')
+    parser.add_argument('-t', '--stream', action='store_true',
+                        help='''Stream the import requests.''')
+    parser.add_argument('-w', '--workers', type=int, default=RUN_SIMULATIONS,
+                        help='''Processes used by the run_parallel benchmark.''')
+    parser.add_argument('-k', '--compact', action='store_true',
+                        help='''Write networks without indentation.''')
+    parser.add_argument('-z', '--compression',
+                        help='''Compress written networks (gzip or bz2).''')
+    parser.add_argument('-o', '--output',
+                        help='''Write the results to this JSON file.''')
+    parser.add_argument('-c', '--baseline',
+                        help='''Compare against the results in this JSON file.''')
+    parser.add_argument('-e', '--tolerance', type=float, default=0.2,
+                        help='''Fraction by which throughput may drop before
+                        it is reported as a regression.''')
+    return parser
+
+if __name__ == '__main__':
+    parser = commandline_parser()
+    args = parser.parse_args()
+
+    names = args.benchmarks.split(',')
+    for name in names:
+        if name not in dict(BENCHMARKS):
+            parser.error("Unknown benchmark %s"%name)
+    sizes = [int(n) for n in args.sizes.split(',')]
+
+    results = run_benchmarks(names, sizes, args.latency,
+                             dict(batch_size=args.batch_size, stream=args.stream,
+                                  workers=args.workers,
+                                  compact=args.compact, compression=args.compression))
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4, separators=(',', ': '))
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print "Regression: %s"%regression
+        if len(regressions) > 0:
+            sys.exit(1)
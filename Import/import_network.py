@@ -10,6 +10,24 @@ Basic usage::
 
        import__network.py [-h]
 
+To avoid paying for the start up, login and workbook loading on every
+import, the app can be left running as a daemon with ``--daemon``. Later
+imports pass their command line and directory to the daemon over a local
+socket, which runs them in that directory, and print what it prints as it
+goes. Imports to the daemon's server share its connection, using their own
+session ID. Without a daemon they run in-process.
+
+Each simulation in the workbook is imported as a scenario of the network,
+which is built from the first simulation.
+
+Each stage of a new import, such as each batch of nodes, is recorded in a
+journal with the IDs the server gave it, so an import which fails part way
+through can be carried on with ``--resume``.
+
+The time, CPU time and memory of each phase of the import are returned in
+timings.json: the largest resident memory of the process by the end of
+the phase, and how much the phase raised it.
+
 Options
 ~~~~~~~
 
@@ -20,12 +38,42 @@ Option                 Short  Parameter    Description
 ``--template-id''      ``-t'' TEMPLATE-ID  The ID of the  Template
 ``--project-id''       ``-p'' PROJECT-ID   The ID of the project you want to
                                            import the network into.
+``--network-id``       ``-n`` NETWORK-ID   The ID of a network, previously
+                                           imported, to update with only the
+                                           changes made since.
 ``--server-url``       ``-u`` SERVER-URL   Url of the server the plugin will
                                            connect to.
                                            Defaults to localhost.
 ``--session-id``       ``-c`` SESSION-ID   Session ID used by the calling software.
                                            If left empty, the plugin will attempt
                                            to log in itself.
+``--batch-size``       ``-b`` BATCH-SIZE   Upload the nodes, links and groups in
+                                           batches of this size rather than in
+                                           a single request. This is what
+                                           keeps the memory used by large
+                                           imports down.
+``--workers``          ``-w`` WORKERS      Number of concurrent requests used
+                                           when uploading in batches.
+                                           Defaults to 4.
+``--stream``           ``-s``              Write the network and scenario
+                                           requests a piece at a time rather
+                                           than building them in memory. The
+                                           server's response still holds the
+                                           whole network, so this saves less
+                                           memory than --batch-size.
+``--refresh-cache``    ``-r``              Ignore the cached attributes,
+                                           template and workbook snapshot,
+                                           rebuild them and update the cache.
+``--no-cache``         ``-x``              Do not read or write the cache.
+``--resume``           ``-e``              Carry on with the last import into
+                                           the template and project from where
+                                           it failed, rather than starting
+                                           again.
+``--daemon``           ``-d``              Stay running, accepting imports from
+                                           later invocations of the app.
+``--profile``          ``-f``              Profile the import with cProfile and
+                                           return the statistics in
+                                           profile.pstats.
 ====================== ====== ============ =======================================
 
 """
@@ -41,24 +89,691 @@ from HydraLib.PluginLib import JsonConnection,\
                                write_output,\
                                validate_plugin_xml,\
                                RequestError,\
+                               JSONObj,\
                                temp_ids
+import cPickle
+import cProfile
+import hashlib
+import json
 import os, sys
+import Queue
+import requests
+import socket
+import tempfile
+import threading
+import time
+import types
 
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
     
 from prototype import simulation_setup
 
+try:
+    import resource
+except ImportError:
+    #Not available on Windows
+    resource = None
+
+try:
+    import numpy
+except ImportError:
+    #Only used to speed up the ResourceTables
+    numpy = None
+
 log = logging.getLogger(__name__)
 
 global __location__
-__location__ = os.path.split(sys.argv[0])[0]
+__location__ = os.path.dirname(os.path.abspath(__file__))
+
+#The socket on which the daemon listens for imports.
+SOCKET_PATH = os.path.join(os.path.expanduser('~'), '.hydra', 'import_network.sock')
+
+def iter_json(obj):
+    """
+        Encode obj as JSON, a piece at a time. Generators found in obj are
+        encoded as lists, one item at a time, so they are never held in
+        memory in full. Each item, such as a node, is encoded in one go.
+    """
+    if isinstance(obj, dict):
+        yield '{'
+        for i, (k, v) in enumerate(obj.items()):
+            if i > 0:
+                yield ','
+            yield json.dumps(k) + ':'
+            for chunk in iter_json(v):
+                yield chunk
+        yield '}'
+    elif isinstance(obj, types.GeneratorType):
+        yield '['
+        for i, item in enumerate(obj):
+            if i > 0:
+                yield ','
+            yield json.dumps(item)
+        yield ']'
+    else:
+        yield json.dumps(obj)
+
+def request_error(response, app_name=None):
+    """
+        Return the RequestError for a failed response, with the server's
+        fault as JsonConnection reports it, rather than the raw body.
+    """
+    try:
+        fault = json.loads(response.content)
+        if 'faultcode' in fault:
+            message = "%s:%s"%(fault['faultcode'], fault['faultstring'])
+        else:
+            message = fault['faultstring']
+    except Exception:
+        message = response.reason or "An unknown server error has occurred."
+
+    if app_name is not None:
+        message = "%s: %s"%(app_name, message)
+    return RequestError(message)
+
+def session_expired(response):
+    """
+        Whether a failed response is the server's refusal of the session,
+        such as one which has expired, so a new login can be tried.
+    """
+    try:
+        fault = json.loads(response.content)['faultstring']
+    except Exception:
+        return False
+    return 'session' in fault.lower()
+
+def stream_call(connection, func, args):
+    """
+        Make the same request as connection.call, but write the body to a
+        temporary file as it is encoded and then stream that file to the
+        server, rather than building the whole request as one string.
+    """
+    log.info("Streaming call: %s", func)
+    with tempfile.TemporaryFile() as body:
+        for chunk in iter_json({func:args}):
+            body.write(chunk)
+        body.seek(0)
+
+        #A ConnectionPool sends it over one of its keep-alive sessions.
+        if isinstance(connection, ConnectionPool):
+            return connection.post(func, body)
+
+        headers = {
+            'Content-Type': 'application/json',
+            'session_id'  : connection.session_id,
+            'app_name'    : getattr(connection, 'app_name', 'Import Network'),
+        }
+        response = requests.post(connection.url, data=body, headers=headers)
+
+    if not response.ok:
+        raise request_error(response, headers['app_name'])
+
+    return json.loads(response.content, object_hook=JSONObj)
+
+def measure():
+    """
+        Return the wall time, the CPU time and the largest resident memory
+        of the process so far (in KB on Linux, or None where it isn't
+        available).
+    """
+    max_rss = None
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return time.time(), sum(os.times()[:2]), max_rss
+
+def memory_increase(start_rss, end_rss):
+    """
+        How much the largest resident memory of the process grew between
+        two measurements, or None if it isn't available. A phase which
+        stays within the memory of earlier phases shows no increase.
+    """
+    if start_rss is None or end_rss is None:
+        return None
+    return end_rss - start_rss
+
+class Instrumentation(object):
+    """
+        Records the wall time and CPU time of each phase of a run, such
+        as parsing the workbook or each request to the server, so they can
+        be written to a JSON file for the user. The memory of each phase
+        is the largest resident memory of the process by its end
+        (max_rss_so_far) and how much the phase raised it
+        (max_rss_increase), both in KB, as the process's memory can only
+        be measured since it started.
+    """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start_wall, start_cpu, start_rss = measure()
+        try:
+            yield
+        finally:
+            end_wall, end_cpu, end_rss = measure()
+            self.add(name, end_wall - start_wall, end_cpu - start_cpu,
+                     end_rss, memory_increase(start_rss, end_rss))
+
+    def add(self, name, wall_time, cpu_time, max_rss_so_far, max_rss_increase):
+        self.phases.append(dict(
+            phase            = name,
+            wall_time        = wall_time,
+            cpu_time         = cpu_time,
+            max_rss_so_far   = max_rss_so_far,
+            max_rss_increase = max_rss_increase,
+        ))
+
+    def summary(self):
+        """
+            Total wall time for each phase name, in the order they were
+            first seen, as a string for the plugin's output.
+        """
+        totals = OrderedDict()
+        for p in self.phases:
+            count, wall_time = totals.get(p['phase'], (0, 0))
+            totals[p['phase']] = (count + 1, wall_time + p['wall_time'])
+
+        parts = []
+        for name, (count, wall_time) in totals.items():
+            if count > 1:
+                parts.append("%s (x%s): %.2fs"%(name, count, wall_time))
+            else:
+                parts.append("%s: %.2fs"%(name, wall_time))
+        return ", ".join(parts)
+
+    def write(self, file_name):
+        with open(file_name, 'w') as timings_file:
+            json.dump(self.phases, timings_file, indent=4, separators=(',', ': '))
+
+def find_workbook(setup_module, file_name='models_input.xlsx'):
+    """
+        Find the workbook read by the simulation setup module. It is looked
+        for beside the module, in the directory above and in the current
+        directory. Returns None if it can't be found.
+    """
+    module_dir = os.path.dirname(os.path.abspath(setup_module.__file__))
+    for search_dir in (module_dir, os.path.dirname(module_dir), os.getcwd()):
+        path = os.path.join(search_dir, file_name)
+        if os.path.exists(path):
+            return path
+    return None
+
+class SimulationSnapshot(object):
+    """
+        Saves the simulations loaded from a workbook to a binary file, so
+        later runs can skip parsing the workbook. The snapshot records the
+        modification time and content hash of the workbook, and is ignored
+        if either has changed since it was made.
+    """
+
+    def __init__(self, workbook, name, snapshot_dir, refresh=False):
+        self.workbook = workbook
+        path_hash = hashlib.sha1(os.path.abspath(workbook)).hexdigest()
+        self.path = os.path.join(snapshot_dir, "%s_%s.snapshot"%(path_hash, name))
+
+        #If refresh is set, the snapshot is never loaded, only saved.
+        self.refresh = refresh
+
+        self._workbook_key = None
+
+    def workbook_key(self):
+        if self._workbook_key is None:
+            with open(self.workbook, 'rb') as workbook_file:
+                content_hash = hashlib.sha1(workbook_file.read()).hexdigest()
+            self._workbook_key = (os.path.getmtime(self.workbook), content_hash)
+        return self._workbook_key
+
+    def load(self):
+        """
+            Return the saved simulations, or None if there is no snapshot
+            or it is out of date.
+        """
+        if self.refresh is True or not os.path.exists(self.path):
+            return None
+
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                #The key is stored first so an out of date snapshot can be
+                #rejected without loading the simulations.
+                if cPickle.load(snapshot_file) != self.workbook_key():
+                    log.info("Snapshot of %s is out of date", self.workbook)
+                    return None
+                simulations = cPickle.load(snapshot_file)
+        except Exception, e:
+            log.warn("Unable to load snapshot %s: %s", self.path, e)
+            return None
+
+        log.info("Loaded simulations from snapshot %s", self.path)
+        return simulations
+
+    def save(self, simulations):
+        try:
+            with open(self.path, 'wb') as snapshot_file:
+                cPickle.dump(self.workbook_key(), snapshot_file, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump(simulations, snapshot_file, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            #Not all simulations can be pickled. This only costs the
+            #next run a parse of the workbook, so carry on.
+            log.warn("Unable to save snapshot %s: %s", self.path, e)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+class PluginCache(object):
+    """
+        A small on-disk cache for objects which rarely change on the server,
+        such as attributes and templates. Entries expire after 'ttl' seconds
+        and, once there are more than 'max_entries' of them, the least
+        recently used are removed. Values are stored as JSON, as they came
+        from the server, and come back as JSONObjs.
+    """
+
+    def __init__(self, cache_dir=None, ttl=86400, max_entries=50, refresh=False):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.hydra', 'cache')
+        self.cache_dir   = cache_dir
+        self.ttl         = ttl
+        self.max_entries = max_entries
+
+        #If refresh is set, nothing is read from the cache, but everything
+        #fetched from the server is written to it.
+        self.refresh     = refresh
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _path(self, key):
+        key_hash = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.cache_dir, "%s.cache"%key_hash)
+
+    def get(self, key):
+        """
+            Return the value stored against key, or None if there is no
+            entry, or it has expired.
+        """
+        if self.refresh is True:
+            return None
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'rb') as cache_file:
+                created, encoded = cPickle.load(cache_file)
+            if time.time() - created > self.ttl:
+                return None
+            value = json.loads(encoded, object_hook=JSONObj)
+        except Exception, e:
+            #A broken entry only costs a request to the server.
+            log.warn("Unable to read cache entry %s: %s", path, e)
+            return None
+
+        #Touch the file so the eviction sees it as recently used.
+        os.utime(path, None)
+        log.info("Using cached %s", key)
+        return value
+
+    def set(self, key, value):
+        path = self._path(key)
+        try:
+            encoded = json.dumps(value)
+            with open(path, 'wb') as cache_file:
+                cPickle.dump((time.time(), encoded), cache_file, cPickle.HIGHEST_PROTOCOL)
+            self._evict()
+        except Exception, e:
+            #The next run fetches it from the server again, so carry on.
+            log.warn("Unable to cache %s: %s", key, e)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _evict(self):
+        entries = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+                   if f.endswith('.cache')]
+        if len(entries) <= self.max_entries:
+            return
+
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class ImportJournal(object):
+    """
+        Records each stage of an import as it completes, such as the
+        project, the network and each batch of nodes, links, groups and
+        scenarios, with the IDs the server gave them. A failed import can
+        then be resumed, sending only what had not yet been saved, rather
+        than starting again.
+
+        Each record is a line of JSON, written to the file as soon as its
+        stage completes. A line left incomplete by a crash is ignored.
+    """
+
+    def __init__(self, journal_dir, key):
+        if not os.path.exists(journal_dir):
+            os.makedirs(journal_dir)
+        key_hash = hashlib.sha1(repr(key)).hexdigest()
+        self.path = os.path.join(journal_dir, "%s.journal"%key_hash)
+        self.records = []
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+            Read the records of an earlier import. Returns the number read.
+        """
+        self.records = []
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    self.records.append(json.loads(line))
+                except ValueError:
+                    log.warn("Ignoring incomplete record in %s", self.path)
+                    break
+        return len(self.records)
+
+    def start(self):
+        """
+            Discard the records of any earlier import.
+        """
+        self.records = []
+        open(self.path, 'w').close()
+
+    def record(self, stage, **values):
+        values['stage'] = stage
+        line = json.dumps(values)
+        with self.lock:
+            with open(self.path, 'a') as journal_file:
+                journal_file.write(line + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self.records.append(values)
+
+    def get(self, stage):
+        """
+            Return the first record of the stage, or None.
+        """
+        for r in self.records:
+            if r['stage'] == stage:
+                return r
+        return None
+
+    def saved_ids(self, stage):
+        """
+            Return the IDs of everything saved in all the records of the
+            stage, by name.
+        """
+        ids = {}
+        for r in self.records:
+            if r['stage'] == stage:
+                ids.update(r['ids'])
+        return ids
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def int_array(values):
+    if numpy is not None:
+        return numpy.array(values, dtype=numpy.int64)
+    return array('l', values)
+
+def adjust_y(y):
+    """
+        Move the y coordinate of a prototype node into the range of the
+        projection, keeping its type, so it is sent as the prototype gave
+        it.
+    """
+    if y > 800000:
+        return y - 1000000
+    elif y > 400000:
+        return y - 400000
+    return y
+
+class ResourceTable(object):
+    """
+        The nodes, links or groups of the network being imported, stored
+        by column rather than as a dictionary per resource: a table from
+        name to row, typed arrays of the temporary and saved ID of each
+        row, and any other columns, such as coordinates, given as keyword
+        arguments. Saved IDs are 0 until the resource is saved.
+
+        Uses numpy if it is available, and the array module otherwise.
+    """
+
+    def __init__(self, names, temp_ids, **columns):
+        self.names    = list(names)
+        self.index    = dict((name, row) for row, name in enumerate(self.names))
+        self.temp_ids = int_array(temp_ids)
+        self.ids      = int_array([0] * len(self.names))
+        self.columns  = columns
+
+    def __len__(self):
+        return len(self.names)
+
+    def rows(self, names):
+        """
+            Return the rows of the named resources, as an array, for
+            looking up all their IDs at once. Raises a KeyError if a name
+            is not in the table.
+        """
+        index = self.index
+        return int_array([index[name] for name in names])
+
+    def get_ids(self, rows):
+        """
+            Return the saved IDs of the rows, as a list.
+        """
+        if numpy is not None:
+            return self.ids[rows].tolist()
+        return [self.ids[row] for row in rows]
+
+    def ref_ids(self, rows):
+        """
+            Return the IDs by which other resources refer to the rows, as
+            a list: the saved ID once there is one, or the temporary ID.
+        """
+        if numpy is not None:
+            ids = self.ids[rows]
+            return numpy.where(ids != 0, ids, self.temp_ids[rows]).tolist()
+        return [self.ids[row] or self.temp_ids[row] for row in rows]
+
+    def set_id(self, name, saved_id):
+        self.ids[self.index[name]] = saved_id
+
+#The number of requests a ConnectionPool makes to the server at once.
+MAX_CONNECTIONS = 4
+
+class ConnectionPool(object):
+    """
+        Makes the requests of a logged in JsonConnection over a pool of
+        keep-alive HTTP sessions, all using the connection's session ID,
+        so each request doesn't open a new connection to the server.
+        At most max_connections requests are made at once, however many
+        threads are making them. call_async makes a request in the
+        background, so independent requests can be made concurrently.
+        If the server refuses the session, such as once it has expired,
+        the pool logs in again and repeats the request.
+
+        The function name and wall time of every request are kept in
+        latencies, in the order they finished.
+    """
+
+    def __init__(self, connection, max_connections=MAX_CONNECTIONS):
+        self.url        = connection.url
+        self.session_id = connection.session_id
+        self.app_name   = getattr(connection, 'app_name', None)
+
+        #Logs in again if the server refuses the session.
+        self._connection = connection
+
+        self.max_connections = max_connections
+
+        #The idle sessions, most recently used first. None stands for a
+        #session which hasn't been needed yet.
+        self._sessions = Queue.LifoQueue()
+        for i in range(max_connections):
+            self._sessions.put(None)
+
+        #Counts the calls to close, so a session which was making a
+        #request at the time is closed once the request is done.
+        self._generation = 0
+
+        #The threads making requests for call_async, started when first used.
+        self._pool = None
+
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def post(self, func, body, object_hook=JSONObj):
+        """
+            Send a request body, which can be a string or a file, for the
+            named function and return the decoded response, as JSONObjs
+            unless another object_hook is given (None for plain dicts,
+            which are much quicker to decode).
+        """
+        session_id = self.session_id
+        response = self._send(func, body, session_id)
+
+        if not response.ok and session_expired(response):
+            self.login(session_id)
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            response = self._send(func, body, self.session_id)
+
+        if not response.ok:
+            raise request_error(response, self.app_name)
+
+        return json.loads(response.content, object_hook=object_hook)
+
+    def _send(self, func, body, session_id):
+        headers = {
+            'Content-Type': 'application/json',
+            'session_id'  : session_id,
+            'app_name'    : self.app_name,
+        }
+
+        session = self._sessions.get()
+        generation = self._generation
+        if session is None:
+            session = requests.Session()
+        start = time.time()
+        try:
+            response = session.post(self.url, data=body, headers=headers)
+        except Exception:
+            #The session's connection may be broken, so start a new one.
+            session.close()
+            self._sessions.put(None)
+            raise
+        self._release(session, generation)
+
+        with self._lock:
+            self.latencies.append((func, time.time() - start))
+
+        return response
+
+    def login(self, refused_session_id):
+        """
+            Log in again, as the server refused the session, unless another
+            request has done so already.
+        """
+        with self._lock:
+            if self.session_id != refused_session_id:
+                return
+            write_output("Session %s refused. Logging in again."%refused_session_id)
+            self._connection.login()
+            self.session_id = self._connection.session_id
+
+    def _release(self, session, generation):
+        """
+            Return a session to the pool once its request is done.
+        """
+        if generation != self._generation:
+            session.close()
+            session = None
+        self._sessions.put(session)
+
+    def call(self, func, args, object_hook=JSONObj):
+        log.info("Calling: %s", func)
+        return self.post(func, json.dumps({func:args}), object_hook)
+
+    def call_async(self, func, args):
+        """
+            Start the request in the background and return its
+            AsyncResult. Its get method waits for the response.
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_connections)
+        return self._pool.apply_async(self.call, (func, args))
+
+    def latency_summary(self, start=0):
+        """
+            The number, mean and longest wall time of the requests to each
+            function, from the start'th request on, as a string for the
+            plugin's output.
+        """
+        totals = OrderedDict()
+        for func, wall_time in self.latencies[start:]:
+            count, total, longest = totals.get(func, (0, 0, 0))
+            totals[func] = (count + 1, total + wall_time, max(longest, wall_time))
+
+        return ", ".join("%s (x%s): %.3fs mean, %.3fs max"%(func, count,
+                                                           total / count, longest)
+                         for func, (count, total, longest) in totals.items())
+
+    def close(self):
+        """
+            Close every session, leaving the pool ready to open new ones.
+            Sessions making a request are closed when it is done, and
+            return their place in the pool then.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        self._generation = self._generation + 1
+
+        num_idle = 0
+        while True:
+            try:
+                session = self._sessions.get_nowait()
+            except Queue.Empty:
+                break
+            num_idle = num_idle + 1
+            if session is not None:
+                session.close()
+        for i in range(num_idle):
+            self._sessions.put(None)
+
+def connect(url=None, session_id=None, max_connections=MAX_CONNECTIONS):
+    """
+        Log in to the server, or use an existing session, and return a
+        ConnectionPool making requests with it.
+    """
+    connection = JsonConnection(url)
+    write_output("Connecting...")
+    if session_id is not None:
+        write_output("Using existing session %s"% session_id)
+        connection.session_id=session_id
+    else:
+        connection.login()
+    return ConnectionPool(connection, max_connections)
 
 class NetworkImporter(object):
     """
        Exporter of Hydra networks to JSON or XML files.
     """
 
-    def __init__(self, url=None, session_id=None):
+    def __init__(self, url=None, session_id=None, batch_size=None, num_workers=4,
+                 stream=False, cache=None, connection=None):
 
         #Record the names of the files created by the plugin so we can
         #display them to the user.
@@ -68,15 +783,21 @@ class NetworkImporter(object):
         #easier 
         self.attr_id_map = {}
 
-        self.connection = JsonConnection(url)
-        write_output("Connecting...")
-        if session_id is not None:
-            write_output("Using existing session %s"% session_id)
-            self.connection.session_id=session_id
-        else:
-            self.connection.login()
+        #The time and memory used by each phase of the import.
+        self.instrumentation = Instrumentation()
+
+        #An existing connection can be passed in, such as the daemon's.
+        if connection is None:
+            with self.instrumentation.phase('Connect'):
+                connection = connect(url, session_id, num_workers)
+        self.connection = connection
 
-        #Dictionaries, keyed on their name, where all the nodes, links & groups will go
+        #Where this run's requests start in the connection's latencies, as
+        #the daemon's connection is shared by all its runs.
+        self.first_request = len(getattr(connection, 'latencies', []))
+
+        #Dictionaries, keyed on their name, where all the nodes, links &
+        #groups are built before they are sent.
         self.hydra_nodes = {}
         self.hydra_links = {}
         self.hydra_groups = {}
@@ -88,10 +809,44 @@ class NetworkImporter(object):
         self.node_ids  = temp_ids()
         self.link_ids  = temp_ids()
         self.group_ids = temp_ids() # A group is an institution.
+
+        #The ResourceTables of the nodes, links and groups, holding their
+        #IDs once saved. Built from the prototype by build_tables.
+        self.node_table  = None
+        self.link_table  = None
+        self.group_table = None
     
         #A mapping from the name of a type to the type itself.
         self.type_name_map = {}
 
+        #The project being retrieved in the background by prepare.
+        self._pending_project = None
+
+        #If a batch size is set, the network is uploaded in pieces, using
+        #num_workers concurrent requests, rather than in one add_network call.
+        self.batch_size  = batch_size
+        self.num_workers = num_workers
+
+        #If set, the add_network and add_scenario requests are written
+        #out a piece at a time rather than being built in memory.
+        self.stream = stream
+
+        #A PluginCache for the attributes and template, or None to always
+        #fetch them from the server.
+        self.cache = cache
+
+        #The simulations built from the workbook, each of which is imported
+        #as a scenario of the network built from the first one.
+        self._simulations = None
+        self._network     = None
+
+        #The scenarios saved on the server, in the order of the simulations.
+        self.scenarios = []
+
+        #An ImportJournal recording what has been saved, so a failed import
+        #can be resumed, or None.
+        self.journal = None
+
         self.num_steps = 3
 
     def fetch_project(self, project_id):
@@ -105,7 +860,7 @@ class NetworkImporter(object):
         """
         if project_id is not None:
             try:
-                project = self.connection.call('get_project', {'project_id':project_id})
+                project = self.call('get_project', {'project_id':project_id})
                 log.info('Loading existing project (ID=%s)' % project_id)
                 return project
             except RequestError, e:
@@ -120,18 +875,110 @@ class NetworkImporter(object):
                 (self.__class__.__name__),
         )
 
-        saved_project = self.connection.call('add_project', {'project':new_project})
-        
+        saved_project = self.call('add_project', {'project':new_project})
+
+        if self.journal is not None:
+            self.journal.record('project', id=saved_project.id)
+
         return saved_project 
 
 
+    def get_project(self, project_id):
+        """
+            Return the target project, waiting for it if prepare has already
+            started retrieving it.
+        """
+        if self._pending_project is not None:
+            return self._pending_project.get()
+        return self.fetch_project(project_id)
+
+    def call(self, func, args, stream=False):
+        """
+            Make a request to the server, recording how long it took.
+            If stream is set, the request is sent using stream_call.
+        """
+        with self.instrumentation.phase("Call %s"%func):
+            if stream is True:
+                return stream_call(self.connection, func, args)
+            return self.connection.call(func, args)
+
+    def timed(self, phase, func, *args):
+        """
+            Call func, recording how long it took in self.instrumentation.
+        """
+        with self.instrumentation.phase(phase):
+            return func(*args)
+
+    def prepare(self, template_id, project_id=None, fetch_project=True,
+                preloaded_simulations=None):
+        """
+            Parse the workbook while the template and, for an existing
+            project, the project are retrieved from the server in the
+            background. Returns once the network and the template are both
+            ready, so the nodes can be built. A new project is only
+            created once both are ready, so a bad template or workbook
+            does not leave an empty project behind; it is then created in
+            the background, while the nodes are built. The project is
+            waited for only when the network is about to be sent.
+        """
+        pool = ThreadPool(2)
+        try:
+            template = pool.apply_async(self.timed, ('Retrieve template',
+                                                     self.get_template,
+                                                     template_id))
+            if fetch_project is True and project_id is not None:
+                self._pending_project = pool.apply_async(self.timed,
+                                                         ('Retrieve project',
+                                                          self.fetch_project,
+                                                          project_id))
+
+            if preloaded_simulations is not None:
+                self._simulations = preloaded_simulations
+                self._network     = preloaded_simulations[0].network
+            else:
+                self.timed('Parse workbook', self.get__network)
+            self.check_simulations()
+
+            template.get()
+
+            if fetch_project is True and project_id is None:
+                self._pending_project = pool.apply_async(self.timed,
+                                                         ('Create project',
+                                                          self.fetch_project,
+                                                          None))
+        finally:
+            #Lets the project request finish in the background.
+            pool.close()
+
+    def write_timings(self, target_dir):
+        """
+            Write the time and memory used by each phase to timings.json,
+            so it is returned with the plugin's other files.
+        """
+        write_output("Timings: %s"%self.instrumentation.summary())
+        if isinstance(self.connection, ConnectionPool):
+            write_output("Requests: %s"%self.connection.latency_summary(self.first_request))
+        file_name = os.path.join(target_dir, "timings.json")
+        self.instrumentation.write(file_name)
+        self.files.append(file_name)
+
     def get_attributes(self, template_id):
-        if template_id is not None:
-            #TODO replace this with get_all_template_attributes when the function
-            #is available (not sure why it's not)
-            attributes = self.connection.call('get_all_attributes', {})
-        else:
-            attributes = self.connection.call('get_all_attributes', {})
+        cache_key = (self.connection.url, 'attributes', template_id)
+        attributes = None
+        if self.cache is not None:
+            attributes = self.cache.get(cache_key)
+
+        if attributes is None:
+            if template_id is not None:
+                #TODO replace this with get_all_template_attributes when the function
+                #is available (not sure why it's not)
+                attributes = self.call('get_all_attributes', {})
+            else:
+                attributes = self.call('get_all_attributes', {})
+
+            #The list is cached as the server sent it, rather than the map.
+            if self.cache is not None:
+                self.cache.set(cache_key, attributes)
         
         attr_id_map = {}
         for a in attributes:
@@ -139,157 +986,709 @@ class NetworkImporter(object):
         self.attr_id_map = attr_id_map
 
     def get_template(self, template_id):
-        if template_id is not None:
-            template = self.connection.call('get_template', {'template_id':int(template_id)})
-        else:
+        if template_id is None:
             raise HydraPluginError("No template specified!")
+
+        cache_key = (self.connection.url, 'template', int(template_id))
+        template = None
+        if self.cache is not None:
+            template = self.cache.get(cache_key)
+
+        if template is None:
+            template = self.call('get_template', {'template_id':int(template_id)})
+
+            #The template is cached as the server sent it, rather than the map.
+            if self.cache is not None:
+                self.cache.set(cache_key, template)
         
         for t_type in template.types:
             self.type_name_map[t_type.name] = t_type
 
     def get__network(self):
 
-        # create list of simulations with timestep information based upon information input
-        # to models_input.xlsx (sheet: simulation)
-        simulations = simulation_setup.create_simulations()  # list of simulation objects
+        simulations = None
 
-        # for each simulation, load the network from models_input.xlsx (sheet: network)
-        simulation_setup.load_network(simulations)
+        #Parsing the workbook is slow, so use a snapshot of the
+        #simulations from a previous run if the workbook hasn't changed.
+        snapshot = None
+        workbook = find_workbook(simulation_setup)
+        if self.cache is not None and workbook is not None:
+            snapshot = SimulationSnapshot(workbook,
+                                          'import',
+                                          self.cache.cache_dir,
+                                          refresh=self.cache.refresh)
+            simulations = snapshot.load()
 
-        # load institutions for each simulation
-        simulation_setup.load_institutions(simulations)
+        if simulations is None:
+            # create list of simulations with timestep information based upon information input
+            # to models_input.xlsx (sheet: simulation)
+            simulations = simulation_setup.create_simulations()  # list of simulation objects
 
+            # for each simulation, load the network from models_input.xlsx (sheet: network)
+            simulation_setup.load_network(simulations)
 
-        self._network = simulations[0].network
+            # load institutions for each simulation
+            simulation_setup.load_institutions(simulations)
 
-    def import_network(self, template_id, project_id):
-        write_output("Writing network to file")
-        write_progress(3, self.num_steps)
+            if snapshot is not None:
+                snapshot.save(simulations)
+
+        #The simulations share their topology, so the network is built
+        #from the first one and each simulation becomes a scenario.
+        self._simulations = simulations
+        self._network     = simulations[0].network
+
+    def check_simulations(self):
+        """
+            Check that every simulation has the nodes, links and
+            institutions of the first, as the network is built from the
+            first and each simulation's group items refer to its resources.
+        """
+        if self._simulations is None:
+            return
+
+        def resource_names(network):
+            return (('node', set(n.name for n in network.nodes)),
+                    ('link', set(l.name for l in network.links)),
+                    ('institution', set(i.name for i in network.institutions)))
+
+        first = self._simulations[0]
+        first_name = getattr(first, 'name', None) or 1
+        first_names = resource_names(first.network)
+        for i, simulation in enumerate(self._simulations[1:]):
+            name = getattr(simulation, 'name', None) or i + 2
+            names = resource_names(simulation.network)
+            for (resource, expected), (resource, found) in zip(first_names, names):
+                extra   = sorted(found - expected)
+                missing = sorted(expected - found)
+                if len(extra) > 0:
+                    difference = "has %s %s, which simulation %s does not"%(
+                                                resource, extra[0], first_name)
+                elif len(missing) > 0:
+                    difference = "has no %s %s, which simulation %s has"%(
+                                                resource, missing[0], first_name)
+                else:
+                    continue
+                raise HydraPluginError("Simulation %s %s. Every simulation must "
+                                       "have the same network."%(name, difference))
 
-        for j_node in self._network.nodes:
+    def iter_simulations(self):
+        """
+            Generate a (scenario name, network, simulation) tuple for each
+            simulation to be imported as a scenario. A single simulation
+            becomes the "Baseline" scenario, as before. If only the network
+            has been set, it is imported as the "Baseline" scenario on its own.
+        """
+        if self._simulations is None:
+            yield "Baseline", self._network, None
+            return
+
+        if len(self._simulations) == 1:
+            yield "Baseline", self._simulations[0].network, self._simulations[0]
+            return
+
+        #Scenario names must be unique within a network.
+        names = set()
+        for i, simulation in enumerate(self._simulations):
+            name = getattr(simulation, 'name', None) or "Simulation %s"%(i + 1)
+            if name in names:
+                name = "%s (%s)"%(name, i + 1)
+            names.add(name)
+            yield name, simulation.network, simulation
+
+    def build_tables(self):
+        """
+            Build the ResourceTables of the nodes, links and groups from the
+            prototype network. The nodes' coordinates are adjusted for the
+            projection and stored as the strings they are sent as, and the
+            links' nodes are stored as rows of the node table.
+        """
+        j_nodes = self._network.nodes
+        j_links = self._network.links
+        j_insts = self._network.institutions
+
+        self.node_table = ResourceTable([n.name for n in j_nodes],
+                                        [self.node_ids.next() for n in j_nodes],
+                                        x = [str(n.x) for n in j_nodes],
+                                        y = [str(adjust_y(n.y)) for n in j_nodes])
+
+        self.link_table = ResourceTable([l.name for l in j_links],
+                                        [self.link_ids.next() for l in j_links],
+                                        node_1 = self.node_table.rows([l.start_node.name
+                                                                       for l in j_links]),
+                                        node_2 = self.node_table.rows([l.end_node.name
+                                                                       for l in j_links]))
+
+        self.group_table = ResourceTable([i.name for i in j_insts],
+                                         [self.group_ids.next() for i in j_insts])
+
+    def iter_nodes(self, template_id):
+        """
+            Generate the hydra nodes, one at a time, from the prototype
+            network and the node table.
+        """
+        temp_ids = self.node_table.temp_ids.tolist()
+        xs       = self.node_table.columns['x']
+        ys       = self.node_table.columns['y']
+        for row, j_node in enumerate(self._network.nodes):
             
             log.info("Node: %s", j_node.component_type)
             node_type = self.type_name_map.get(j_node.component_type)
 
-            y = j_node.y
-            if y > 800000:
-                y = y - 1000000
-            elif y > 400000:
-                y = y - 400000
-
-            node = dict(
-                id = self.node_ids.next(),
+            yield dict(
+                id = temp_ids[row],
                 name = j_node.name,
                 description = " Node",
-                x    = str(j_node.x),
-                y    = str(y),
+                x    = xs[row],
+                y    = ys[row],
                 attributes = [],
                 types = [{'template_id':int(template_id), 'id':int(node_type.id)}]
             )
-            self.hydra_nodes[j_node.name] = node
 
-        for j_link in self._network.links:
+    def iter_links(self, template_id):
+        """
+            Generate the hydra links, one at a time. Each refers to its
+            nodes by their saved IDs, if they have been saved, or by their
+            temporary IDs otherwise.
+        """
+        temp_ids  = self.link_table.temp_ids.tolist()
+        node_1_ids = self.node_table.ref_ids(self.link_table.columns['node_1'])
+        node_2_ids = self.node_table.ref_ids(self.link_table.columns['node_2'])
+        for row, j_link in enumerate(self._network.links):
             link_type = self.type_name_map.get(j_link.component_type)
             log.info("Link: %s", j_link.component_type)
-            link = dict(
-                id = self.link_ids.next(),
+            yield dict(
+                id = temp_ids[row],
                 name = j_link.name,
                 description = " Link",
-                node_1_id = self.hydra_nodes[j_link.start_node.name]['id'],
-                node_2_id = self.hydra_nodes[j_link.end_node.name]['id'],
+                node_1_id = node_1_ids[row],
+                node_2_id = node_2_ids[row],
                 attributes = [],
                 types = [{'template_id':int(template_id), 'id':link_type.id}]
             )
-            self.hydra_links[j_link.name] = link
 
-
-        for j_inst in self._network.institutions:
+    def iter_groups(self, template_id):
+        """
+            Generate the hydra resource groups (institutions), one at a time.
+        """
+        temp_ids = self.group_table.temp_ids.tolist()
+        for row, j_inst in enumerate(self._network.institutions):
             group_type = self.type_name_map.get(j_inst.component_type)
             log.info("Group: %s", j_inst.component_type)
-            group = dict(
-                id = self.group_ids.next(),
+            yield dict(
+                id = temp_ids[row],
                 name = j_inst.name,
                 description = "A  Model Institution",
                 attributes = [],
                 types = [{'template_id':int(template_id), 'id':group_type.id}]
             )
-            self.hydra_groups[j_inst.name] = group
 
-        project = self.fetch_project(project_id)
-        project_id = project.id
+    def journal_signature(self):
+        """
+            A hash of the names of the resources and scenarios to be
+            imported, so an import is only resumed from the same workbook.
+        """
+        names = [
+            sorted(n.name for n in self._network.nodes),
+            sorted(l.name for l in self._network.links),
+            sorted(i.name for i in self._network.institutions),
+            [name for name, network, simulation in self.iter_simulations()],
+        ]
+        return hashlib.sha1(json.dumps(names)).hexdigest()
+
+    def check_journal(self):
+        """
+            Start recording the import in the journal or, if it is being
+            resumed, check the journal is of the same network.
+        """
+        signature = self.journal_signature()
+        start = self.journal.get('start')
+        if start is None:
+            self.journal.record('start', signature=signature)
+        elif start['signature'] != signature:
+            raise HydraPluginError("The workbook has changed since the import being "
+                                   "resumed. Import it again without --resume, "
+                                   "or update the network it created instead.")
+        else:
+            write_output("Resuming import")
+
+    def import_network(self, template_id, project_id):
+        write_output("Writing network to file")
+        write_progress(3, self.num_steps)
+
+        saved_network = None
+        if self.journal is not None:
+            self.check_journal()
+            saved_network = self.journal.get('network')
+
+        self.build_tables()
 
         network_type = self.type_name_map.get('Network')
 
         hydra_network = {
             'name' : " Network (%s)"%datetime.now(),
             'description' : " Network, imported directly from the prototype",
-            'nodes': self.hydra_nodes.values(),
-            'links': self.hydra_links.values(),
-            'project_id' : project_id,
             'projection':'EPSG:2229',
-            'resourcegroups': self.hydra_groups.values(),
             'scenarios': [],
             'types' : [{'template_id':int(template_id), 'id':network_type.id}],
         }
 
-        self.network = self.connection.call('add_network', {'net':hydra_network})
+        if self.stream is True and not self.batch_size and saved_network is None:
+            #The nodes must be generated before the links, so build them
+            #into an ordered request.
+            hydra_network['project_id'] = self.get_project(project_id).id
+            net = OrderedDict(sorted(hydra_network.items()))
+            net['nodes']          = self.iter_nodes(template_id)
+            net['links']          = self.iter_links(template_id)
+            net['resourcegroups'] = self.iter_groups(template_id)
+            self.network = self.call('add_network', {'net':net}, stream=True)
+            self._index_network()
+            self._journal_network()
+            return self.network
+
+        with self.instrumentation.phase('Build network'):
+            for node in self.iter_nodes(template_id):
+                self.hydra_nodes[node['name']] = node
+            for link in self.iter_links(template_id):
+                self.hydra_links[link['name']] = link
+            for group in self.iter_groups(template_id):
+                self.hydra_groups[group['name']] = group
+
+        hydra_network['nodes']          = self.hydra_nodes.values()
+        hydra_network['links']          = self.hydra_links.values()
+        hydra_network['resourcegroups'] = self.hydra_groups.values()
+
+        #The project may still be being retrieved in the background.
+        hydra_network['project_id'] = self.get_project(project_id).id
+
+        if saved_network is not None:
+            #Only send what was not saved before the import failed.
+            self.network = JSONObj(dict(hydra_network,
+                                        id=saved_network['id'],
+                                        nodes=[], links=[], resourcegroups=[]))
+            self.upload_resources()
+        elif self.batch_size:
+            self.upload_network(hydra_network)
+        else:
+            self.network = self.call('add_network', {'net':hydra_network})
+            self._index_network()
+            self._journal_network()
+
+        #The saved IDs are in the tables, so the requests are no longer needed.
+        self.hydra_nodes.clear()
+        self.hydra_links.clear()
+        self.hydra_groups.clear()
+
         return self.network
 
+    def _journal_network(self):
+        if self.journal is None:
+            return
+        self.journal.record('network', id=self.network.id)
+        self.journal.record('nodes', ids=[[n.name, n.id] for n in self.network.nodes])
+        self.journal.record('links', ids=[[l.name, l.id] for l in self.network.links])
+        self.journal.record('groups', ids=[[g.name, g.id] for g in self.network.resourcegroups])
 
-    def import_scenario(self):
-        
+    def _index_network(self):
+        """
+            Record the IDs of the nodes, links and groups of the saved
+            network in their tables, so the scenarios can refer to them.
+        """
         for n in self.network.nodes:
-            self.hydra_nodes[n.name] = n
+            self.node_table.set_id(n.name, n.id)
         for l in self.network.links:
-            self.hydra_links[l.name] = l
+            self.link_table.set_id(l.name, l.id)
         for g in self.network.resourcegroups:
-            self.hydra_groups[g.name] = g
-
-        hydra_group_members = []
-        for j_inst in self._network.institutions:
-            group_id = self.hydra_groups[j_inst.name].id
-
-            for n in j_inst.nodes:
-                hydra_group_members.append(
-                {
-                    'ref_key':'NODE',
-                    'ref_id' : self.hydra_nodes[n.name]['id'],
-                    'group_id' : group_id, 
-                }
-                )
-
-            for l in j_inst.links:
-                hydra_group_members.append(
-                {
-                    'ref_key':'LINK',
-                    'ref_id' : self.hydra_links[l.name]['id'],
-                    'group_id' : group_id, 
-                }
-                )
-            for i in j_inst.institutions:
-                hydra_group_members.append(
-                {
-                    'ref_key':'GROUP',
-                    'ref_id' : self.hydra_groups[i.name]['id'],
-                    'group_id' : group_id, 
-                }
-                )
+            self.group_table.set_id(g.name, g.id)
+
+    def _batches(self, items):
+        """
+            Split a list of resources into lists of at most self.batch_size.
+        """
+        if not self.batch_size:
+            return [items]
+        size = int(self.batch_size)
+        return [items[i:i+size] for i in range(0, len(items), size)]
+
+    def upload_network(self, hydra_network):
+        """
+            Upload the network in pieces rather than in a single add_network
+            call. The network is first created without any nodes, links or
+            groups. These are then sent in batches, using several concurrent
+            requests.
+
+            Links refer to their nodes using temporary IDs, so the nodes
+            must be saved before the links, and the temporary IDs swapped for
+            the ones assigned by the server.
+        """
+        shell = dict(hydra_network, nodes=[], links=[], resourcegroups=[])
+        self.network = self.call('add_network', {'net':shell})
+        if self.journal is not None:
+            self.journal.record('network', id=self.network.id)
+
+        self.upload_resources()
+        return self.network
+
+    def upload_resources(self):
+        """
+            Send the nodes, links and groups to self.network in batches.
+        """
+        pool = ThreadPool(self.num_workers)
+        try:
+            self._upload(pool, self._add_nodes, self.hydra_nodes, self.node_table, 'nodes')
+
+            #The links can now refer to the saved nodes.
+            node_1_ids = self.node_table.get_ids(self.link_table.columns['node_1'])
+            node_2_ids = self.node_table.get_ids(self.link_table.columns['node_2'])
+            for name, link in self.hydra_links.items():
+                row = self.link_table.index[name]
+                link['node_1_id'] = node_1_ids[row]
+                link['node_2_id'] = node_2_ids[row]
+
+            self._upload(pool, self._add_links, self.hydra_links, self.link_table, 'links')
+            self._upload(pool, self._add_groups, self.hydra_groups, self.group_table, 'groups')
+        finally:
+            pool.close()
+            pool.join()
+
+    def _journal_saved(self, stage, saved):
+        if self.journal is not None:
+            self.journal.record(stage, ids=[[r.name, r.id] for r in saved])
+        return saved
+
+    def _add_nodes(self, nodes):
+        return self._journal_saved('nodes',
+                                   self.call('add_nodes', {'network_id':self.network.id,
+                                                           'nodes':nodes}))
+
+    def _add_links(self, links):
+        return self._journal_saved('links',
+                                   self.call('add_links', {'network_id':self.network.id,
+                                                           'links':links}))
+
+    def _add_groups(self, groups):
+        #Each group is saved by its own request, so is journalled as it is saved.
+        return [self._journal_saved('groups',
+                                    [self.call('add_group', {'network_id':self.network.id,
+                                                             'group':g})])[0]
+                for g in groups]
+
+    def _upload(self, pool, add_func, resources, table, resource_name):
+        """
+            Send the resources to the server in batches, recording the ID
+            the server gives each in its ResourceTable. Resources already
+            recorded in the journal are not sent again.
+        """
+        num_resources = len(resources)
+        num_saved     = 0
+        if num_resources == 0:
+            return
+
+        unsaved = resources.values()
+        if self.journal is not None:
+            saved_ids = self.journal.saved_ids(resource_name)
+            unsaved = [r for r in unsaved if r['name'] not in saved_ids]
+            for name, saved_id in saved_ids.items():
+                if name in resources:
+                    table.set_id(name, saved_id)
+                    num_saved = num_saved + 1
+            if num_saved > 0:
+                write_output("%s of %s %s already uploaded"%(num_saved, num_resources,
+                                                           resource_name))
+        if len(unsaved) == 0:
+            return
+
+        for saved in pool.imap_unordered(add_func, self._batches(unsaved)):
+            for r in saved:
+                table.set_id(r.name, r.id)
+            num_saved = num_saved + len(saved)
+            write_output("Uploaded %s of %s %s"%(num_saved, num_resources, resource_name))
+
+    def _changed(self, old, new, fields):
+        """
+            Check whether a saved resource differs from the one generated
+            from the prototype, in the given fields or in its types.
+        """
+        for field in fields:
+            old_value = old.get(field)
+            new_value = new[field]
+            try:
+                if float(old_value) != float(new_value):
+                    return True
+            except (TypeError, ValueError):
+                if old_value != new_value:
+                    return True
+
+        old_type_ids = set(t.id for t in old.get('types') or [])
+        new_type_ids = set(t['id'] for t in new['types'])
+        return not new_type_ids.issubset(old_type_ids)
+
+    def _sync(self, pool, old_resources, new_resources, table, resource_name,
+              add_func, update_func, fields=()):
+        """
+            Add the resources in new_resources which are not in
+            old_resources and update those which have changed, recording
+            the saved ID of each in its ResourceTable. Both are
+            dictionaries keyed on name.
+
+            Returns the IDs of the resources which are no longer in the
+            prototype, for deleting once nothing refers to them.
+        """
+        added   = {}
+        changed = []
+        for name, new in new_resources.items():
+            old = old_resources.get(name)
+            if old is None:
+                added[name] = new
+            elif self._changed(old, new, fields):
+                new['id'] = old.id
+                changed.append(new)
+            else:
+                table.set_id(name, old.id)
+
+        self._upload(pool, add_func, added, table, resource_name)
+
+        for saved in pool.imap_unordered(update_func, changed):
+            table.set_id(saved.name, saved.id)
+
+        removed = [r.id for name, r in old_resources.items() if name not in new_resources]
+
+        write_output("%s %s added, %s changed and %s removed"%(
+            len(added), resource_name, len(changed), len(removed)))
+
+        return removed
+
+    def update_network(self, template_id, network_id):
+        """
+            Bring an existing network into line with the prototype rather
+            than importing a new one. Nodes, links and groups are matched by
+            name, and only those which have been added, removed or changed
+            are sent to the server. The group memberships in the scenario of
+            each simulation, matched by name, are then updated in the same
+            way, and scenarios are added for any new simulations. Other
+            scenarios lose only the memberships of removed resources.
+        """
+        write_output("Retrieving network %s"%network_id)
+        self.network = self.call('get_network',
+                                            {'network_id':int(network_id),
+                                             'include_data':'N'})
+
+        old_nodes  = dict((n.name, n) for n in self.network.nodes)
+        old_links  = dict((l.name, l) for l in self.network.links)
+        old_groups = dict((g.name, g) for g in self.network.resourcegroups)
+
+        self.build_tables()
+        new_nodes  = dict((n['name'], n) for n in self.iter_nodes(template_id))
+        new_groups = dict((g['name'], g) for g in self.iter_groups(template_id))
+
+        update_node  = lambda node: self.call('update_node', {'node':node})
+        update_link  = lambda link: self.call('update_link', {'link':link})
+        update_group = lambda group: self.call('update_group', {'group':group})
+
+        pool = ThreadPool(self.num_workers)
+        try:
+            removed_nodes = self._sync(pool, old_nodes, new_nodes, self.node_table,
+                                       'nodes', self._add_nodes, update_node,
+                                       fields=('x', 'y'))
+
+            #The nodes are all saved, so the links can refer to them.
+            new_links = dict((l['name'], l) for l in self.iter_links(template_id))
 
+            removed_links = self._sync(pool, old_links, new_links, self.link_table,
+                                       'links', self._add_links, update_link,
+                                       fields=('node_1_id', 'node_2_id'))
+            removed_groups = self._sync(pool, old_groups, new_groups, self.group_table,
+                                        'groups', self._add_groups, update_group)
+
+            scenarios = self.network.get('scenarios') or []
+            scenario_names = dict((s.name, s) for s in scenarios)
+            updated = []
+            missing = []
+            for name, network, simulation in self.iter_simulations():
+                scenario = scenario_names.get(name)
+                if scenario is None and name == "Baseline" and len(scenarios) > 0:
+                    scenario = scenarios[0]
+                if scenario is None:
+                    missing.append((name, network, simulation))
+                else:
+                    self.update_group_items(scenario, network)
+                    updated.append(scenario)
+
+            #The scenarios of no simulation keep their group items, but
+            #lose those of the resources about to be removed.
+            removed = dict(NODE=set(removed_nodes), LINK=set(removed_links),
+                           GROUP=set(removed_groups))
+            updated_ids = set(s.id for s in updated)
+            for scenario in scenarios:
+                if scenario.id not in updated_ids:
+                    self.remove_group_items(scenario, removed)
+
+            added = []
+            if len(missing) > 0:
+                added = self.import_scenarios(missing)
+            self.scenarios = updated + added
+            self.scenario  = self.scenarios[0]
+
+            #Group items referring to removed resources have gone, so
+            #the resources themselves can now be removed.
+            pool.map(lambda link_id: self.call('delete_link', {'link_id':link_id}),
+                     removed_links)
+            pool.map(lambda node_id: self.call('delete_node', {'node_id':node_id}),
+                     removed_nodes)
+            pool.map(lambda group_id: self.call('delete_group', {'group_id':group_id}),
+                     removed_groups)
+        finally:
+            pool.close()
+            pool.join()
+
+        return self.network
+
+    def update_group_items(self, scenario, network):
+        """
+            Add and remove group memberships in the scenario so that they
+            match the institutions in the simulation's network.
+        """
+        old_items = {}
+        for item in scenario.get('resourcegroupitems') or []:
+            old_items[(item.ref_key, item.ref_id, item.group_id)] = item.id
+
+        new_items = set()
+        for item in self.iter_group_items(network):
+            new_items.add((item['ref_key'], item['ref_id'], item['group_id']))
+
+        added = [dict(ref_key=ref_key, ref_id=ref_id, group_id=group_id)
+                 for ref_key, ref_id, group_id in new_items
+                 if (ref_key, ref_id, group_id) not in old_items]
+        removed = [item_id for key, item_id in old_items.items() if key not in new_items]
+
+        if len(removed) > 0:
+            self.call('delete_resourcegroupitems',
+                                 {'scenario_id':scenario.id, 'item_ids':removed})
+        if len(added) > 0:
+            self.call('add_resourcegroupitems',
+                                 {'scenario_id':scenario.id, 'items':added})
+
+        write_output("%s: %s group items added and %s removed"%(scenario.name,
+                                                                len(added),
+                                                                len(removed)))
+
+
+    def remove_group_items(self, scenario, removed):
+        """
+            Remove the group memberships in the scenario of the resources
+            which are about to be removed: removed is a set of resource
+            IDs for each ref_key.
+        """
+        item_ids = [item.id for item in scenario.get('resourcegroupitems') or []
+                    if item.ref_id in removed[item.ref_key]
+                    or item.group_id in removed['GROUP']]
+
+        if len(item_ids) > 0:
+            self.call('delete_resourcegroupitems',
+                                 {'scenario_id':scenario.id, 'item_ids':item_ids})
+
+        write_output("%s: %s group items removed"%(scenario.name, len(item_ids)))
+
+    def iter_group_items(self, network=None):
+        """
+            Generate the group membership items for a simulation's network,
+            one at a time, using the IDs of the saved network. The members
+            of all the groups are looked up in the ResourceTables at once,
+            one lookup for each table. Defaults to the network of the first
+            simulation.
+        """
+        if network is None:
+            network = self._network
+
+        tables  = (('NODE', self.node_table), ('LINK', self.link_table), ('GROUP', self.group_table))
+        names   = dict((ref_key, []) for ref_key, table in tables)
+        members = []
+        for j_inst in network.institutions:
+            inst_members = (('NODE', j_inst.nodes), ('LINK', j_inst.links), ('GROUP', j_inst.institutions))
+            for ref_key, resources in inst_members:
+                names[ref_key].extend(r.name for r in resources)
+            members.append([(ref_key, len(resources)) for ref_key, resources in inst_members])
+
+        ids = dict((ref_key, table.get_ids(table.rows(names[ref_key])))
+                   for ref_key, table in tables)
+        group_ids = self.group_table.get_ids(
+            self.group_table.rows([i.name for i in network.institutions]))
+
+        offsets = dict((ref_key, 0) for ref_key, table in tables)
+        for group_id, inst_members in zip(group_ids, members):
+            for ref_key, num_members in inst_members:
+                start = offsets[ref_key]
+                offsets[ref_key] = start + num_members
+                for ref_id in ids[ref_key][start:start + num_members]:
+                    yield {
+                        'ref_key':ref_key,
+                        'ref_id' : ref_id,
+                        'group_id' : group_id, 
+                    }
+
+    def import_scenarios(self, simulations=None):
+        """
+            Create a scenario for each simulation, holding its group
+            memberships. Each scenario is built and sent in a request of
+            its own, num_workers at a time.
+
+            Returns the saved scenarios, in the order of the simulations.
+            Scenarios recorded in the journal are not sent again.
+        """
+        if simulations is None:
+            simulations = list(self.iter_simulations())
+
+        scenarios = OrderedDict((name, None) for name, network, simulation in simulations)
+        if self.journal is not None:
+            for name, scenario_id in self.journal.saved_ids('scenarios').items():
+                if name in scenarios:
+                    scenarios[name] = JSONObj({'id':scenario_id, 'name':name})
+        unsaved = [s for s in simulations if scenarios[s[0]] is None]
+        num_saved = len(simulations) - len(unsaved)
+
+        pool = ThreadPool(self.num_workers)
+        try:
+            for saved in pool.imap(self._add_scenario, unsaved):
+                scenarios[saved.name] = saved
+                num_saved = num_saved + 1
+                write_output("Uploaded %s of %s scenarios"%(num_saved, len(simulations)))
+        finally:
+            pool.close()
+            pool.join()
+
+        self.scenarios = scenarios.values()
+        self.scenario = self.scenarios[0]
+
+        write_output("Finished Writing Output.")
+
+        return self.scenarios
+
+    def _add_scenario(self, item):
+        """
+            Build and send the scenario of one of the items given by
+            iter_simulations.
+        """
+        name, network, simulation = item
         scenario = dict(
-            name = "Baseline",
+            name = name,
             description = "Scenario imported from the import app",
             network_id = self.network.id,
-            resourcegroupitems = hydra_group_members,
             resourcescenarios  = []
         )
 
-        write_output("Finished Writing Output.")
-
-        self.scenario = self.connection.call('add_scenario', {
-            'network_id': self.network.id,
-            'scen':scenario})
+        if self.stream is True:
+            scenario['resourcegroupitems'] = self.iter_group_items(network)
+            saved = self.call('add_scenario', {
+                'network_id': self.network.id,
+                'scen':scenario}, stream=True)
+        else:
+            with self.instrumentation.phase('Build scenario'):
+                scenario['resourcegroupitems'] = list(self.iter_group_items(network))
+            saved = self.call('add_scenario', {
+                'network_id': self.network.id,
+                'scen':scenario})
 
-        return self.scenario
+        return self._journal_saved('scenarios', [saved])[0]
 
 
 def commandline_parser():
@@ -302,37 +1701,131 @@ def commandline_parser():
                         help='''The ID of the  Template''')
     parser.add_argument('-p', '--project-id',
                         help='''The ID of the target project''')
+    parser.add_argument('-n', '--network-id',
+                        help='''The ID of an existing network to update
+                        instead of importing a new one.''')
     parser.add_argument('-u', '--server-url',
                         help='''Specify the URL of the server to which this
                         plug-in connects.''')
     parser.add_argument('-c', '--session-id',
                         help='''Session ID. If this does not exist, a login will be
                         attempted based on details in config.''')
+    parser.add_argument('-b', '--batch-size', type=int,
+                        help='''Upload the nodes, links and groups in batches
+                        of this size instead of in a single request. This is
+                        what keeps the memory used by large imports down.''')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='''The number of concurrent requests used when
+                        uploading in batches.''')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='''Write the network and scenario requests a
+                        piece at a time instead of building them in memory.
+                        The server's response still holds the whole network,
+                        so this saves less memory than --batch-size.''')
+    parser.add_argument('-r', '--refresh-cache', action='store_true',
+                        help='''Ignore the cached attributes, template and
+                        workbook snapshot, rebuild them and update the cache.''')
+    parser.add_argument('-x', '--no-cache', action='store_true',
+                        help='''Do not read or write the local cache of
+                        attributes, templates and workbook snapshots.''')
+    parser.add_argument('-e', '--resume', action='store_true',
+                        help='''Carry on with the last import into the
+                        template and project from where it failed, using
+                        the journal of what it saved, rather than
+                        starting again.''')
+    parser.add_argument('-d', '--daemon', action='store_true',
+                        help='''Stay running, keeping the connection and
+                        the loaded network, and accept imports from later
+                        invocations of the app.''')
+    parser.add_argument('-f', '--profile', action='store_true',
+                        help='''Profile the import with cProfile and return
+                        the statistics in profile.pstats.''')
     return parser
 
 
-if __name__ == '__main__':
-    parser = commandline_parser()
-    args = parser.parse_args()
-    network_importer = NetworkImporter(url=args.server_url, session_id=args.session_id)
+def get_journal(network_importer, args, cache=None):
+    """
+        Return the ImportJournal of an import into the given server,
+        template and project. Journals are kept with the cache or, without
+        one, in the current directory.
+    """
+    if cache is not None:
+        journal_dir = os.path.join(cache.cache_dir, 'journals')
+    else:
+        journal_dir = os.getcwd()
+    key = (network_importer.connection.url, args.template_id, args.project_id)
+    return ImportJournal(journal_dir, key)
+
+def run(args, connection=None, preloaded_simulations=None, validate=True):
+    """
+        Import the network as described by the command line arguments and
+        return the plugin's XML response. The daemon passes in its
+        connection and the simulations it has already loaded.
+    """
+    profiler = None
+    if args.profile is True:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    #The timings and profile are written to the directory the import was
+    #started in, even if parsing the workbook moves elsewhere.
+    target_dir = os.getcwd()
+
+    cache = None
+    if args.no_cache is False:
+        cache = PluginCache(refresh=args.refresh_cache)
+    network_importer = NetworkImporter(url=args.server_url,
+                                       session_id=args.session_id,
+                                       batch_size=args.batch_size,
+                                       num_workers=args.workers,
+                                       stream=args.stream,
+                                       cache=cache,
+                                       connection=connection)
     errors = []
     network_id = None
-    scenario_id = None
+    scenario_ids = []
     try:
         write_output("Starting App")
         write_progress(1, network_importer.num_steps) 
 
-        validate_plugin_xml(os.path.join(__location__, 'plugin.xml'))
-        
-        network_importer.get__network()
+        if validate is True:
+            validate_plugin_xml(os.path.join(__location__, 'plugin.xml'))
+
+        #New imports are journalled, so they can be resumed if they fail.
+        project_id = args.project_id
+        if args.network_id is None:
+            journal = get_journal(network_importer, args, cache)
+            if args.resume is True and journal.load() > 0:
+                saved_project = journal.get('project')
+                if saved_project is not None:
+                    project_id = saved_project['id']
+            else:
+                journal.start()
+            network_importer.journal = journal
         
-        network_importer.get_template(args.template_id)
+        network_importer.prepare(args.template_id,
+                                 project_id,
+                                 fetch_project=args.network_id is None,
+                                 preloaded_simulations=preloaded_simulations)
+
+        if args.network_id is not None:
+            network = network_importer.timed('Update network',
+                                             network_importer.update_network,
+                                             args.template_id,
+                                             args.network_id)
+            network_id = network.id
+        else:
+            network = network_importer.timed('Import network',
+                                             network_importer.import_network,
+                                             args.template_id,
+                                             project_id)
+            network_id = network.id
+
+            network_importer.timed('Import scenarios', network_importer.import_scenarios)
+            network_importer.journal.remove()
 
-        network = network_importer.import_network(args.template_id, args.project_id)
-        network_id = network.id
+        scenario_ids = [s.id for s in network_importer.scenarios]
 
-        scenario = network_importer.import_scenario()
-        scenario_id = scenario.id
 
         message = "Import Complete"
     except HydraPluginError as e:
@@ -344,11 +1837,193 @@ if __name__ == '__main__':
         log.exception(e)
         errors = [e]
 
+    if len(errors) > 0 and network_importer.journal is not None \
+            and len(network_importer.journal.records) > 1:
+        write_output("The import can be carried on from where it failed "
+                     "using --resume.")
+
+    try:
+        network_importer.write_timings(target_dir)
+        if profiler is not None:
+            profiler.disable()
+            file_name = os.path.join(target_dir, "profile.pstats")
+            profiler.dump_stats(file_name)
+            network_importer.files.append(file_name)
+    except IOError, e:
+        log.exception(e)
+
+    #A connection made for this run isn't used again.
+    if connection is None:
+        network_importer.connection.close()
+
     xml_response = create_xml_response('Import  Network',
                                                  network_id,
-                                                 [scenario_id],
+                                                 scenario_ids,
                                                  errors,
                                                  [],
                                                  message,
                                                  network_importer.files)
-    print xml_response
+    return xml_response
+
+def _read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+class ClientOutput(object):
+    """
+        Stands in for sys.stdout while the daemon runs a job, sending
+        everything written straight back to the client, so it sees the
+        progress of the job as it happens. If the client has gone away,
+        the job carries on regardless.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.connected = True
+
+        #Progress is written from another thread during parallel runs.
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        with self.lock:
+            if self.connected is False:
+                return
+            try:
+                self.client.sendall(data)
+            except socket.error, e:
+                log.info("Lost the client: %s", e)
+                self.connected = False
+
+    def flush(self):
+        pass
+
+def send_to_daemon(argv, socket_path=SOCKET_PATH, output=None):
+    """
+        Pass a command line, and the directory it was run in, to the
+        daemon and write everything the daemon prints while running it
+        to output (sys.stdout by default) as it arrives. Returns False,
+        having written nothing, if there is no daemon running.
+    """
+    if output is None:
+        output = sys.stdout
+
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return False
+
+    received = False
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}))
+        client.shutdown(socket.SHUT_WR)
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            output.write(chunk)
+            output.flush()
+            received = True
+    except socket.error, e:
+        log.info("Unable to use daemon at %s: %s", socket_path, e)
+    finally:
+        client.close()
+
+    return received
+
+def serve(args, socket_path=SOCKET_PATH):
+    """
+        Run as a daemon. The connection and the simulations loaded from
+        the workbook are kept between imports, which are sent by
+        send_to_daemon and run one at a time. The simulations are reloaded
+        if the workbook changes.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise HydraPluginError("The daemon needs Unix sockets, which are "
+                               "not available on this platform.")
+
+    validate_plugin_xml(os.path.join(__location__, 'plugin.xml'))
+
+    #Each import runs in the client's directory, and then the daemon
+    #returns here.
+    daemon_dir = os.getcwd()
+
+    cache = None
+    if args.no_cache is False:
+        cache = PluginCache(refresh=args.refresh_cache)
+    network_importer = NetworkImporter(url=args.server_url,
+                                       session_id=args.session_id,
+                                       cache=cache)
+
+    workbook = find_workbook(simulation_setup)
+    def workbook_mtime():
+        if workbook is None:
+            return None
+        return os.path.getmtime(workbook)
+
+    loaded_mtime = workbook_mtime()
+    network_importer.get__network()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    elif not os.path.exists(os.path.dirname(socket_path)):
+        os.makedirs(os.path.dirname(socket_path))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(5)
+    write_output("Listening on %s"%socket_path)
+
+    try:
+        while True:
+            client, address = server.accept()
+            stdout = sys.stdout
+            try:
+                request  = json.loads(_read_all(client))
+                job_args = commandline_parser().parse_args(request['argv'])
+
+                if workbook_mtime() != loaded_mtime:
+                    write_output("Workbook has changed. Reloading.")
+                    loaded_mtime = workbook_mtime()
+                    network_importer.get__network()
+
+                #Imports using the same server share the connection, with
+                #the session they were given.
+                connection = None
+                if job_args.server_url == args.server_url:
+                    connection = network_importer.connection
+                    if job_args.session_id is not None:
+                        connection.session_id = job_args.session_id
+
+                #Relative paths in the command line, and the default
+                #output directory, are the client's.
+                os.chdir(request['cwd'])
+
+                #Send back everything the import prints as it is printed, as
+                #well as the response.
+                sys.stdout = ClientOutput(client)
+                print run(job_args, connection, network_importer._simulations, validate=False)
+            except (Exception, SystemExit), e:
+                log.exception(e)
+            finally:
+                sys.stdout = stdout
+                client.close()
+                os.chdir(daemon_dir)
+    finally:
+        server.close()
+        os.remove(socket_path)
+        network_importer.connection.close()
+
+if __name__ == '__main__':
+    parser = commandline_parser()
+    args = parser.parse_args()
+    if args.daemon is True:
+        serve(args)
+    else:
+        if send_to_daemon(sys.argv[1:]) is False:
+            print run(args)
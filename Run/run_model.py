@@ -8,7 +8,14 @@ Basics
 A Hydra app for running the jordan model
 Basic usage::
 
-       run_jordan_prototype.py [-h] [-n network_id] [-s scenario_id] [-u] [-c] 
+       run_jordan_prototype.py [-h] [-n network_id] [-s scenario_id [scenario_id ...]] [-u] [-c] 
+
+To avoid paying for the start up, login and workbook loading on every run,
+the app can be left running as a daemon with ``--daemon``. Later runs
+pass their command line and directory to the daemon over a local socket,
+which runs them in that directory, and print what it prints as it goes.
+Runs against the daemon's server share its connection, using their own
+session ID. Without a daemon they run in-process.
 
 Options
 ~~~~~~~
@@ -18,45 +25,1760 @@ Option                 Short  Parameter    Description
 ====================== ====== ============ =======================================
 ``--help``             ``-h``              Show help message and exit.
 ``--network-id         ``-n`` NETWORK_ID   The ID of the network to be exported.
-``--scenario-id        ``-s`` SCENARIO_ID  The ID of the scenario to be exported.
-                                           (optional)
+``--scenario-id        ``-s`` SCENARIO_ID  The ID(s) of the scenario(s) to be
+                                           run, separated by spaces or commas.
+                                           Each is run separately, and its
+                                           results saved to it.
 ``--server-url``       ``-u`` SERVER-URL   Url of the server the plugin will
                                            connect to.
                                            Defaults to localhost.
 ``--session-id``       ``-c`` SESSION-ID   Session ID used by the calling software.
                                            If left empty, the plugin will attempt
                                            to log in itself.
+``--refresh-cache``    ``-r``              Ignore the cached attributes,
+                                           workbook snapshot and results,
+                                           rebuild them and update the cache.
+``--no-cache``         ``-x``              Do not read or write the cache.
+``--local-snapshot``   ``-l``              Run from the local snapshot of the
+                                           network and scenario, if there is
+                                           one and the network has not
+                                           changed on the server since,
+                                           rather than fetch them. Otherwise
+                                           fetch them and make the snapshot.
+                                           Needs NumPy.
+``--attribute-map``    ``-a`` ATTR-MAP     A JSON file mapping the attributes
+                                           the model uses, by resource type, to
+                                           the model's inputs. Their data is
+                                           set on the model, and only their
+                                           data is fetched.
+``--workers``          ``-w`` WORKERS      Number of processes used to run the
+                                           simulations. Defaults to 1, which
+                                           runs them one after another.
+``--parameter``        ``-p`` PARAMETER    The model parameter to set, as a path
+                                           from the list of simulations.
+                                           Defaults to the piped water tariff
+                                           factor.
+``--values``           ``-v`` VALUES       The value(s) of the parameter. A
+                                           comma separated list or a range
+                                           (start:stop:step) runs the model
+                                           once per value and writes
+                                           sweep_summary.json, with the
+                                           results of each run. A value given
+                                           here overrides the scenario's
+                                           data. Defaults to 2, which the
+                                           scenario's data can override.
+``--checkpoint-every`` ``-i`` INTERVAL     Save a checkpoint of each
+                                           simulation every INTERVAL timesteps.
+``--resume``           ``-e`` TIMESTEP     Resume each simulation from the
+                                           latest checkpoint of the last run
+                                           of the scenario, or the latest at
+                                           or before TIMESTEP. The inputs of
+                                           this run apply from there, so a run
+                                           can branch from a checkpoint. Any
+                                           run which does not resume clears
+                                           the checkpoints.
+``--progress-every``   ``-g`` SECONDS      Write the timesteps run, timesteps
+                                           per second and estimated time left
+                                           at most every SECONDS while the
+                                           simulations run. 0 turns this off.
+                                           Defaults to 5.
+``--save-simulation``  ``-k`` INDEX        When a scenario is run as more than
+                                           one simulation, by a sweep or a
+                                           model of several simulations, the
+                                           one whose results are saved to it,
+                                           counting from 0 in the order they
+                                           are run: by value, then by
+                                           simulation. Without it, nothing is
+                                           saved to such a scenario.
+``--daemon``           ``-d``              Stay running, accepting runs from
+                                           later invocations of the app.
+``--profile``          ``-f``              Profile the run with cProfile and
+                                           return the statistics in
+                                           profile.pstats.
 ====================== ====== ============ =======================================
 
-"""
+"""
+
+
+import argparse as ap
+import logging
+
+from HydraLib.HydraException import HydraPluginError
+from HydraLib.PluginLib import JsonConnection,\
+                               JSONObj,\
+                               RequestError,\
+                               create_xml_response,\
+                               write_progress,\
+                               write_output,\
+                               validate_plugin_xml
+import bz2
+import copy
+import cPickle
+import cProfile
+import gzip
+import hashlib
+import json
+import math
+import multiprocessing
+import os, sys
+import Queue
+import re
+import requests
+import shutil
+import socket
+import threading
+import time
+import traceback
+
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+try:
+    import resource
+except ImportError:
+    #Not available on Windows
+    resource = None
+
+try:
+    import numpy
+except ImportError:
+    #Only needed for network snapshots
+    numpy = None
+
+
+from HydraLib.xml2json import json2xml
+
+log = logging.getLogger(__name__)
+
+global __location__
+__location__ = os.path.dirname(os.path.abspath(__file__))
+
+#The socket on which the daemon listens for runs.
+SOCKET_PATH = os.path.join(os.path.expanduser('~'), '.hydra', 'run_model.sock')
+
+def measure():
+    """
+        Return the wall time, the CPU time and the largest resident memory
+        of the process so far (in KB on Linux, or None where it isn't
+        available).
+    """
+    max_rss = None
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return time.time(), sum(os.times()[:2]), max_rss
+
+def memory_increase(start_rss, end_rss):
+    """
+        How much the largest resident memory of the process grew between
+        two measurements, or None if it isn't available. A phase which
+        stays within the memory of earlier phases shows no increase.
+    """
+    if start_rss is None or end_rss is None:
+        return None
+    return end_rss - start_rss
+
+class Instrumentation(object):
+    """
+        Records the wall time and CPU time of each phase of a run, such
+        as parsing the workbook or each request to the server, so they can
+        be written to a JSON file for the user. The memory of each phase
+        is the largest resident memory of the process by its end
+        (max_rss_so_far) and how much the phase raised it
+        (max_rss_increase), both in KB, as the process's memory can only
+        be measured since it started.
+    """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start_wall, start_cpu, start_rss = measure()
+        try:
+            yield
+        finally:
+            end_wall, end_cpu, end_rss = measure()
+            self.add(name, end_wall - start_wall, end_cpu - start_cpu,
+                     end_rss, memory_increase(start_rss, end_rss))
+
+    def add(self, name, wall_time, cpu_time, max_rss_so_far, max_rss_increase):
+        self.phases.append(dict(
+            phase            = name,
+            wall_time        = wall_time,
+            cpu_time         = cpu_time,
+            max_rss_so_far   = max_rss_so_far,
+            max_rss_increase = max_rss_increase,
+        ))
+
+    def summary(self):
+        """
+            Total wall time for each phase name, in the order they were
+            first seen, as a string for the plugin's output.
+        """
+        totals = OrderedDict()
+        for p in self.phases:
+            count, wall_time = totals.get(p['phase'], (0, 0))
+            totals[p['phase']] = (count + 1, wall_time + p['wall_time'])
+
+        parts = []
+        for name, (count, wall_time) in totals.items():
+            if count > 1:
+                parts.append("%s (x%s): %.2fs"%(name, count, wall_time))
+            else:
+                parts.append("%s: %.2fs"%(name, wall_time))
+        return ", ".join(parts)
+
+    def write(self, file_name):
+        with open(file_name, 'w') as timings_file:
+            json.dump(self.phases, timings_file, indent=4, separators=(',', ': '))
+
+def find_workbook(setup_module, file_name='models_input.xlsx'):
+    """
+        Find the workbook read by the simulation setup module. It is looked
+        for beside the module, in the directory above and in the current
+        directory. Returns None if it can't be found.
+    """
+    module_dir = os.path.dirname(os.path.abspath(setup_module.__file__))
+    for search_dir in (module_dir, os.path.dirname(module_dir), os.getcwd()):
+        path = os.path.join(search_dir, file_name)
+        if os.path.exists(path):
+            return path
+    return None
+
+class SimulationSnapshot(object):
+    """
+        Saves the simulations loaded from a workbook to a binary file, so
+        later runs can skip parsing the workbook. The snapshot records the
+        modification time and content hash of the workbook, and is ignored
+        if either has changed since it was made.
+    """
+
+    def __init__(self, workbook, name, snapshot_dir, refresh=False):
+        self.workbook = workbook
+        path_hash = hashlib.sha1(os.path.abspath(workbook)).hexdigest()
+        self.path = os.path.join(snapshot_dir, "%s_%s.snapshot"%(path_hash, name))
+
+        #If refresh is set, the snapshot is never loaded, only saved.
+        self.refresh = refresh
+
+        self._workbook_key = None
+
+    def workbook_key(self):
+        if self._workbook_key is None:
+            with open(self.workbook, 'rb') as workbook_file:
+                content_hash = hashlib.sha1(workbook_file.read()).hexdigest()
+            self._workbook_key = (os.path.getmtime(self.workbook), content_hash)
+        return self._workbook_key
+
+    def load(self):
+        """
+            Return the saved simulations, or None if there is no snapshot
+            or it is out of date.
+        """
+        if self.refresh is True or not os.path.exists(self.path):
+            return None
+
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                #The key is stored first so an out of date snapshot can be
+                #rejected without loading the simulations.
+                if cPickle.load(snapshot_file) != self.workbook_key():
+                    log.info("Snapshot of %s is out of date", self.workbook)
+                    return None
+                simulations = cPickle.load(snapshot_file)
+        except Exception, e:
+            log.warn("Unable to load snapshot %s: %s", self.path, e)
+            return None
+
+        log.info("Loaded simulations from snapshot %s", self.path)
+        return simulations
+
+    def save(self, simulations):
+        try:
+            with open(self.path, 'wb') as snapshot_file:
+                cPickle.dump(self.workbook_key(), snapshot_file, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump(simulations, snapshot_file, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            #Not all simulations can be pickled. This only costs the
+            #next run a parse of the workbook, so carry on.
+            log.warn("Unable to save snapshot %s: %s", self.path, e)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+class NetworkSnapshot(object):
+    """
+        Saves a network, and the data of one of its scenarios, as columnar
+        NumPy arrays with one file per column, so later runs can load it
+        from disk (memory-mapped) rather than fetch it from the server.
+        Snapshots are kept per server, network ID and scenario ID.
+
+        Resources keep their IDs, names, coordinates, end nodes and
+        attributes. Scalars and single column time series are stored as
+        numbers; any other data is stored as text. The resources are read
+        when the snapshot is loaded, but each dataset only when it is used
+        (see SnapshotDatasets).
+
+        A snapshot is saved with a stamp of the network as it was on the
+        server (see ModelRunner.get_network_stamp), and is only loaded
+        while the server gives the same stamp, so a network changed since
+        is fetched again.
+    """
+
+    #Increased whenever the layout of the files changes, so older
+    #snapshots are ignored.
+    VERSION = 2
+
+    #The owner of a resource attribute, in the 'ra_owner' column.
+    OWNERS = ['NETWORK', 'NODE', 'LINK', 'GROUP']
+
+    #The kind of each dataset, in the 'ds_kind' column.
+    SCALAR, TIMESERIES, TEXT = 0, 1, 2
+
+    #Stands in for None in string columns.
+    NULL = '\x00'
+
+    def __init__(self, url, network_id, scenario_id, snapshot_dir,
+                 include_data=True, refresh=False):
+        url_hash = hashlib.sha1(url or '').hexdigest()[:12]
+        #A network fetched without its data is kept apart from one with it.
+        contents = 'data' if include_data is True else 'topology'
+        self.path = os.path.join(snapshot_dir, "network_%s_%s_scenario_%s_%s"%(
+                                                url_hash, network_id, scenario_id, contents))
+        self.scenario_id = int(scenario_id)
+
+        #If refresh is set, the snapshot is never loaded, only saved.
+        self.refresh = refresh
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def _save_array(self, name, values, dtype):
+        numpy.save(self._file(name), numpy.asarray(values, dtype=dtype))
+
+    def _load_array(self, name):
+        return numpy.load(self._file(name), mmap_mode='r')
+
+    def _save_strings(self, name, strings):
+        """
+            Save a column of strings as one block of UTF-8 bytes and the
+            offset of each string within it.
+        """
+        encoded = [self.NULL if s is None else unicode(s).encode('utf-8') for s in strings]
+        offsets = [0]
+        for s in encoded:
+            offsets.append(offsets[-1] + len(s))
+        data = ''.join(encoded)
+        self._save_array(name + '_offsets', offsets, 'int64')
+        self._save_array(name + '_data', bytearray(data), 'uint8')
+
+    def _load_strings(self, name):
+        offsets = self._load_array(name + '_offsets').tolist()
+        data = self._load_array(name + '_data').tostring()
+        try:
+            #Most columns are ASCII, so can be decoded in one go, as
+            #their offsets are the same in bytes and characters.
+            data = data.decode('ascii')
+            decode = unicode
+        except UnicodeDecodeError:
+            decode = lambda s: s.decode('utf-8')
+        strings = []
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            s = data[start:end]
+            strings.append(None if s == self.NULL else decode(s))
+        return strings
+
+    def _encode_dataset(self, value):
+        """
+            Split a dataset's value into its kind, a number, a time series
+            (times and values) and text; only those for its kind are used.
+        """
+        text = value.get('value')
+        if value.get('type') == 'scalar':
+            try:
+                number = float(text)
+            except (TypeError, ValueError):
+                number = None
+            if number is not None and repr(number) == text:
+                return self.SCALAR, number, [], [], ''
+        elif value.get('type') == 'timeseries':
+            try:
+                ts = json.loads(text, object_pairs_hook=OrderedDict)
+                column = ts['0']
+                if ts.keys() == ['0'] and isinstance(column, dict):
+                    return self.TIMESERIES, 0, column.keys(), map(float, column.values()), ''
+            except (TypeError, ValueError, KeyError):
+                pass
+        return self.TEXT, 0, [], [], text
+
+    def save(self, network, stamp=None):
+        log.info("Saving network snapshot %s", self.path)
+        try:
+            self._save(network, stamp)
+        except Exception, e:
+            log.warn("Unable to save network snapshot %s: %s", self.path, e)
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def _save(self, network, stamp):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        #The meta data is written last, so a snapshot which was not
+        #finished is never loaded.
+        meta_path = os.path.join(self.path, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        scenario = dict(resourcescenarios=[])
+        for s in network.get('scenarios') or []:
+            if s['id'] == self.scenario_id:
+                scenario = s
+
+        resources = dict(
+            NODE  = network.get('nodes') or [],
+            LINK  = network.get('links') or [],
+            GROUP = network.get('resourcegroups') or [],
+        )
+        for ref_key, prefix in (('NODE', 'node'), ('LINK', 'link'), ('GROUP', 'group')):
+            self._save_array(prefix + '_id', [r['id'] for r in resources[ref_key]], 'int64')
+            self._save_strings(prefix + '_name', [r['name'] for r in resources[ref_key]])
+
+        nodes = resources['NODE']
+        self._save_array('node_x', [n.get('x') for n in nodes], 'float64')
+        self._save_array('node_y', [n.get('y') for n in nodes], 'float64')
+        links = resources['LINK']
+        self._save_array('link_node_1_id', [l['node_1_id'] for l in links], 'int64')
+        self._save_array('link_node_2_id', [l['node_2_id'] for l in links], 'int64')
+
+        ra_id, ra_attr_id, ra_owner, ra_index = [], [], [], []
+        owners = [('NETWORK', [network])] + [(k, resources[k]) for k in self.OWNERS[1:]]
+        for owner, owner_resources in owners:
+            for index, resource in enumerate(owner_resources):
+                for ra in resource.get('attributes') or []:
+                    ra_id.append(ra['id'])
+                    ra_attr_id.append(ra['attr_id'])
+                    ra_owner.append(self.OWNERS.index(owner))
+                    ra_index.append(index)
+        self._save_array('ra_id', ra_id, 'int64')
+        self._save_array('ra_attr_id', ra_attr_id, 'int64')
+        self._save_array('ra_owner', ra_owner, 'int8')
+        self._save_array('ra_index', ra_index, 'int64')
+
+        columns = dict((name, []) for name in ['rs_ra_id', 'rs_attr_id', 'ds_kind',
+                                               'ds_scalar', 'ds_type', 'ds_name',
+                                               'ds_unit', 'ds_dimension', 'ds_text',
+                                               'ts_time_index', 'ts_values'])
+        ts_offsets = [0]
+
+        #Most time series share their times, so each time is stored once
+        #and the time series refer to it by its index.
+        ts_times = OrderedDict()
+        for rs in scenario['resourcescenarios'] or []:
+            value = rs['value']
+            kind, number, times, values, text = self._encode_dataset(value)
+            columns['rs_ra_id'].append(rs['resource_attr_id'])
+            columns['rs_attr_id'].append(rs['attr_id'])
+            columns['ds_kind'].append(kind)
+            columns['ds_scalar'].append(number)
+            columns['ds_text'].append(text)
+            for field in ['type', 'name', 'unit', 'dimension']:
+                columns['ds_' + field].append(value.get(field))
+            for t in times:
+                columns['ts_time_index'].append(ts_times.setdefault(t, len(ts_times)))
+            columns['ts_values'].extend(values)
+            ts_offsets.append(len(columns['ts_values']))
+
+        for name in ['rs_ra_id', 'rs_attr_id']:
+            self._save_array(name, columns[name], 'int64')
+        self._save_array('ds_kind', columns['ds_kind'], 'int8')
+        self._save_array('ds_scalar', columns['ds_scalar'], 'float64')
+        self._save_array('ts_offsets', ts_offsets, 'int64')
+        self._save_array('ts_values', columns['ts_values'], 'float64')
+        self._save_array('ts_time_index', columns['ts_time_index'], 'int64')
+        self._save_strings('ts_times', ts_times.keys())
+        for name in ['ds_type', 'ds_name', 'ds_unit', 'ds_dimension', 'ds_text']:
+            self._save_strings(name, columns[name])
+
+        excluded = ['nodes', 'links', 'resourcegroups', 'scenarios', 'attributes']
+        meta = dict(
+            version  = self.VERSION,
+            stamp    = stamp,
+            network  = dict((k, v) for k, v in network.items() if k not in excluded),
+            scenario = dict((k, v) for k, v in scenario.items() if k != 'resourcescenarios'),
+        )
+        with open(meta_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+    def load(self, stamp=None):
+        """
+            Return the saved network, as returned by get_network, or None
+            if there is no snapshot, it was made by another version or it
+            was saved with a different stamp.
+        """
+        meta_path = os.path.join(self.path, 'meta.json')
+        if self.refresh is True or not os.path.exists(meta_path):
+            return None
+
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if meta['version'] != self.VERSION:
+                log.info("Network snapshot %s is out of date", self.path)
+                return None
+            if meta.get('stamp') != stamp:
+                log.info("Network snapshot %s is older than the network", self.path)
+                return None
+            network = self._load(meta)
+        except Exception, e:
+            log.warn("Unable to load network snapshot %s: %s", self.path, e)
+            return None
+
+        log.info("Loaded network from snapshot %s", self.path)
+        return network
+
+    def _load(self, meta):
+        network = meta['network']
+        network['attributes'] = []
+
+        resources = {}
+        for ref_key, prefix in (('NODE', 'node'), ('LINK', 'link'), ('GROUP', 'group')):
+            resources[ref_key] = [dict(id=i, name=name, attributes=[])
+                                  for i, name in zip(self._load_array(prefix + '_id').tolist(),
+                                                     self._load_strings(prefix + '_name'))]
+
+        x = self._load_array('node_x').tolist()
+        y = self._load_array('node_y').tolist()
+        for node, node_x, node_y in zip(resources['NODE'], x, y):
+            node['x'] = None if node_x != node_x else node_x
+            node['y'] = None if node_y != node_y else node_y
+        node_1 = self._load_array('link_node_1_id').tolist()
+        node_2 = self._load_array('link_node_2_id').tolist()
+        for link, node_1_id, node_2_id in zip(resources['LINK'], node_1, node_2):
+            link['node_1_id'] = node_1_id
+            link['node_2_id'] = node_2_id
+
+        owners = [[network]] + [resources[k] for k in self.OWNERS[1:]]
+        for ra_id, attr_id, owner, index in zip(self._load_array('ra_id').tolist(),
+                                                self._load_array('ra_attr_id').tolist(),
+                                                self._load_array('ra_owner').tolist(),
+                                                self._load_array('ra_index').tolist()):
+            owners[owner][index]['attributes'].append(dict(id=ra_id, attr_id=attr_id))
+
+        #The data is left in the memory-mapped files until it is used.
+        resourcescenarios = SnapshotDatasets(self)
+
+        scenario = meta['scenario']
+        scenario['resourcescenarios'] = resourcescenarios
+
+        network['nodes'] = resources['NODE']
+        network['links'] = resources['LINK']
+        network['resourcegroups'] = resources['GROUP']
+        network['scenarios'] = [scenario]
+        return JSONObj(network)
+
+class SnapshotStrings(object):
+    """
+        A column of strings saved by NetworkSnapshot._save_strings, each
+        read from the memory-mapped file when it is asked for.
+    """
+
+    def __init__(self, snapshot, name):
+        self.offsets = snapshot._load_array(name + '_offsets')
+        self.data    = snapshot._load_array(name + '_data')
+
+    def __getitem__(self, row):
+        s = self.data[int(self.offsets[row]):int(self.offsets[row + 1])].tostring()
+        if s == NetworkSnapshot.NULL:
+            return None
+        return s.decode('utf-8')
+
+class SnapshotDatasets(object):
+    """
+        The resource scenarios of a NetworkSnapshot's scenario, as a
+        sequence. Each is only read from the memory-mapped columns when it
+        is asked for, by its position or (see row) its resource attribute
+        ID, so a run which uses a few of them doesn't read the rest.
+    """
+
+    def __init__(self, snapshot):
+        load = snapshot._load_array
+        self.ra_ids        = load('rs_ra_id')
+        self.attr_ids      = load('rs_attr_id')
+        self.kinds         = load('ds_kind')
+        self.scalars       = load('ds_scalar')
+        self.ts_offsets    = load('ts_offsets')
+        self.ts_time_index = load('ts_time_index')
+        self.ts_values     = load('ts_values')
+        self.ts_times      = snapshot._load_strings('ts_times')
+        self.strings = dict((field, SnapshotStrings(snapshot, 'ds_' + field))
+                            for field in ['type', 'name', 'unit', 'dimension', 'text'])
+
+        #The row of each resource attribute, made when first needed.
+        self._rows = None
+
+    def __len__(self):
+        return len(self.ra_ids)
+
+    def __iter__(self):
+        for row in xrange(len(self)):
+            yield self[row]
+
+    def __getitem__(self, row):
+        kind = int(self.kinds[row])
+        if kind == NetworkSnapshot.SCALAR:
+            text = repr(float(self.scalars[row]))
+        elif kind == NetworkSnapshot.TIMESERIES:
+            start, end = int(self.ts_offsets[row]), int(self.ts_offsets[row + 1])
+            times = [self.ts_times[i] for i in self.ts_time_index[start:end].tolist()]
+            text = json.dumps({'0': dict(zip(times, self.ts_values[start:end].tolist()))})
+        else:
+            text = self.strings['text'][row]
+
+        strings = self.strings
+        return dict(
+            resource_attr_id = int(self.ra_ids[row]),
+            attr_id          = int(self.attr_ids[row]),
+            value            = dict(type=strings['type'][row], name=strings['name'][row],
+                                    unit=strings['unit'][row],
+                                    dimension=strings['dimension'][row], value=text),
+        )
+
+    def row(self, resource_attr_id):
+        """
+            Return the row of the resource attribute's dataset, or None.
+        """
+        if self._rows is None:
+            self._rows = dict((ra_id, row) for row, ra_id in enumerate(self.ra_ids.tolist()))
+        return self._rows.get(resource_attr_id)
+
+class PluginCache(object):
+    """
+        A small on-disk cache for objects which rarely change on the server,
+        such as attributes and templates. Entries expire after 'ttl' seconds
+        and, once there are more than 'max_entries' of them, the least
+        recently used are removed. Values are stored as JSON, as they came
+        from the server, and come back as JSONObjs.
+    """
+
+    def __init__(self, cache_dir=None, ttl=86400, max_entries=50, refresh=False):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.hydra', 'cache')
+        self.cache_dir   = cache_dir
+        self.ttl         = ttl
+        self.max_entries = max_entries
+
+        #If refresh is set, nothing is read from the cache, but everything
+        #fetched from the server is written to it.
+        self.refresh     = refresh
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _path(self, key):
+        key_hash = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.cache_dir, "%s.cache"%key_hash)
+
+    def get(self, key):
+        """
+            Return the value stored against key, or None if there is no
+            entry, or it has expired.
+        """
+        if self.refresh is True:
+            return None
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'rb') as cache_file:
+                created, encoded = cPickle.load(cache_file)
+            if time.time() - created > self.ttl:
+                return None
+            value = json.loads(encoded, object_hook=JSONObj)
+        except Exception, e:
+            #A broken entry only costs a request to the server.
+            log.warn("Unable to read cache entry %s: %s", path, e)
+            return None
+
+        #Touch the file so the eviction sees it as recently used.
+        os.utime(path, None)
+        log.info("Using cached %s", key)
+        return value
+
+    def set(self, key, value):
+        path = self._path(key)
+        try:
+            encoded = json.dumps(value)
+            with open(path, 'wb') as cache_file:
+                cPickle.dump((time.time(), encoded), cache_file, cPickle.HIGHEST_PROTOCOL)
+            self._evict()
+        except Exception, e:
+            #The next run fetches it from the server again, so carry on.
+            log.warn("Unable to cache %s: %s", key, e)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _evict(self):
+        entries = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+                   if f.endswith('.cache')]
+        if len(entries) <= self.max_entries:
+            return
+
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+#The types of resource which can be named in an attribute map.
+REF_KEYS = ['NETWORK', 'NODE', 'LINK', 'GROUP']
+
+def load_attribute_map(path):
+    """
+        Read the attributes the model uses from a JSON file. For each type
+        of resource (see REF_KEYS), the file maps the name of each
+        attribute to the property of the model it is used for:
+
+            {"NODE": {"demand": "demand"}, "LINK": {"flow": "flow"}}
+    """
+    try:
+        with open(path) as map_file:
+            attribute_map = json.load(map_file)
+    except (IOError, ValueError), e:
+        raise HydraPluginError("Unable to read attribute map %s: %s"%(path, e))
+
+    if not isinstance(attribute_map, dict):
+        raise HydraPluginError("Attribute map %s must be a JSON object."%path)
+    for ref_key, attributes in attribute_map.items():
+        if ref_key not in REF_KEYS:
+            raise HydraPluginError("Unknown resource type %s in attribute map %s. "
+                                   "Expected one of %s."%(ref_key, path, ', '.join(REF_KEYS)))
+        if not isinstance(attributes, dict):
+            raise HydraPluginError("The %s attributes in attribute map %s must map "
+                                   "attribute names to properties."%(ref_key, path))
+    return attribute_map
+
+def decode_dataset(dataset):
+    """
+        Return the value of a Hydra dataset: a float for a scalar, the
+        decoded JSON for a time series or array, or the text otherwise.
+    """
+    value = dataset.get('value')
+    try:
+        if dataset.get('type') == 'scalar':
+            return float(value)
+        if dataset.get('type') in ('timeseries', 'array'):
+            return json.loads(value)
+    except (TypeError, ValueError):
+        pass
+    return value
+
+class ScenarioData(object):
+    """
+        The datasets of a scenario, by resource attribute ID. Each dataset
+        is only decoded the first time it is asked for. Given a function
+        to fetch the datasets of an attribute, each attribute's datasets
+        are only fetched the first time one of them is asked for.
+    """
+
+    def __init__(self, resource_scenarios=None, fetch=None):
+        #The fetched, but not yet decoded, datasets.
+        self._datasets = {}
+
+        #The decoded values.
+        self._values = {}
+
+        self.fetch = fetch
+        self.fetched_attr_ids = set()
+
+        #The datasets of a network snapshot, read from it when used.
+        self._snapshot = None
+
+        self.add(resource_scenarios or [])
+
+    def add(self, resource_scenarios):
+        if isinstance(resource_scenarios, SnapshotDatasets):
+            self._snapshot = resource_scenarios
+            return
+        for rs in resource_scenarios:
+            self._datasets[rs['resource_attr_id']] = rs['value']
+
+    def get(self, resource_attr_id, attr_id):
+        """
+            Return the value of the resource attribute, or None if it has
+            no data in the scenario.
+        """
+        if resource_attr_id in self._values:
+            return self._values[resource_attr_id]
+
+        if resource_attr_id not in self._datasets and self._snapshot is not None:
+            row = self._snapshot.row(resource_attr_id)
+            if row is not None:
+                self._datasets[resource_attr_id] = self._snapshot[row]['value']
+
+        if resource_attr_id not in self._datasets and self.fetch is not None \
+                and attr_id not in self.fetched_attr_ids:
+            self.fetched_attr_ids.add(attr_id)
+            self.add(self.fetch(attr_id))
+
+        dataset = self._datasets.pop(resource_attr_id, None)
+        if dataset is None:
+            return None
+        value = decode_dataset(dataset)
+        self._values[resource_attr_id] = value
+        return value
+
+class ResultCache(object):
+    """
+        Keeps the finished simulations of earlier runs on disk, by a hash
+        of everything which determines them (see ModelRunner.result_key),
+        so an identical run can reuse them rather than run again. Once
+        the entries take more than 'max_bytes', the least recently used
+        are removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024, refresh=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        #If refresh is set, nothing is read from the cache, but every
+        #run is written to it.
+        self.refresh   = refresh
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, "%s.result"%key)
+
+    def get(self, key):
+        """
+            Return the simulations stored against key, or None.
+        """
+        if self.refresh is True:
+            return None
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'rb') as result_file:
+                simulations = cPickle.load(result_file)
+        except Exception, e:
+            #An entry pickled by other code, such as an older model, can
+            #fail in any way, so it's removed and the simulations run.
+            log.warn("Unable to read cached results %s: %s", key, e)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        os.utime(path, None)
+        log.info("Using cached results %s", key)
+        return simulations
+
+    def set(self, key, simulations):
+        path = self._path(key)
+        try:
+            with open(path, 'wb') as result_file:
+                cPickle.dump(simulations, result_file, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            log.warn("Unable to cache results %s: %s", key, e)
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+                   if f.endswith('.result')]
+        entries.sort(key=os.path.getmtime, reverse=True)
+
+        total_bytes = 0
+        for path in entries:
+            total_bytes += os.path.getsize(path)
+            if total_bytes > self.max_bytes:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+def model_version(setup_module):
+    """
+        Return a hash of the model's code, the .py files of the package
+        holding the simulation setup module, and of the workbook it reads.
+    """
+    model_hash = hashlib.sha1()
+    package_dir = os.path.dirname(os.path.abspath(setup_module.__file__))
+    for root, dirs, files in os.walk(package_dir):
+        dirs.sort()
+        for file_name in sorted(files):
+            if file_name.endswith('.py'):
+                path = os.path.join(root, file_name)
+                model_hash.update(os.path.relpath(path, package_dir))
+                with open(path, 'rb') as code_file:
+                    model_hash.update(code_file.read())
+
+    workbook = find_workbook(setup_module)
+    if workbook is not None:
+        with open(workbook, 'rb') as workbook_file:
+            model_hash.update(workbook_file.read())
+    return model_hash.hexdigest()
+
+#The parameter overridden by default: the piped water tariff factor.
+DEFAULT_PARAMETER = '[0].network.exogenous_inputs.amman_model_user_input_params[0]'
+
+def parse_values(values):
+    """
+        Parse the values for a parameter, either a comma separated list,
+        such as '1,2,3', or a range 'start:stop:step', which includes stop
+        if a whole number of steps reaches it, and never goes past it.
+    """
+    if ':' in values:
+        start, stop, step = [float(v) for v in values.split(':')]
+        if step <= 0:
+            raise ValueError("The step must be positive")
+        if stop < start:
+            raise ValueError("The stop must not be less than the start")
+        #The tolerance keeps stop when rounding leaves it just out of reach.
+        num_steps = int(math.floor((stop - start) / step + 1e-9))
+        return [start + i * step for i in range(num_steps + 1)]
+    return [float(v) for v in values.split(',')]
+
+def parse_ids(ids):
+    """
+        Parse a comma separated list of IDs, such as '1,2,3'.
+    """
+    return [int(i) for i in ids.split(',') if i != '']
+
+def _parameter_path(path):
+    """
+        Split a parameter path, such as
+        '[0].network.exogenous_inputs.amman_model_user_input_params[0]',
+        into a list of attribute names and list indices. The path starts
+        from the list of simulations.
+    """
+    step_re = r'\.?([A-Za-z_]\w*)|\[(-?\d+)\]'
+    if path == '' or re.sub(step_re, '', path) != '':
+        raise HydraPluginError("Invalid parameter %s"%path)
+
+    steps = []
+    for name, index in re.findall(step_re, path):
+        if name != '':
+            steps.append(name)
+        else:
+            steps.append(int(index))
+    return steps
+
+def _follow(obj, steps, path):
+    try:
+        for step in steps:
+            if isinstance(step, int):
+                obj = obj[step]
+            else:
+                obj = getattr(obj, step)
+    except (AttributeError, IndexError, KeyError, TypeError):
+        raise HydraPluginError("Parameter %s not found"%path)
+    return obj
+
+def get_parameter(simulations, path):
+    return _follow(simulations, _parameter_path(path), path)
+
+def set_parameter(simulations, path, value):
+    steps = _parameter_path(path)
+    parent = _follow(simulations, steps[:-1], path)
+    try:
+        if isinstance(steps[-1], int):
+            parent[steps[-1]] = value
+        else:
+            setattr(parent, steps[-1], value)
+    except (AttributeError, IndexError, TypeError):
+        raise HydraPluginError("Unable to set parameter %s"%path)
+
+def set_input(obj, path, value):
+    """
+        Set the property at 'path' (see _parameter_path) under obj to a
+        copy of value. If the property is already an array of the same
+        shape, it is filled in place rather than replaced.
+    """
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        try:
+            current = _follow(obj, _parameter_path(path), path)
+        except HydraPluginError:
+            current = None
+        if isinstance(current, numpy.ndarray) and current.shape == value.shape:
+            current[:] = value
+            return
+    set_parameter(obj, path, copy.copy(value))
+
+def input_values(value, num_timesteps):
+    """
+        Convert a decoded dataset (see decode_dataset) into the value of a
+        model input. A time series with a value for each of the
+        num_timesteps timesteps becomes an array of its values in time
+        order, and a numeric array becomes an array. Returns None for a
+        time series with any other number of values.
+    """
+    if isinstance(value, dict):
+        if len(value) != 1 or not isinstance(value.values()[0], dict):
+            return None
+        column = value.values()[0]
+        if len(column) != num_timesteps:
+            return None
+        value = [column[t] for t in sorted(column)]
+    elif not isinstance(value, list):
+        return value
+
+    try:
+        if numpy is not None:
+            return numpy.array(value, dtype='float64')
+        return array('d', value)
+    except (TypeError, ValueError):
+        return value
+
+#The largest request, in bytes of data, used to save results.
+MAX_UPLOAD_BYTES = 4 * 1024 * 1024
+
+def coordinate(value):
+    """
+        A node's coordinate as a number, as the server can give it as a
+        string and a network snapshot gives it as a float.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+def layout_hash(network):
+    """
+        A hash of the layout of a network: the IDs and names of its
+        resources, the coordinates of its nodes and the ends of its links.
+    """
+    layout = [
+        [(n['id'], n['name'], coordinate(n.get('x')), coordinate(n.get('y')))
+         for n in network.get('nodes') or []],
+        [(l['id'], l['name'], l['node_1_id'], l['node_2_id'])
+         for l in network.get('links') or []],
+        [(g['id'], g['name']) for g in network.get('resourcegroups') or []],
+    ]
+    return hashlib.sha1(json.dumps(layout)).hexdigest()
+
+def collect_results(simulation):
+    """
+        Gather the recorded history of each property of each component of
+        the simulation into typed arrays. Returns a dict keyed on
+        (ref_key, component name, property name). Properties whose values
+        are not numbers are skipped.
+    """
+    network = simulation.network
+    components = [('NETWORK', None, network)]
+    components.extend(('NODE', n.name, n) for n in network.nodes)
+    components.extend(('LINK', l.name, l) for l in network.links)
+    components.extend(('GROUP', i.name, i) for i in network.institutions)
+
+    results = {}
+    for ref_key, name, component in components:
+        for prop, history in getattr(component, '_history', {}).items():
+            try:
+                results[(ref_key, name, prop)] = array('d', history)
+            except TypeError:
+                log.info("Not saving %s of %s: values are not numbers", prop, name)
+    return results
+
+def summarise_results(simulation):
+    """
+        The smallest, mean, largest and final value of each result of the
+        simulation (see collect_results), as a list of dicts sorted by
+        resource type, resource and property, for a sweep's summary.
+    """
+    summaries = []
+    for (ref_key, name, prop), values in sorted(collect_results(simulation).items()):
+        if len(values) == 0:
+            continue
+        summaries.append(dict(
+            resource_type = ref_key,
+            resource      = name,
+            property      = prop,
+            min           = min(values),
+            mean          = sum(values) / len(values),
+            max           = max(values),
+            final         = values[-1],
+        ))
+    return summaries
+
+def encode_result(name, values, timesteps):
+    """
+        Encode an array of results as a compact Hydra dataset: a time series
+        if there is a value for each timestep, otherwise an array.
+    """
+    if timesteps is not None and len(timesteps) == len(values):
+        ts = dict((str(t), v) for t, v in zip(timesteps, values))
+        data_type, value = 'timeseries', {'0': ts}
+    else:
+        data_type, value = 'array', values.tolist()
+
+    return dict(
+        name      = name,
+        type      = data_type,
+        unit      = None,
+        dimension = 'dimensionless',
+        value     = json.dumps(value, separators=(',', ':')),
+    )
+
+#Networks are written this many of their encoded pieces at a time.
+WRITE_BATCH = 4096
+
+#The file suffix and opener for each supported compression.
+COMPRESSION = OrderedDict([
+    ('gzip', ('.gz',  lambda path: gzip.open(path, 'wb'))),
+    ('bz2',  ('.bz2', lambda path: bz2.BZ2File(path, 'w'))),
+])
+
+#In XML, lists of at least this many items are written a piece at a time,
+#along with anything which holds them.
+STREAM_MIN_ITEMS = 100
+
+def holds_long_list(obj, min_items=STREAM_MIN_ITEMS, depth=2):
+    """
+        Check whether obj is a list of at least min_items items, or holds
+        one within 'depth' levels of dicts and lists.
+    """
+    if isinstance(obj, list) and len(obj) >= min_items:
+        return True
+    if depth == 0:
+        return False
+    if isinstance(obj, dict):
+        values = obj.itervalues()
+    elif isinstance(obj, list):
+        values = obj
+    else:
+        return False
+    return any(holds_long_list(v, min_items, depth - 1) for v in values)
+
+def iter_json(obj, indent=None):
+    """
+        Encode obj as JSON, a piece at a time, giving the same text as
+        json.dumps with sorted keys. With indent=None the output is
+        compact. The pieces come from one pass of the standard encoder,
+        so this takes no longer than json.dumps; encoding each node or
+        link separately costs the encoder's set up for every one of
+        them.
+    """
+    if indent is None:
+        separators = (',', ':')
+    else:
+        separators = (',', ': ')
+    encoder = json.JSONEncoder(sort_keys=True, indent=indent, separators=separators)
+    return encoder.iterencode(obj)
+
+def iter_xml(obj, line_padding=''):
+    """
+        Encode obj as XML, a piece at a time, giving the same text as
+        json2xml. Only the long lists (see holds_long_list), and what
+        holds them, are broken into pieces, and the items of a long list
+        are each encoded whole, so only the few objects above them are
+        searched for long lists.
+    """
+    if type(obj) is dict and holds_long_list(obj):
+        for i, (tag_name, sub_obj) in enumerate(obj.items()):
+            yield "%s%s<%s>\n"%('\n' if i > 0 else '', line_padding, tag_name)
+            for chunk in iter_xml(sub_obj, '\t' + line_padding):
+                yield chunk
+            yield "\n%s</%s>"%(line_padding, tag_name)
+    elif type(obj) is list and len(obj) >= STREAM_MIN_ITEMS:
+        for i, sub_obj in enumerate(obj):
+            if i > 0:
+                yield '\n'
+            yield json2xml(sub_obj, line_padding)
+    elif type(obj) is list and holds_long_list(obj):
+        for i, sub_obj in enumerate(obj):
+            if i > 0:
+                yield '\n'
+            for chunk in iter_xml(sub_obj, line_padding):
+                yield chunk
+    else:
+        yield json2xml(obj, line_padding)
+
+def write_chunks(out_file, chunks, batch=WRITE_BATCH):
+    """
+        Write the chunks to out_file, joining them 'batch' at a time so
+        the file (and any compressor) sees fewer, larger writes. The
+        encoders give millions of small chunks, so they are counted
+        rather than measured. Text which isn't ASCII, as XML can hold, is
+        written as UTF-8.
+    """
+    chunks = iter(chunks)
+    while True:
+        piece = ''.join(islice(chunks, batch))
+        if piece == '':
+            break
+        if isinstance(piece, unicode):
+            piece = piece.encode('utf-8')
+        out_file.write(piece)
+
+class Checkpoints(object):
+    """
+        Saves the state of each simulation every 'interval' timesteps while
+        it runs, and restores simulations from those checkpoints, so a run
+        can carry on from part way through rather than from the first
+        timestep.
+
+        This relies on the simulation calling
+        network.set_timestep(timestep, index) at the start of each
+        timestep, as pynsim does, and on start() carrying on from the state
+        the simulation is in.
+    """
+
+    def __init__(self, checkpoint_dir, interval=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.interval = interval
+
+        #The timestep each restored simulation resumes from, and its full
+        #list of timesteps, by the simulation's index.
+        self.resumed = {}
+
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+    def _path(self, index, timestep_index):
+        return os.path.join(self.checkpoint_dir, "%s_%s.checkpoint"%(index, timestep_index))
+
+    def save(self, simulation, index, timestep_index):
+        path = self._path(index, timestep_index)
+        try:
+            with open(path, 'wb') as checkpoint_file:
+                cPickle.dump(simulation, checkpoint_file, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            log.warn("Unable to save checkpoint %s: %s", path, e)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _timestep_indices(self, index):
+        """
+            The timestep indices of the checkpoints of the simulation.
+        """
+        timestep_indices = []
+        prefix = "%s_"%index
+        for file_name in os.listdir(self.checkpoint_dir):
+            if file_name.startswith(prefix) and file_name.endswith('.checkpoint'):
+                timestep_indices.append(int(file_name[len(prefix):-len('.checkpoint')]))
+        return timestep_indices
+
+    def latest(self, index, before=None):
+        """
+            Return the latest timestep index with a checkpoint of the
+            simulation, at or before 'before' if it is given, or None.
+        """
+        timestep_indices = [timestep_index for timestep_index in self._timestep_indices(index)
+                            if before is None or timestep_index <= before]
+        return max(timestep_indices) if len(timestep_indices) > 0 else None
+
+    def restore(self, simulations, before=None):
+        """
+            Replace each simulation with its latest checkpoint (at or
+            before timestep index 'before', if it is given), so it resumes
+            from there. Returns the number of simulations restored.
+        """
+        num_restored = 0
+        for index in range(len(simulations)):
+            timestep_index = self.latest(index, before)
+            if timestep_index is None:
+                continue
+            with open(self._path(index, timestep_index), 'rb') as checkpoint_file:
+                simulation = cPickle.load(checkpoint_file)
+
+            self.resumed[index] = (timestep_index, simulation.timesteps)
+            simulation.timesteps = simulation.timesteps[timestep_index:]
+            simulations[index] = simulation
+            num_restored = num_restored + 1
+            log.info("Resuming simulation %s from timestep %s", index, timestep_index)
+
+            #Later checkpoints belong to the run being branched from, so
+            #must not be resumed from once this run has carried on.
+            for later in self._timestep_indices(index):
+                if later > timestep_index:
+                    os.remove(self._path(index, later))
+        return num_restored
+
+    def offset(self, index):
+        """
+            The timestep index the simulation was restored at, which its
+            timestep indices start from, or 0 if it was not restored.
+        """
+        return self.resumed.get(index, (0, None))[0]
+
+    @contextmanager
+    def attach(self, simulation, index):
+        """
+            Save checkpoints of the simulation while it runs within this
+            context. A restored simulation gets its full list of timesteps
+            back at the end.
+        """
+        offset, timesteps = self.resumed.get(index, (0, None))
+        network = simulation.network
+        set_timestep = network.set_timestep
+
+        def checkpointed_set_timestep(timestep, timestep_index, *args, **kwargs):
+            timestep_index = timestep_index + offset
+            if self.interval and timestep_index > 0 and timestep_index % self.interval == 0:
+                #The wrapper can't be pickled, so the simulation is saved
+                #as it would be without it.
+                del network.set_timestep
+                resumed_timesteps = simulation.timesteps
+                if timesteps is not None:
+                    simulation.timesteps = timesteps
+                try:
+                    self.save(simulation, index, timestep_index)
+                finally:
+                    simulation.timesteps = resumed_timesteps
+                    network.set_timestep = checkpointed_set_timestep
+            return set_timestep(timestep, timestep_index, *args, **kwargs)
+
+        network.set_timestep = checkpointed_set_timestep
+        try:
+            yield
+        finally:
+            if 'set_timestep' in vars(network):
+                del network.set_timestep
+            if timesteps is not None:
+                simulation.timesteps = timesteps
+
+#Progress is written at most this often, in seconds.
+PROGRESS_INTERVAL = 5
+
+@contextmanager
+def report_progress(simulation, key, report, interval=PROGRESS_INTERVAL, offset=0):
+    """
+        Call report(key, number of timesteps completed) while the
+        simulation runs within this context, at most once every 'interval'
+        seconds, and once more when it finishes. Like Checkpoints.attach,
+        this relies on network.set_timestep being called at the start of
+        each timestep. All it adds to each timestep is a look at the clock.
+        A simulation resumed from a checkpoint has timestep indices from
+        'offset' on (see Checkpoints.offset), but only its remaining
+        timesteps are counted.
+    """
+    num_timesteps = len(getattr(simulation, 'timesteps', None) or [])
+    network = simulation.network
+    set_timestep = network.set_timestep
+    next_report = [time.time() + interval]
+
+    def reporting_set_timestep(timestep, timestep_index, *args, **kwargs):
+        now = time.time()
+        if now >= next_report[0]:
+            next_report[0] = now + interval
+            report(key, timestep_index - offset)
+        return set_timestep(timestep, timestep_index, *args, **kwargs)
+
+    network.set_timestep = reporting_set_timestep
+    try:
+        yield
+        report(key, num_timesteps)
+    finally:
+        #Checkpoints.attach may already have removed it.
+        if vars(network).get('set_timestep') is reporting_set_timestep:
+            del network.set_timestep
+
+class Progress(object):
+    """
+        Gathers the number of timesteps completed by each simulation being
+        run, and writes the total, the throughput and the estimated time
+        remaining at most every 'interval' seconds. Simulations running
+        in worker processes send their progress through a ProgressQueue,
+        which is read by listen.
+    """
+
+    def __init__(self, interval=PROGRESS_INTERVAL):
+        self.interval = interval
+
+        #The name, number of timesteps and number completed of each
+        #simulation, by a key identifying its run.
+        self.names     = OrderedDict()
+        self.totals    = {}
+        self.completed = {}
+
+        self.start_time  = time.time()
+        self.next_report = self.start_time + interval
+        self.lock = threading.Lock()
+
+    def add(self, key, name, num_timesteps):
+        self.names[key]     = name
+        self.totals[key]    = num_timesteps
+        self.completed[key] = 0
+
+    def attach(self, simulation, key, offset=0):
+        return report_progress(simulation, key, self.update, self.interval, offset)
+
+    def update(self, key, completed):
+        with self.lock:
+            self.completed[key] = completed
+            now = time.time()
+            if now >= self.next_report:
+                self.next_report = now + self.interval
+                write_output(self.summary(now))
+
+    def summary(self, now=None):
+        if now is None:
+            now = time.time()
+        completed = sum(self.completed.values())
+        total     = sum(self.totals.values())
+        elapsed   = now - self.start_time
+
+        rate = completed / elapsed if elapsed > 0 else 0.0
+        if rate > 0:
+            eta = str(timedelta(seconds=int(round((total - completed) / rate))))
+        else:
+            eta = "unknown"
+        percent = 100.0 * completed / total if total > 0 else 100.0
+
+        message = "%s of %s timesteps (%.0f%%), %.1f timesteps/s, ETA %s"%(
+                                                completed, total, percent, rate, eta)
+        running = ["%s %s/%s"%(name, self.completed[key], self.totals[key])
+                   for key, name in self.names.items()
+                   if 0 < self.completed[key] < self.totals[key]]
+        if len(running) > 0:
+            message = "%s. Running: %s"%(message, ", ".join(running))
+        return message
+
+    def finish(self):
+        elapsed = time.time() - self.start_time
+        completed = sum(self.completed.values())
+        if completed > 0 and elapsed > 0:
+            write_output("Ran %s timesteps in %.1fs, %.1f timesteps/s"%(
+                                            completed, elapsed, completed / elapsed))
+
+    def listen(self, queue):
+        """
+            Apply the updates sent through the queue by a ProgressQueue,
+            until None is sent.
+        """
+        while True:
+            update = queue.get()
+            if update is None:
+                break
+            self.update(*update)
+
+class ProgressQueue(object):
+    """
+        Sends the progress of the simulations running in a worker process
+        to the Progress in the parent process, through a multiprocessing
+        queue.
+    """
+
+    def __init__(self, queue, interval=PROGRESS_INTERVAL):
+        self.queue = queue
+        self.interval = interval
+
+    def attach(self, simulation, key, offset=0):
+        return report_progress(simulation, key, self.send, self.interval, offset)
+
+    def send(self, key, completed):
+        self.queue.put((key, completed))
+
+#The simulations to be run by a worker process, their Checkpoints (or
+#None) and the ProgressQueue to report their progress to (or None). Set by
+#init_worker.
+_worker_simulations = None
+_worker_checkpoints = None
+_worker_progress    = None
+
+def init_worker(simulations, checkpoints=None, progress=None):
+    global _worker_simulations, _worker_checkpoints, _worker_progress
+    _worker_simulations = simulations
+    _worker_checkpoints = checkpoints
+    _worker_progress    = progress
+
+def run_attached(simulation, index=None, checkpoints=None, progress=None, key=None):
+    """
+        Run a simulation, checkpointing it if checkpoints are given and
+        reporting its progress, under 'key', if a Progress or
+        ProgressQueue is given.
+    """
+    if progress is not None:
+        #Progress is attached first, so the checkpoints' wrapper of
+        #set_timestep, which removes itself while the simulation is
+        #saved, is the outer one.
+        offset = 0
+        if checkpoints is not None:
+            offset = checkpoints.offset(index)
+        with progress.attach(simulation, key, offset):
+            run_attached(simulation, index, checkpoints)
+    elif checkpoints is not None:
+        with checkpoints.attach(simulation, index):
+            simulation.start()
+    else:
+        simulation.start()
+
+def start_simulation(simulation, index=None, checkpoints=None, progress=None, key=None):
+    """
+        Run a simulation (see run_attached), catching any error so a failed
+        simulation does not stop the others. Returns the error (or None)
+        and the wall time, CPU time, largest resident memory so far and
+        its increase during the run (see Instrumentation).
+    """
+    start_wall, start_cpu, start_rss = measure()
+    try:
+        run_attached(simulation, index, checkpoints, progress, key)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    end_wall, end_cpu, end_rss = measure()
+    return error, (end_wall - start_wall, end_cpu - start_cpu,
+                   end_rss, memory_increase(start_rss, end_rss))
+
+def run_simulation(job):
+    """
+        Run one simulation in a worker process. The job is the index of
+        the simulation and, for a parameter sweep, the parameter and the
+        value to set it to first.
+
+        Returns the job, the pickled simulation once it has finished (or
+        None), the error (or None) and the statistics of the run (see
+        start_simulation).
+    """
+    index, parameter, value = job
+    if parameter is not None:
+        set_parameter(_worker_simulations, parameter, value)
+
+    simulation = _worker_simulations[index]
+    error, stats = start_simulation(simulation, index, _worker_checkpoints,
+                                    _worker_progress, job)
+
+    result = None
+    if error is None:
+        try:
+            result = cPickle.dumps(simulation, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            log.warn("Unable to return simulation %s: %s", index, e)
+
+    return job, result, error, stats
+
+def request_error(response, app_name=None):
+    """
+        Return the RequestError for a failed response, with the server's
+        fault as JsonConnection reports it, rather than the raw body.
+    """
+    try:
+        fault = json.loads(response.content)
+        if 'faultcode' in fault:
+            message = "%s:%s"%(fault['faultcode'], fault['faultstring'])
+        else:
+            message = fault['faultstring']
+    except Exception:
+        message = response.reason or "An unknown server error has occurred."
+
+    if app_name is not None:
+        message = "%s: %s"%(app_name, message)
+    return RequestError(message)
+
+def session_expired(response):
+    """
+        Whether a failed response is the server's refusal of the session,
+        such as one which has expired, so a new login can be tried.
+    """
+    try:
+        fault = json.loads(response.content)['faultstring']
+    except Exception:
+        return False
+    return 'session' in fault.lower()
+
+#The number of requests a ConnectionPool makes to the server at once.
+MAX_CONNECTIONS = 4
+
+class ConnectionPool(object):
+    """
+        Makes the requests of a logged in JsonConnection over a pool of
+        keep-alive HTTP sessions, all using the connection's session ID,
+        so each request doesn't open a new connection to the server.
+        At most max_connections requests are made at once, however many
+        threads are making them. call_async makes a request in the
+        background, so independent requests can be made concurrently.
+        If the server refuses the session, such as once it has expired,
+        the pool logs in again and repeats the request.
+
+        The function name and wall time of every request are kept in
+        latencies, in the order they finished.
+    """
+
+    def __init__(self, connection, max_connections=MAX_CONNECTIONS):
+        self.url        = connection.url
+        self.session_id = connection.session_id
+        self.app_name   = getattr(connection, 'app_name', None)
+
+        #Logs in again if the server refuses the session.
+        self._connection = connection
+
+        self.max_connections = max_connections
+
+        #The idle sessions, most recently used first. None stands for a
+        #session which hasn't been needed yet.
+        self._sessions = Queue.LifoQueue()
+        for i in range(max_connections):
+            self._sessions.put(None)
+
+        #Counts the calls to close, so a session which was making a
+        #request at the time is closed once the request is done.
+        self._generation = 0
+
+        #The threads making requests for call_async, started when first used.
+        self._pool = None
+
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def post(self, func, body, object_hook=JSONObj):
+        """
+            Send a request body, which can be a string or a file, for the
+            named function and return the decoded response, as JSONObjs
+            unless another object_hook is given (None for plain dicts,
+            which are much quicker to decode).
+        """
+        session_id = self.session_id
+        response = self._send(func, body, session_id)
+
+        if not response.ok and session_expired(response):
+            self.login(session_id)
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            response = self._send(func, body, self.session_id)
 
+        if not response.ok:
+            raise request_error(response, self.app_name)
 
-import argparse as ap
-import logging
+        return json.loads(response.content, object_hook=object_hook)
 
-from HydraLib.HydraException import HydraPluginError
-from HydraLib.PluginLib import JsonConnection,\
-                               create_xml_response,\
-                               write_progress,\
-                               write_output,\
-                               validate_plugin_xml
-import json
-import os, sys
+    def _send(self, func, body, session_id):
+        headers = {
+            'Content-Type': 'application/json',
+            'session_id'  : session_id,
+            'app_name'    : self.app_name,
+        }
 
+        session = self._sessions.get()
+        generation = self._generation
+        if session is None:
+            session = requests.Session()
+        start = time.time()
+        try:
+            response = session.post(self.url, data=body, headers=headers)
+        except Exception:
+            #The session's connection may be broken, so start a new one.
+            session.close()
+            self._sessions.put(None)
+            raise
+        self._release(session, generation)
 
-from HydraLib.xml2json import json2xml
+        with self._lock:
+            self.latencies.append((func, time.time() - start))
 
-log = logging.getLogger(__name__)
+        return response
 
-global __location__
-__location__ = os.path.split(sys.argv[0])[0]
+    def login(self, refused_session_id):
+        """
+            Log in again, as the server refused the session, unless another
+            request has done so already.
+        """
+        with self._lock:
+            if self.session_id != refused_session_id:
+                return
+            write_output("Session %s refused. Logging in again."%refused_session_id)
+            self._connection.login()
+            self.session_id = self._connection.session_id
+
+    def _release(self, session, generation):
+        """
+            Return a session to the pool once its request is done.
+        """
+        if generation != self._generation:
+            session.close()
+            session = None
+        self._sessions.put(session)
+
+    def call(self, func, args, object_hook=JSONObj):
+        log.info("Calling: %s", func)
+        return self.post(func, json.dumps({func:args}), object_hook)
+
+    def call_async(self, func, args):
+        """
+            Start the request in the background and return its
+            AsyncResult. Its get method waits for the response.
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_connections)
+        return self._pool.apply_async(self.call, (func, args))
+
+    def latency_summary(self, start=0):
+        """
+            The number, mean and longest wall time of the requests to each
+            function, from the start'th request on, as a string for the
+            plugin's output.
+        """
+        totals = OrderedDict()
+        for func, wall_time in self.latencies[start:]:
+            count, total, longest = totals.get(func, (0, 0, 0))
+            totals[func] = (count + 1, total + wall_time, max(longest, wall_time))
+
+        return ", ".join("%s (x%s): %.3fs mean, %.3fs max"%(func, count,
+                                                           total / count, longest)
+                         for func, (count, total, longest) in totals.items())
+
+    def close(self):
+        """
+            Close every session, leaving the pool ready to open new ones.
+            Sessions making a request are closed when it is done, and
+            return their place in the pool then.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        self._generation = self._generation + 1
+
+        num_idle = 0
+        while True:
+            try:
+                session = self._sessions.get_nowait()
+            except Queue.Empty:
+                break
+            num_idle = num_idle + 1
+            if session is not None:
+                session.close()
+        for i in range(num_idle):
+            self._sessions.put(None)
+
+def connect(url=None, session_id=None, max_connections=MAX_CONNECTIONS):
+    """
+        Log in to the server, or use an existing session, and return a
+        ConnectionPool making requests with it.
+    """
+    connection = JsonConnection(url)
+    write_output("Connecting...")
+    if session_id is not None:
+        write_output("Using existing session %s"% session_id)
+        connection.session_id=session_id
+    else:
+        connection.login()
+    return ConnectionPool(connection, max_connections)
 
 class ModelRunner(object):
     """
        Exporter of Hydra networks to JSON or XML files.
     """
 
-    def __init__(self, url=None, session_id=None):
+    def __init__(self, url=None, session_id=None, cache=None, num_workers=1,
+                 parameter=DEFAULT_PARAMETER, values=None, target_dir=None,
+                 connection=None, max_upload_bytes=MAX_UPLOAD_BYTES,
+                 as_xml=False, compact=False, compression=None,
+                 local_snapshot=False, result_cache=None,
+                 checkpoint_interval=None, resume_from=None,
+                 progress_interval=PROGRESS_INTERVAL, save_simulation=None):
 
         #Record the names of the files created by the plugin so we can
         #display them to the user.
@@ -66,55 +1788,241 @@ class ModelRunner(object):
         #easier 
         self.attr_id_map = {}
 
-        self.connection = JsonConnection(url)
-        write_output("Connecting...")
-        if session_id is not None:
-            write_output("Using existing session %s"% session_id)
-            self.connection.session_id=session_id
-        else:
-            self.connection.login()
+        #The time and memory used by each phase of the run.
+        self.instrumentation = Instrumentation()
+
+        #An existing connection can be passed in, such as the daemon's.
+        if connection is None:
+            with self.instrumentation.phase('Connect'):
+                connection = connect(url, session_id)
+        self.connection = connection
+
+        #Where this run's requests start in the connection's latencies, as
+        #the daemon's connection is shared by all its runs.
+        self.first_request = len(getattr(connection, 'latencies', []))
         
         self.network = None
+        self.scenario_id = None
+
+        #All the scenarios being run. Each is run separately, and its
+        #results are saved to it.
+        self.scenario_ids = []
+
+        #Results are saved in requests of at most this many bytes of data.
+        self.max_upload_bytes = max_upload_bytes
+
+        #How write_network writes the network: as XML rather than JSON,
+        #without indentation, and compressed with one of COMPRESSION
+        #(or None).
+        self.as_xml = as_xml
+        self.compact = compact
+        self.compression = compression
+
+        #A PluginCache for the attributes, or None to always fetch them
+        #from the server.
+        self.cache = cache
+
+        #Whether to run from a local snapshot of the network (see
+        #NetworkSnapshot), kept in the cache, rather than fetch it.
+        self.local_snapshot = local_snapshot
+
+        #A ResultCache of earlier runs, or None to always run the model.
+        self.result_cache = result_cache
+
+        #Save a checkpoint of each simulation every this many timesteps
+        #(or never, if None), and resume from the checkpoint at this
+        #timestep index (-1 for the latest), or from the start if None.
+        self.checkpoint_interval = checkpoint_interval
+        self.resume_from = resume_from
+
+        #Write the progress of the simulations at most every this many
+        #seconds while they run, or not at all if None or 0.
+        self.progress_interval = progress_interval
+
+        #The number of processes used to run the simulations.
+        self.num_workers = num_workers
+
+        #The parameter to set before running, and the value(s) to set it
+        #to. With more than one value, the model is run for each of them.
+        #Values which are given override the scenario's data (see
+        #apply_scenario_data); the default is set before the scenario's
+        #data, so the scenario can override it.
+        self.parameter = parameter
+        self.values_given = values is not None
+        if values is None:
+            values = [2]
+        self.values = values
+
+        #Where output files are written.
+        if target_dir is None:
+            target_dir = os.getcwd()
+        self.target_dir = os.path.abspath(target_dir)
+
+        #Simulations already loaded from the workbook, such as by the
+        #daemon. Each run works on a copy of them.
+        self.preloaded_simulations = None
+
+        #The attributes the model uses, read by load_attribute_map. If set,
+        #only the data of these attributes is fetched, and only when it
+        #is first used. Otherwise all the scenario's data is fetched.
+        self.attribute_map = None
+
+        #The ScenarioData of each scenario being run, by scenario ID.
+        self.scenario_data = {}
+
+        #The parts of result_key which are the same for every scenario.
+        self._network_key = None
+        self._model_version = None
+
+        #The simulations, once they have been run.
+        self.simulations = []
+
+        #The simulations of each scenario, by scenario ID, in the order
+        #they are run (by value, then by simulation), with None in place
+        #of those which did not finish. Their results are saved to the
+        #scenario.
+        self.scenario_results = OrderedDict()
+
+        #Which of the simulations of a scenario, by its position in
+        #scenario_results, to save the results of when there is more than
+        #one. See export_results.
+        self.save_simulation = save_simulation
+
+        #Errors and warnings from the individual simulations, to be
+        #reported in the plugin's response.
+        self.errors   = []
+        self.warnings = []
 
         self.num_steps = 3
 
+    def call(self, func, args, object_hook=JSONObj):
+        """
+            Make a request to the server, recording how long it took.
+        """
+        with self.instrumentation.phase("Call %s"%func):
+            return self.connection.call(func, args, object_hook)
+
     def get_attributes(self, template_id):
-        if template_id is not None:
-            #TODO: Find out why get_all_template_attributes isnt here.
-            attributes = self.connection.call('get_all_attributes', 
-                                            {'template_id':template_id})
-        else:
-            attributes = self.connection.call('get_all_attributes', {})
+        cache_key = (self.connection.url, 'attributes', template_id)
+        attributes = None
+        if self.cache is not None:
+            attributes = self.cache.get(cache_key)
+
+        if attributes is None:
+            if template_id is not None:
+                #TODO: Find out why get_all_template_attributes isnt here.
+                attributes = self.call('get_all_attributes', 
+                                                {'template_id':template_id})
+            else:
+                attributes = self.call('get_all_attributes', {})
+
+            #The list is cached as the server sent it, rather than the map.
+            if self.cache is not None:
+                self.cache.set(cache_key, attributes)
         
         attr_id_map = {}
         for a in attributes:
             attr_id_map[a.id] = a
         self.attr_id_map = attr_id_map
 
-    def get_network_data(self, network_id, scenario_id):
+    def get_network_snapshot(self, network_id, scenario_id):
+        """
+            Return the NetworkSnapshot of the network and scenario, or None
+            if local snapshots are not in use or cannot be made.
+        """
+        if self.local_snapshot is False or self.cache is None:
+            return None
+        if numpy is None:
+            log.warn("NumPy is not installed. Unable to use network snapshots.")
+            return None
+        return NetworkSnapshot(self.connection.url,
+                               network_id,
+                               scenario_id,
+                               self.cache.cache_dir,
+                               include_data=self.attribute_map is None,
+                               refresh=self.cache.refresh)
+
+    def get_network_stamp(self, network_id, scenario_id):
+        """
+            Return a stamp of the network and scenario as they are on the
+            server, or None if it could not be fetched, to tell whether a
+            snapshot of them is still current. It comes from the server's
+            summary of the network, without its data or its resources'
+            attributes: the network's and the scenario's own details
+            (including when they were changed, if the server records it),
+            the scenario's group members and the layout of the network
+            (see layout_hash).
+        """
+        try:
+            summary = self.call('get_network', {'network_id'  : int(network_id),
+                                                'scenario_ids': [int(scenario_id)],
+                                                'include_data': 'N',
+                                                'summary'     : 'Y'},
+                                object_hook=None)
+        except Exception, e:
+            log.warn("Unable to check network %s against its snapshot: %s", network_id, e)
+            return None
+
+        excluded = ['nodes', 'links', 'resourcegroups', 'scenarios', 'attributes',
+                    'resourcescenarios', 'resourcegroupitems']
+        stamp = [dict((k, v) for k, v in summary.items() if k not in excluded)]
+        for s in summary.get('scenarios') or []:
+            if s['id'] == int(scenario_id):
+                stamp.append(dict((k, v) for k, v in s.items() if k not in excluded))
+                items = [(i.get('ref_key'), i.get('ref_id'), i.get('group_id'))
+                         for i in s.get('resourcegroupitems') or []]
+                stamp.append(hashlib.sha1(json.dumps(items)).hexdigest())
+        stamp.append(layout_hash(summary))
+        return hashlib.sha1(json.dumps(stamp, sort_keys=True)).hexdigest()
+
+    def get_network_data(self, network_id, scenario_ids):
         """
             Retrieve the network, identify the parameters to set, 
             set them and run the model. Then identify the results
             and set them back on the network.
+            All the scenarios (one ID or a list of them) are retrieved
+            with the network in one request.
         """
 
         write_output("Retrieving Network") 
         write_progress(2, self.num_steps) 
         if network_id is not None:
 
-            if scenario_id is None:
+            if scenario_ids is None or scenario_ids == []:
                 raise HydraPluginError("A scenario ID must be specified.")
+            if not isinstance(scenario_ids, list):
+                scenario_ids = [scenario_ids]
+            scenario_ids = [int(scenario_id) for scenario_id in scenario_ids]
+
+            #Snapshots hold the data of a single scenario, and are only
+            #used while the network on the server still matches them.
+            network = None
+            snapshot = None
+            stamp = None
+            if len(scenario_ids) == 1:
+                snapshot = self.get_network_snapshot(network_id, scenario_ids[0])
+            if snapshot is not None:
+                stamp = self.get_network_stamp(network_id, scenario_ids[0])
+            if stamp is not None:
+                network = snapshot.load(stamp)
 
             #The network ID can be specified to get the network...
-            try:
-                network_id = int(network_id)
-                network = self.connection.call('get_network', {'network_id':network_id,
-                                                        'scenario_ids':[int(scenario_id)]})
+            if network is None:
+                try:
+                    network_id = int(network_id)
+                    args = {'network_id':network_id,
+                            'scenario_ids':scenario_ids}
+                    if self.attribute_map is not None:
+                        args['include_data'] = 'N'
+                    network = self.call('get_network', args)
 
-                write_output("Network retrieved")
-            except Exception, e:
-                log.exception(e)
-                raise HydraPluginError("Network %s not found."%network_id)
+                    write_output("Network retrieved")
+                except Exception, e:
+                    log.exception(e)
+                    raise HydraPluginError("Network %s not found."%network_id)
+
+                if stamp is not None:
+                    snapshot.save(network, stamp)
 
         else:
             raise HydraPluginError("A network ID must be specified!")
@@ -135,11 +2043,75 @@ class ModelRunner(object):
             #raise HydraPluginError("There's no network attributes. Unable to run Model.")
         
         self.network = network
+        self.scenario_ids = scenario_ids
+        self.scenario_id = scenario_ids[0]
+        self.scenario_data = dict((scenario_id, self.get_scenario_data(network, scenario_id))
+                                  for scenario_id in scenario_ids)
+
+    def get_scenario_data(self, network, scenario_id):
+        """
+            Return the ScenarioData of one of the scenarios being run. With
+            an attribute map, the data of each attribute in the map is
+            fetched in the background and waited for the first time it is
+            used.
+        """
+        resource_scenarios = []
+        for scenario in network.scenarios or []:
+            if scenario.id == scenario_id:
+                resource_scenarios = scenario.get('resourcescenarios') or []
 
+        if self.attribute_map is None:
+            return ScenarioData(resource_scenarios)
 
-    def run_model(self):
+        names = set()
+        for attributes in self.attribute_map.values():
+            names.update(attributes.keys())
+        attr_ids = set(a.id for a in self.attr_id_map.values() if a.name in names)
 
-        from jordanprototype import simulation_setup
+        #The data of each mapped attribute which the network's resources
+        #have is fetched concurrently, in the background, and waited for
+        #when first used.
+        pending = {}
+        if isinstance(self.connection, ConnectionPool):
+            resources = [network] + (network.nodes or []) + (network.links or []) \
+                                  + (network.resourcegroups or [])
+            used_attr_ids = set(ra.attr_id for resource in resources
+                                           for ra in resource.attributes or [])
+            for attr_id in attr_ids & used_attr_ids:
+                pending[attr_id] = self.connection.call_async('get_attribute_datasets',
+                                                              {'attr_id':attr_id,
+                                                               'scenario_id':scenario_id})
+
+        def fetch(attr_id):
+            if attr_id in pending:
+                return pending.pop(attr_id).get()
+            if attr_id not in attr_ids:
+                return []
+            return self.call('get_attribute_datasets', {'attr_id':attr_id,
+                                                        'scenario_id':scenario_id})
+
+        return ScenarioData(resource_scenarios, fetch)
+
+    def load_simulations(self, simulation_setup):
+        """
+            Load the simulations, with their networks, institutions,
+            inputs, observations and engines, from models_input.xlsx.
+            If the workbook hasn't changed since the last run, the
+            simulations are restored from a snapshot instead.
+        """
+        if self.preloaded_simulations is not None:
+            return copy.deepcopy(self.preloaded_simulations)
+
+        snapshot = None
+        workbook = find_workbook(simulation_setup)
+        if self.cache is not None and workbook is not None:
+            snapshot = SimulationSnapshot(workbook,
+                                          'run',
+                                          self.cache.cache_dir,
+                                          refresh=self.cache.refresh)
+            simulations = snapshot.load()
+            if simulations is not None:
+                return simulations
 
         # create list of simulations with timestep information based upon information input
         # to models_input.xlsx (sheet: simulation)
@@ -154,43 +2126,617 @@ class ModelRunner(object):
         # load exogenous inputs for each simulation
         simulation_setup.load_exogenous_inputs(simulations)
 
-        old_tariff = simulations[0].network.exogenous_inputs.amman_model_user_input_params[0]
-
-        new_tariff = 2
-
-        log.critical("Setting piped water tarriff factor from %s to %s", old_tariff, new_tariff)
-
-        simulations[0].network.exogenous_inputs.amman_model_user_input_params[0] = new_tariff
-
         # load observations (simulation independent)
         simulation_setup.load_observations(simulations)
 
         # load engines for each simulation
         simulation_setup.load_engines(simulations)
 
-        # run each simulation in simulations list
-        for s in simulations:
-            s.start()
+        if snapshot is not None:
+            snapshot.save(simulations)
+
+        return simulations
+
+    def run_model(self):
+
+        from jordanprototype import simulation_setup
+
+        with self.instrumentation.phase('Load simulations'):
+            simulations = self.load_simulations(simulation_setup)
+
+        checkpoints = self.get_checkpoints()
+
+        if len(self.scenario_ids) > 1:
+            self.run_scenarios(simulations, simulation_setup)
+            os.chdir(__location__)
+            return
+
+        #A resumed run takes the inputs given for this run from the
+        #checkpoint onwards, so can branch from an earlier run.
+        if checkpoints is not None and self.resume_from is not None:
+            before = None if self.resume_from < 0 else self.resume_from
+            num_restored = checkpoints.restore(simulations, before)
+            write_output("Resuming %s of %s simulations from checkpoints"%(
+                                                num_restored, len(simulations)))
+
+        if self.values_given is False:
+            self.set_value(simulations, self.values[0])
+
+        inputs_key = None
+        if self.attribute_map is not None:
+            with self.instrumentation.phase('Apply scenario data'):
+                inputs_key = self.apply_scenario_data(simulations,
+                                                      self.scenario_data[self.scenario_id])
+
+        result_key = None
+        cached = None
+        if self.result_cache is not None and len(self.values) == 1 \
+                and self.resume_from is None:
+            result_key = self.result_key(simulation_setup, inputs_key, self.values[0])
+            cached = self.result_cache.get(result_key)
+
+        if len(self.values) > 1:
+            self.run_sweep(simulations)
+        elif cached is not None:
+            write_output("Using the results of an identical earlier run")
+            self.simulations = cached
+            self.scenario_results[self.scenario_id] = cached
+        else:
+            if self.values_given is True:
+                self.set_value(simulations, self.values[0])
+
+            # run each simulation in simulations list
+            finished = [None] * len(simulations)
+            if self.num_workers > 1 and len(simulations) > 1:
+                jobs = [(i, None, None) for i in range(len(simulations))]
+                for job, simulation, error, stats in self.run_parallel(simulations, jobs,
+                                                                       checkpoints=checkpoints):
+                    if self.check_result(simulations[job[0]], simulation, error):
+                        simulations[job[0]] = simulation
+                        finished[job[0]] = simulation
+            else:
+                #As in parallel, a failed simulation is recorded and does
+                #not stop the others.
+                progress = self.get_progress((i, getattr(s, 'name', i), s)
+                                             for i, s in enumerate(simulations))
+                for i, s in enumerate(simulations):
+                    error, stats = start_simulation(s, i, checkpoints, progress, i)
+                    self.instrumentation.add("Simulation %s"%getattr(s, 'name', ''), *stats)
+                    if self.check_result(s, s, error):
+                        finished[i] = s
+                if progress is not None:
+                    progress.finish()
+
+            self.simulations = simulations
+            self.scenario_results[self.scenario_id] = finished
+
+            #A simulation whose result didn't come back is left unrun in
+            #simulations, so isn't cached however the run ended.
+            if result_key is not None and all(s is not None for s in finished):
+                self.result_cache.set(result_key, simulations)
 
         os.chdir(__location__)
 
+    def set_value(self, simulations, value):
+        """
+            Set self.parameter on the simulations, logging its old value.
+        """
+        old_value = get_parameter(simulations, self.parameter)
+
+        log.critical("Setting %s from %s to %s", self.parameter, old_value, value)
+
+        set_parameter(simulations, self.parameter, value)
+
+    def get_checkpoints(self):
+        """
+            Return the Checkpoints of the network and scenario being run,
+            or None if checkpoints are not in use. They are kept in the
+            plugin cache, or in the target directory without one. A run
+            which does not resume clears the checkpoints of earlier runs of
+            its scenarios first, so only its own can be resumed from.
+        """
+        if self.resume_from is None and self.network is not None:
+            for scenario_id in self.scenario_ids:
+                shutil.rmtree(self.checkpoint_dir(scenario_id), ignore_errors=True)
+
+        if self.checkpoint_interval is None and self.resume_from is None:
+            return None
+        if len(self.scenario_ids) > 1 or len(self.values) > 1:
+            raise HydraPluginError("Checkpoints can only be used when running "
+                                   "one scenario with one parameter value.")
+
+        return Checkpoints(self.checkpoint_dir(self.scenario_id), self.checkpoint_interval)
+
+    def checkpoint_dir(self, scenario_id):
+        if self.cache is not None:
+            base_dir = self.cache.cache_dir
+        else:
+            base_dir = self.target_dir
+        return os.path.join(base_dir,
+                            'checkpoints',
+                            "network_%s_scenario_%s"%(self.network.id, scenario_id))
+
+    def get_progress(self, runs):
+        """
+            Return a Progress of the runs about to be made, given as
+            (key, name, simulation), or None if progress is not being
+            reported.
+        """
+        if not self.progress_interval:
+            return None
+        progress = Progress(self.progress_interval)
+        for key, name, simulation in runs:
+            progress.add(key, name, len(getattr(simulation, 'timesteps', None) or []))
+        return progress
+
+    def run_scenarios(self, simulations, setup_module):
+        """
+            Run the simulations once for each scenario, each with a copy of
+            the simulations with the scenario's data applied. In parallel,
+            the simulations of all the scenarios share one pool of worker
+            processes. A failed simulation is recorded against its scenario
+            and does not stop the others. Scenarios with results in the
+            result cache are not run again.
+        """
+        if len(self.values) > 1:
+            raise HydraPluginError("A parameter can only be swept on one scenario.")
+        if self.attribute_map is None:
+            self.warnings.append("No attribute map was given, so every scenario "
+                                 "was run with the same inputs.")
+
+        write_output("Running %s scenarios"%len(self.scenario_ids))
+
+        self.scenario_results = OrderedDict((scenario_id, []) for scenario_id in self.scenario_ids)
+
+        all_simulations = []
+        scenario_of = []
+        result_keys = {}
+        for scenario_id in self.scenario_ids:
+            variant = copy.deepcopy(simulations)
+            if self.values_given is False:
+                set_parameter(variant, self.parameter, self.values[0])
+
+            inputs_key = None
+            if self.attribute_map is not None:
+                with self.instrumentation.phase('Apply scenario data'):
+                    inputs_key = self.apply_scenario_data(variant,
+                                                          self.scenario_data[scenario_id])
+
+            if self.result_cache is not None:
+                result_keys[scenario_id] = self.result_key(setup_module, inputs_key,
+                                                           self.values[0])
+                cached = self.result_cache.get(result_keys[scenario_id])
+                if cached is not None:
+                    write_output("Using the results of an identical earlier run "
+                                 "for scenario %s"%scenario_id)
+                    self.scenario_results[scenario_id] = cached
+                    continue
+
+            if self.values_given is True:
+                set_parameter(variant, self.parameter, self.values[0])
+            all_simulations.extend(variant)
+            scenario_of.extend([scenario_id] * len(variant))
+
+        if self.num_workers > 1 and len(all_simulations) > 0:
+            jobs = [(i, None, None) for i in range(len(all_simulations))]
+            results = self.run_parallel(all_simulations, jobs)
+        else:
+            results = self._run_scenarios_serial(all_simulations, scenario_of)
+
+        finished = {}
+        for (index, parameter, value), simulation, error, stats in results:
+            scenario_id = scenario_of[index]
+            if self.check_result(all_simulations[index], simulation, error,
+                                 label="scenario %s"%scenario_id):
+                finished[index] = simulation
+
+        #Keep each scenario's simulations in their original order, with
+        #None in place of those which did not finish.
+        for scenario_id in self.scenario_ids:
+            indices = [i for i, s in enumerate(scenario_of) if s == scenario_id]
+            if len(indices) == 0:
+                continue
+            scenario_simulations = [finished.get(i) for i in indices]
+            self.scenario_results[scenario_id] = scenario_simulations
+            if scenario_id in result_keys \
+                    and all(s is not None for s in scenario_simulations):
+                self.result_cache.set(result_keys[scenario_id], scenario_simulations)
+
+    def _run_scenarios_serial(self, simulations, scenario_of):
+        names = ["%s (scenario %s)"%(getattr(simulation, 'name', index), scenario_of[index])
+                 for index, simulation in enumerate(simulations)]
+        progress = self.get_progress((index, names[index], simulation)
+                                     for index, simulation in enumerate(simulations))
+        for index, simulation in enumerate(simulations):
+            error, stats = start_simulation(simulation, progress=progress, key=index)
+            self.instrumentation.add("Simulation %s"%names[index], *stats)
+            yield (index, None, None), simulation, error, stats
+        if progress is not None:
+            progress.finish()
+
+    def apply_scenario_data(self, simulations, scenario_data):
+        """
+            Set the inputs of the model from a scenario's ScenarioData, as
+            described by the attribute map. Each resource's data is set on the component
+            of the same name in each simulation; the network's data is set
+            on the simulation's network, such as on its exogenous inputs.
+            Each dataset is converted once and then assigned to every
+            simulation.
+
+            Returns a hash of the data which was set, for result_key.
+        """
+        inputs_hash = hashlib.sha1()
+        resources = [('NETWORK', [self.network]),
+                     ('NODE',    self.network.nodes or []),
+                     ('LINK',    self.network.links or []),
+                     ('GROUP',   self.network.resourcegroups or [])]
+
+        components = []
+        for s in simulations:
+            components.append(dict(
+                NODE  = dict((c.name, c) for c in getattr(s.network, 'nodes', [])),
+                LINK  = dict((c.name, c) for c in getattr(s.network, 'links', [])),
+                GROUP = dict((c.name, c) for c in getattr(s.network, 'institutions', [])),
+            ))
+
+        missing = 0
+        for ref_key, ref_resources in resources:
+            properties = self.attribute_map.get(ref_key)
+            if not properties:
+                continue
+            for resource in ref_resources:
+                for ra in resource.attributes or []:
+                    attr = self.attr_id_map.get(ra.attr_id)
+                    if attr is None or attr.name not in properties:
+                        continue
+                    value = scenario_data.get(ra.id, ra.attr_id)
+                    if value is None:
+                        continue
+
+                    path = properties[attr.name]
+                    inputs_hash.update(json.dumps([ref_key, resource.name, path, value],
+                                                  sort_keys=True))
+                    model_values = {}
+                    for s, simulation_components in zip(simulations, components):
+                        if ref_key == 'NETWORK':
+                            component = s.network
+                        else:
+                            component = simulation_components[ref_key].get(resource.name)
+                            if component is None:
+                                missing += 1
+                                continue
+
+                        num_timesteps = len(getattr(s, 'timesteps', []))
+                        if num_timesteps not in model_values:
+                            model_values[num_timesteps] = input_values(value, num_timesteps)
+                        model_value = model_values[num_timesteps]
+                        if model_value is None:
+                            self.warnings.append("%s of %s does not match the timesteps "
+                                                 "of simulation %s"%(attr.name, resource.name,
+                                                                     getattr(s, 'name', '')))
+                            continue
+                        set_input(component, path, model_value)
+
+        if missing > 0:
+            self.warnings.append("%s values were not set, as their resources are not "
+                                 "in the model"%missing)
+
+        return inputs_hash.hexdigest()
+
+    def result_key(self, setup_module, inputs_key, value):
+        """
+            Return the key of a run in the result cache: a hash of the
+            network's topology, the scenario data set on the model (see
+            apply_scenario_data), the parameter and its value, and the
+            version of the model.
+        """
+        if self._network_key is None:
+            self._network_key = layout_hash(self.network)
+
+        if self._model_version is None:
+            self._model_version = model_version(setup_module)
+
+        parts = [self._network_key, inputs_key, self.parameter, value, self._model_version]
+        return hashlib.sha1(json.dumps(parts)).hexdigest()
+
+    def run_parallel(self, simulations, jobs, maxtasksperchild=None, checkpoints=None):
+        """
+            Run the jobs (see run_simulation) in a pool of worker processes,
+            each with its own copy of the simulations. As each job completes,
+            yields the job, the finished simulation (or None), the error (or
+            None) and the statistics of the run (see start_simulation).
+            These are also recorded in self.instrumentation.
+        """
+        num_processes = min(self.num_workers, len(jobs))
+        write_output("Running %s simulations on %s processes"%(len(jobs), num_processes))
+
+        def job_name(job):
+            index, parameter, value = job
+            name = getattr(simulations[index], 'name', index)
+            if parameter is not None:
+                name = "%s (%s=%s)"%(name, parameter, value)
+            return name
+
+        #The workers send their progress back through a queue, which is
+        #read by a thread in this process.
+        progress = self.get_progress((job, job_name(job), simulations[job[0]])
+                                     for job in jobs)
+        progress_queue = None
+        listener = None
+        if progress is not None:
+            queue = multiprocessing.Queue()
+            progress_queue = ProgressQueue(queue, progress.interval)
+            listener = threading.Thread(target=progress.listen, args=(queue,))
+            listener.daemon = True
+            listener.start()
+
+        pool = multiprocessing.Pool(num_processes,
+                                    init_worker,
+                                    (simulations, checkpoints, progress_queue),
+                                    maxtasksperchild)
+        try:
+            for job, result, error, stats in pool.imap_unordered(run_simulation, jobs):
+                self.instrumentation.add("Simulation %s"%job_name(job), *stats)
+
+                simulation = None
+                if result is not None:
+                    simulation = cPickle.loads(result)
+                yield job, simulation, error, stats
+        finally:
+            pool.close()
+            pool.join()
+            if listener is not None:
+                queue.put(None)
+                listener.join()
+                progress.finish()
+
+    def check_result(self, original, simulation, error, label=None):
+        """
+            Record the error, or a warning if the finished simulation could
+            not be returned from its worker. Returns True if the simulation
+            finished and is available.
+        """
+        name = getattr(original, 'name', '')
+        if label is not None:
+            name = "%s (%s)"%(name, label)
+
+        if error is not None:
+            log.critical("Simulation %s failed:\n%s", name, error)
+            self.errors.append("Simulation %s failed: %s"%(name, error))
+            return False
+
+        write_output("Simulation %s finished"%name)
+
+        if simulation is None:
+            self.warnings.append("Simulation %s finished, but its "
+                                 "results could not be returned."%name)
+            return False
+
+        return True
+
+    def run_sweep(self, simulations):
+        """
+            Run the simulations once for each value of self.parameter.
+            The workbook is only loaded once: in parallel, each job runs in
+            a freshly started worker with its own copy of the simulations;
+            otherwise each value gets a deep copy of them.
+            A summary of all the runs, with the results of each (see
+            summarise_results), is written to sweep_summary.json.
+        """
+        write_output("Running %s values of %s"%(len(self.values), self.parameter))
+
+        if self.num_workers > 1:
+            jobs = [(i, self.parameter, value)
+                    for value in self.values
+                    for i in range(len(simulations))]
+            results = self.run_parallel(simulations, jobs, maxtasksperchild=1)
+        else:
+            results = self._run_sweep_serial(simulations)
+
+        summary = []
+        finished = {}
+        for (index, parameter, value), simulation, error, stats in results:
+            run_results = None
+            if self.check_result(simulations[index], simulation, error,
+                                 label="%s=%s"%(parameter, value)):
+                self.simulations.append(simulation)
+                finished[(index, value)] = simulation
+                run_results = summarise_results(simulation)
+
+            summary.append(dict(
+                simulation = getattr(simulations[index], 'name', index),
+                parameter  = parameter,
+                value      = value,
+                status     = 'failed' if error is not None else 'finished',
+                error      = error,
+                run_time   = stats[0],
+                results    = run_results,
+            ))
+
+        summary.sort(key=lambda run: (run['value'], run['simulation']))
+
+        file_name = os.path.join(self.target_dir, "sweep_summary.json")
+        with open(file_name, 'w') as summary_file:
+            json.dump(summary, summary_file, sort_keys=True, indent=4, separators=(',', ': '))
+        self.files.append(file_name)
+
+        self.scenario_results[self.scenario_id] = [finished.get((index, value))
+                                                   for value in self.values
+                                                   for index in range(len(simulations))]
+
+    def _run_sweep_serial(self, simulations):
+        progress = self.get_progress(((index, self.parameter, value),
+                                      "%s (%s=%s)"%(getattr(simulation, 'name', index),
+                                                    self.parameter, value),
+                                      simulation)
+                                     for value in self.values
+                                     for index, simulation in enumerate(simulations))
+        for value in self.values:
+            variant = copy.deepcopy(simulations)
+            set_parameter(variant, self.parameter, value)
+            for index, simulation in enumerate(variant):
+                job = (index, self.parameter, value)
+                error, stats = start_simulation(simulation, progress=progress, key=job)
+                self.instrumentation.add("Simulation %s (%s=%s)"%(
+                    getattr(simulation, 'name', index), self.parameter, value), *stats)
+                yield job, simulation, error, stats
+        if progress is not None:
+            progress.finish()
+
+    def _resource_attrs(self):
+        """
+            Map (ref_key, resource name, attribute name) to the resource
+            attribute ID and attribute ID of each attribute in the network.
+        """
+        resource_attrs = {}
+        def add(ref_key, name, attributes):
+            for ra in attributes or []:
+                attr = self.attr_id_map.get(ra.attr_id)
+                if attr is not None:
+                    resource_attrs[(ref_key, name, attr.name)] = (ra.id, ra.attr_id)
+
+        add('NETWORK', None, self.network.attributes)
+        for n in self.network.nodes:
+            add('NODE', n.name, n.attributes)
+        for l in self.network.links:
+            add('LINK', l.name, l.attributes)
+        for g in self.network.resourcegroups:
+            add('GROUP', g.name, g.attributes)
+        return resource_attrs
+
+    def export_results(self):
+        """
+            Save the results of the simulations back to their scenarios.
+            Each property recorded by a component is saved against the
+            attribute of the same name on the matching resource, if it has
+            one. The data is sent in batches of at most
+            self.max_upload_bytes.
+            Only one simulation can be saved to a scenario. When a scenario
+            was run more than once (a sweep, or a model of several
+            simulations), self.save_simulation chooses which, by its
+            position in scenario_results; without it, nothing is saved to
+            that scenario and a warning says so. Scenarios run once are
+            always saved.
+        """
+        to_save = []
+        for scenario_id, simulations in self.scenario_results.items():
+            if len(simulations) == 0:
+                continue
+
+            index = self.save_simulation
+            if index is None:
+                if len(simulations) > 1:
+                    self.warnings.append("Scenario %s was run as %s simulations, but "
+                                         "only one can be saved to it, so none was. "
+                                         "Choose which with --save-simulation."%(
+                                            scenario_id, len(simulations)))
+                    continue
+                index = 0
+            elif index >= len(simulations):
+                self.warnings.append("Scenario %s was run as %s simulations, so there "
+                                     "is no simulation %s to save to it."%(
+                                        scenario_id, len(simulations), index))
+                continue
+
+            if simulations[index] is None:
+                self.warnings.append("Simulation %s of scenario %s did not finish, "
+                                     "so no results were saved to it."%(index, scenario_id))
+                continue
+            to_save.append((scenario_id, simulations[index]))
+
+        resource_attrs = None
+        for scenario_id, simulation in to_save:
+            if resource_attrs is None:
+                resource_attrs = self._resource_attrs()
+            self._export_simulation_results(scenario_id, simulation, resource_attrs)
+
+    def _export_simulation_results(self, scenario_id, simulation, resource_attrs):
+        write_output("Saving results to scenario %s"%scenario_id)
+
+        timesteps      = getattr(simulation, 'timesteps', None)
+
+        batch       = []
+        batch_bytes = 0
+        num_saved   = 0
+        num_skipped = 0
+        for (ref_key, name, prop), values in collect_results(simulation).iteritems():
+            if (ref_key, name, prop) not in resource_attrs:
+                num_skipped = num_skipped + 1
+                continue
+
+            resource_attr_id, attr_id = resource_attrs[(ref_key, name, prop)]
+            dataset = encode_result("%s %s"%(name or self.network.name, prop),
+                                    values,
+                                    timesteps)
+
+            if len(batch) > 0 and batch_bytes + len(dataset['value']) > self.max_upload_bytes:
+                self._save_results(scenario_id, batch)
+                num_saved   = num_saved + len(batch)
+                batch       = []
+                batch_bytes = 0
+
+            batch.append(dict(
+                resource_attr_id = resource_attr_id,
+                attr_id          = attr_id,
+                value            = dataset,
+            ))
+            batch_bytes = batch_bytes + len(dataset['value'])
+
+        if len(batch) > 0:
+            self._save_results(scenario_id, batch)
+            num_saved = num_saved + len(batch)
+
+        log.info("%s results have no matching attribute in the network", num_skipped)
+        write_output("Saved %s results"%num_saved)
+
+    def _save_results(self, scenario_id, resource_scenarios):
+        self.call('update_resourcedata',
+                             {'scenario_id'       : scenario_id,
+                              'resource_scenarios': resource_scenarios})
+
+    def write_timings(self):
+        """
+            Write the time and memory used by each phase to timings.json,
+            so it is returned with the plugin's other files.
+        """
+        write_output("Timings: %s"%self.instrumentation.summary())
+        if isinstance(self.connection, ConnectionPool):
+            write_output("Requests: %s"%self.connection.latency_summary(self.first_request))
+        file_name = os.path.join(self.target_dir, "timings.json")
+        self.instrumentation.write(file_name)
+        self.files.append(file_name)
+
     def write_network(self, network, target_dir):
+        """
+            Write the network to a JSON or XML file in target_dir. The file
+            is written a piece at a time, rather than built as one string,
+            and can be compressed with any of COMPRESSION.
+        """
         write_output("Writing network to file")
         write_progress(3, self.num_steps) 
 
         if self.as_xml is False:
             file_name = "network_%s.json"%(network['name'])
-            self.files.append(os.path.join(target_dir, file_name))
-
-            network_file = open(os.path.join(target_dir, file_name), 'w')
-            network_file.write(json.dumps(network, sort_keys=True, indent=4, separators=(',', ': ')))
+            indent = None if self.compact else 4
+            chunks = iter_json(network, indent=indent)
         else:
             file_name = "network_%s.xml"%(network['name'])
-            self.files.append(os.path.join(target_dir, file_name))
+            chunks = iter_xml({'network': network})
+
+        file_path = os.path.join(target_dir, file_name)
+        if self.compression is None:
+            network_file = open(file_path, 'w')
+        else:
+            suffix, open_file = COMPRESSION[self.compression]
+            file_path += suffix
+            network_file = open_file(file_path)
+        self.files.append(file_path)
 
-            network_file = open(os.path.join(target_dir, file_name), 'w')
-            json_network = {'network': network}
-            network_file.write(json2xml(json_network))
+        with self.instrumentation.phase('Write network'):
+            try:
+                write_chunks(network_file, chunks)
+            finally:
+                network_file.close()
 
         write_output("Network Written to %s "%(target_dir))
 
@@ -202,8 +2748,11 @@ def commandline_parser():
         """, epilog="For more information visit www.hydraplatform.org")
     parser.add_argument('-n', '--network-id',
                         help='''Specify the network_id of the network to be run.''')
-    parser.add_argument('-s', '--scenario-id',
-                        help='''Specify the ID of the scenario to be run. ''')
+    parser.add_argument('-s', '--scenario-id', action='append', nargs='+',
+                        type=parse_ids,
+                        help='''Specify the ID(s) of the scenario(s) to be
+                        run, separated by spaces or commas. Each scenario is
+                        run separately and its results saved to it.''')
     parser.add_argument('-m', '--model-dir',
                         help='''Target directory''')
     parser.add_argument('-u', '--server-url',
@@ -212,23 +2761,133 @@ def commandline_parser():
     parser.add_argument('-c', '--session-id',
                         help='''Session ID. If this does not exist, a login will be
                         attempted based on details in config.''')
+    parser.add_argument('-r', '--refresh-cache', action='store_true',
+                        help='''Ignore the cached attributes, workbook
+                        snapshot and results, rebuild them and update the
+                        cache.''')
+    parser.add_argument('-x', '--no-cache', action='store_true',
+                        help='''Do not read or write the local cache of
+                        attributes, workbook snapshots and results.''')
+    parser.add_argument('-l', '--local-snapshot', action='store_true',
+                        help='''Run from the local snapshot of the network
+                        and scenario, if there is one and the network has
+                        not changed on the server since, rather than fetch
+                        them from the server. Otherwise, fetch them and
+                        make the snapshot.''')
+    parser.add_argument('-a', '--attribute-map',
+                        help='''A JSON file mapping the attributes the
+                        model uses to its inputs. Their data is set on the
+                        model, and only their data is fetched, when it is
+                        first used.''')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='''The number of processes used to run the
+                        simulations.''')
+    parser.add_argument('-p', '--parameter', default=DEFAULT_PARAMETER,
+                        help='''The model parameter to set before running,
+                        as a path from the list of simulations. Defaults to
+                        the piped water tariff factor, %s.'''%DEFAULT_PARAMETER)
+    parser.add_argument('-v', '--values', type=parse_values,
+                        help='''The value to set the parameter to. A comma
+                        separated list or a range (start:stop:step) runs the
+                        model once for each value. A value given here
+                        overrides the scenario's data. Defaults to 2, which
+                        the scenario's data can override.''')
+    parser.add_argument('-i', '--checkpoint-every', type=int,
+                        help='''Save a checkpoint of each simulation every
+                        this many timesteps.''')
+    parser.add_argument('-e', '--resume', type=int, nargs='?', const=-1,
+                        help='''Resume each simulation from the latest
+                        checkpoint of the last run of the scenario, or the
+                        latest at or before the given timestep index. Any
+                        run which does not resume clears the checkpoints. The inputs given for this run apply
+                        from there, so a run can branch from a checkpoint.''')
+    parser.add_argument('-g', '--progress-every', type=int, default=PROGRESS_INTERVAL,
+                        help='''Write the number of timesteps run, the
+                        timesteps run per second and the estimated time
+                        remaining at most every this many seconds while the
+                        simulations run. 0 turns this off. Defaults to
+                        %s.'''%PROGRESS_INTERVAL)
+    parser.add_argument('-k', '--save-simulation', type=int,
+                        help='''When a scenario is run as more than one
+                        simulation, by a sweep or a model of several
+                        simulations, the one whose results are saved to
+                        it, counting from 0 in the order they are run: by
+                        value, then by simulation. Without it, nothing is
+                        saved to such a scenario, as only one can be.''')
+    parser.add_argument('-d', '--daemon', action='store_true',
+                        help='''Stay running, keeping the connection and
+                        the loaded simulations, and accept runs from later
+                        invocations of the app.''')
+    parser.add_argument('-f', '--profile', action='store_true',
+                        help='''Profile the run with cProfile and return
+                        the statistics in profile.pstats.''')
     return parser
 
 
-if __name__ == '__main__':
-    parser = commandline_parser()
-    args = parser.parse_args()
-    jp_runner = ModelRunner(url=args.server_url, session_id=args.session_id)
+def run(args, connection=None, preloaded_simulations=None, validate=True):
+    """
+        Run the model as described by the command line arguments and
+        return the plugin's XML response. The daemon passes in its
+        connection and the simulations it has already loaded.
+    """
+    profiler = None
+    if args.profile is True:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    #Each -s can be given more than once, and with more than one ID.
+    scenario_ids = [scenario_id for ids in args.scenario_id or []
+                                for id_list in ids
+                                for scenario_id in id_list]
+
+    cache = None
+    result_cache = None
+    if args.no_cache is False:
+        cache = PluginCache(refresh=args.refresh_cache)
+        result_cache = ResultCache(os.path.join(cache.cache_dir, 'results'),
+                                   refresh=args.refresh_cache)
+    jp_runner = ModelRunner(url=args.server_url,
+                            session_id=args.session_id,
+                            cache=cache,
+                            num_workers=args.workers,
+                            parameter=args.parameter,
+                            values=args.values,
+                            target_dir=args.model_dir,
+                            connection=connection,
+                            local_snapshot=args.local_snapshot,
+                            result_cache=result_cache,
+                            checkpoint_interval=args.checkpoint_every,
+                            resume_from=args.resume,
+                            progress_interval=args.progress_every,
+                            save_simulation=args.save_simulation)
+    jp_runner.preloaded_simulations = preloaded_simulations
     errors = []
+    warnings = []
     try:
         write_output("Starting App")
         write_progress(1, jp_runner.num_steps) 
 
-        validate_plugin_xml(os.path.join(__location__, 'plugin.xml'))
+        if validate is True:
+            validate_plugin_xml(os.path.join(__location__, 'plugin.xml'))
+
+        if args.save_simulation is not None and args.save_simulation < 0:
+            raise HydraPluginError("--save-simulation must be 0 or more, not %s"%(
+                                        args.save_simulation))
+
+        if args.attribute_map is not None:
+            jp_runner.attribute_map = load_attribute_map(args.attribute_map)
         
-        jp_runner.get_network_data(args.network_id, args.scenario_id)
+        with jp_runner.instrumentation.phase('Fetch network'):
+            jp_runner.get_network_data(args.network_id, scenario_ids)
         jp_runner.run_model()
-        message = "Model Run Complete"
+        with jp_runner.instrumentation.phase('Save results'):
+            jp_runner.export_results()
+        errors   = jp_runner.errors
+        warnings = jp_runner.warnings
+        if len(errors) > 0:
+            message = "Model Run Complete with errors"
+        else:
+            message = "Model Run Complete"
     except HydraPluginError as e:
         message="An error has occurred"
         errors = [e.message]
@@ -238,11 +2897,185 @@ if __name__ == '__main__':
         log.exception(e)
         errors = [e]
 
+    try:
+        jp_runner.write_timings()
+        if profiler is not None:
+            profiler.disable()
+            file_name = os.path.join(jp_runner.target_dir, "profile.pstats")
+            profiler.dump_stats(file_name)
+            jp_runner.files.append(file_name)
+    except IOError, e:
+        log.exception(e)
+
+    #A connection made for this run isn't used again.
+    if connection is None:
+        jp_runner.connection.close()
+
     xml_response = create_xml_response('Run Jordan Model',
                                                  args.network_id,
-                                                 [],
+                                                 scenario_ids,
                                                  errors,
-                                                 [],
+                                                 warnings,
                                                  message,
                                                  jp_runner.files)
-    print xml_response
+    return xml_response
+
+def _read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+class ClientOutput(object):
+    """
+        Stands in for sys.stdout while the daemon runs a job, sending
+        everything written straight back to the client, so it sees the
+        progress of the job as it happens. If the client has gone away,
+        the job carries on regardless.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.connected = True
+
+        #Progress is written from another thread during parallel runs.
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        with self.lock:
+            if self.connected is False:
+                return
+            try:
+                self.client.sendall(data)
+            except socket.error, e:
+                log.info("Lost the client: %s", e)
+                self.connected = False
+
+    def flush(self):
+        pass
+
+def send_to_daemon(argv, socket_path=SOCKET_PATH, output=None):
+    """
+        Pass a command line, and the directory it was run in, to the
+        daemon and write everything the daemon prints while running it
+        to output (sys.stdout by default) as it arrives. Returns False,
+        having written nothing, if there is no daemon running.
+    """
+    if output is None:
+        output = sys.stdout
+
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return False
+
+    received = False
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}))
+        client.shutdown(socket.SHUT_WR)
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            output.write(chunk)
+            output.flush()
+            received = True
+    except socket.error, e:
+        log.info("Unable to use daemon at %s: %s", socket_path, e)
+    finally:
+        client.close()
+
+    return received
+
+def serve(args, socket_path=SOCKET_PATH):
+    """
+        Run as a daemon. The connection and the loaded simulations are kept
+        between runs, which are sent by send_to_daemon and run one at a
+        time. The simulations are reloaded if the workbook changes.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise HydraPluginError("The daemon needs Unix sockets, which are "
+                               "not available on this platform.")
+
+    from jordanprototype import simulation_setup
+
+    validate_plugin_xml(os.path.join(__location__, 'plugin.xml'))
+
+    cache = None
+    if args.no_cache is False:
+        cache = PluginCache(refresh=args.refresh_cache)
+    jp_runner = ModelRunner(url=args.server_url, session_id=args.session_id, cache=cache)
+
+    workbook = find_workbook(simulation_setup)
+    def workbook_mtime():
+        if workbook is None:
+            return None
+        return os.path.getmtime(workbook)
+
+    loaded_mtime = workbook_mtime()
+    simulations  = jp_runner.load_simulations(simulation_setup)
+    os.chdir(__location__)
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    elif not os.path.exists(os.path.dirname(socket_path)):
+        os.makedirs(os.path.dirname(socket_path))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(5)
+    write_output("Listening on %s"%socket_path)
+
+    try:
+        while True:
+            client, address = server.accept()
+            stdout = sys.stdout
+            try:
+                request  = json.loads(_read_all(client))
+                job_args = commandline_parser().parse_args(request['argv'])
+
+                if workbook_mtime() != loaded_mtime:
+                    write_output("Workbook has changed. Reloading.")
+                    loaded_mtime = workbook_mtime()
+                    simulations  = jp_runner.load_simulations(simulation_setup)
+                    os.chdir(__location__)
+
+                #Runs using the same server share the connection, with
+                #the session they were given.
+                connection = None
+                if job_args.server_url == args.server_url:
+                    connection = jp_runner.connection
+                    if job_args.session_id is not None:
+                        connection.session_id = job_args.session_id
+
+                #Relative paths in the command line, and the default
+                #output directory, are the client's.
+                os.chdir(request['cwd'])
+
+                #Send back everything the run prints as it is printed, as
+                #well as the response.
+                sys.stdout = ClientOutput(client)
+                print run(job_args, connection, simulations, validate=False)
+            except (Exception, SystemExit), e:
+                log.exception(e)
+            finally:
+                sys.stdout = stdout
+                client.close()
+                os.chdir(__location__)
+    finally:
+        server.close()
+        os.remove(socket_path)
+        jp_runner.connection.close()
+
+if __name__ == '__main__':
+    parser = commandline_parser()
+    args = parser.parse_args()
+    if args.daemon is True:
+        serve(args)
+    else:
+        if send_to_daemon(sys.argv[1:]) is False:
+            print run(args)
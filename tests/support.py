@@ -0,0 +1,41 @@
+"""
+    Shared set up for the tests: puts the apps and the benchmark on the path
+    and runs the benchmark's stand-in Hydra server in a thread, so a test
+    can look at what the apps sent it.
+"""
+
+import logging
+import os, sys
+import threading
+
+__location__ = os.path.dirname(os.path.abspath(__file__))
+
+for app_dir in ('Import', 'Run', 'Benchmark'):
+    path = os.path.join(__location__, '..', app_dir)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import benchmark
+
+#The apps log failures the tests cause on purpose.
+logging.getLogger().addHandler(logging.NullHandler())
+
+class StandIn(object):
+    """
+        A stand-in server, on a free local port, whose StandInState is
+        available to the test as 'state'.
+    """
+
+    def __init__(self, latency=0, handler=benchmark.StandInHandler):
+        self.server = benchmark.StandInServer(('127.0.0.1', 0), handler)
+        self.state = benchmark.StandInState(latency)
+        self.server.state = self.state
+        self.url = "http://127.0.0.1:%s/json"%self.server.server_address[1]
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
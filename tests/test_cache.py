@@ -0,0 +1,99 @@
+"""
+    Tests of the cache of attributes and templates shared by the apps.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+import run_model
+import import_network
+
+from HydraLib.PluginLib import JSONObj
+
+class PermissiveObj(JSONObj):
+    """
+        Answers every attribute, as HydraLib's JSONObj can, which makes it
+        unpicklable.
+    """
+    def __getattr__(self, name):
+        return self.get(name)
+
+class PluginCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def check_cache(self, cache_class):
+        cache = cache_class(cache_dir=self.cache_dir)
+        attributes = [PermissiveObj({'id': 1, 'name': 'flow', 'dimension': 'dimensionless'})]
+        cache.set(('url', 'attributes', None), attributes)
+
+        cached = cache.get(('url', 'attributes', None))
+        self.assertEqual(cached, attributes)
+        self.assertEqual(cached[0].name, 'flow')
+        self.assertEqual(cache.get(('url', 'attributes', 1)), None)
+
+    def check_failures(self, cache_class):
+        cache = cache_class(cache_dir=self.cache_dir)
+
+        #Neither raises: the value is fetched from the server instead.
+        cache.set('key', object())
+        self.assertEqual(cache.get('key'), None)
+
+        with open(cache._path('broken'), 'wb') as cache_file:
+            cache_file.write('not a cache entry')
+        self.assertEqual(cache.get('broken'), None)
+
+    def test_run_cache(self):
+        self.check_cache(run_model.PluginCache)
+        self.check_failures(run_model.PluginCache)
+
+    def test_import_cache(self):
+        self.check_cache(import_network.PluginCache)
+        self.check_failures(import_network.PluginCache)
+
+    def test_cached_template(self):
+        server = support.StandIn()
+        try:
+            cache = import_network.PluginCache(cache_dir=self.cache_dir)
+            for i in range(2):
+                importer = import_network.NetworkImporter(url=server.url,
+                                                          session_id='test',
+                                                          cache=cache)
+                importer.get_template(1)
+                self.assertEqual(importer.type_name_map['Network'].template_id, 1)
+                importer.connection.close()
+            self.assertEqual(server.state.calls['get_template'], 1)
+        finally:
+            server.stop()
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_stale_entries_are_removed(self):
+        cache = run_model.ResultCache(self.cache_dir)
+        cache.set('current', [1, 2])
+        self.assertEqual(cache.get('current'), [1, 2])
+
+        #Pickled by code which has since changed or gone.
+        for key, entry in (('moved', 'crun_model\nNoSuchClass\np0\n.'),
+                           ('removed', 'cno_such_module\nSimulation\np0\n.'),
+                           ('truncated', '')):
+            with open(cache._path(key), 'wb') as result_file:
+                result_file.write(entry)
+            self.assertEqual(cache.get(key), None)
+            self.assertFalse(os.path.exists(cache._path(key)))
+
+if __name__ == '__main__':
+    unittest.main()
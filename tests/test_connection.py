@@ -0,0 +1,121 @@
+"""
+    Tests of the ConnectionPool shared by the apps, against the benchmark's
+    stand-in server.
+"""
+
+import threading
+import time
+import unittest
+
+import support
+import benchmark
+import import_network
+import run_model
+
+class CountingHandler(benchmark.StandInHandler):
+    """
+        Counts the connections the server has opened and closed.
+    """
+
+    def setup(self):
+        with self.server.lock:
+            self.server.opened += 1
+        benchmark.StandInHandler.setup(self)
+
+    def finish(self):
+        benchmark.StandInHandler.finish(self)
+        with self.server.lock:
+            self.server.closed += 1
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        #Long enough for requests made together to need a session each.
+        self.server = support.StandIn(latency=0.05, handler=CountingHandler)
+        self.server.server.lock = threading.Lock()
+        self.server.server.opened = 0
+        self.server.server.closed = 0
+
+    def tearDown(self):
+        self.server.stop()
+
+    def wait_until_closed(self, timeout=5):
+        server = self.server.server
+        end = time.time() + timeout
+        while server.closed < server.opened and time.time() < end:
+            time.sleep(0.01)
+
+    def check_pool(self, module):
+        server = self.server.server
+        pool = module.connect(self.server.url, 'test', max_connections=2)
+
+        #One at a time, the requests share a connection.
+        for i in range(3):
+            self.assertEqual(pool.call('get_all_attributes', {}), self.server.state.attributes)
+        self.assertEqual(server.opened, 1)
+
+        requests = [pool.call_async('get_template', {'template_id':benchmark.TEMPLATE_ID})
+                    for i in range(4)]
+        for request in requests:
+            self.assertEqual(request.get()['id'], benchmark.TEMPLATE_ID)
+        self.assertEqual(server.opened, 2)
+        self.assertEqual([name for name, latency in pool.latencies],
+                         ['get_all_attributes'] * 3 + ['get_template'] * 4)
+
+        pool.close()
+        self.wait_until_closed()
+        self.assertEqual(server.closed, 2)
+
+        #A closed pool opens new connections when it is used again.
+        self.assertEqual(pool.call('get_all_attributes', {}), self.server.state.attributes)
+        self.assertEqual(server.opened, 3)
+        pool.close()
+        self.wait_until_closed()
+        self.assertEqual(server.closed, 3)
+
+    def check_close_during_request(self, module):
+        server = self.server.server
+        pool = module.connect(self.server.url, 'test', max_connections=2)
+
+        request = threading.Thread(target=pool.call, args=('get_all_attributes', {}))
+        request.start()
+        time.sleep(0.02)
+        pool.close()
+        request.join()
+
+        #The session making the request is closed once it is done, and
+        #the pool still makes at most max_connections.
+        self.wait_until_closed()
+        self.assertEqual((server.opened, server.closed), (1, 1))
+        self.assertEqual(pool._sessions.qsize(), 2)
+
+    def check_fault(self, module):
+        pool = module.connect(self.server.url, 'test')
+        try:
+            pool.call('no_such_function', {})
+        except module.RequestError, e:
+            self.assertEqual(str(e), "Server:Unknown function no_such_function")
+        else:
+            self.fail("No RequestError raised")
+        pool.close()
+
+    def test_run_close_during_request(self):
+        self.check_close_during_request(run_model)
+
+    def test_import_close_during_request(self):
+        self.check_close_during_request(import_network)
+
+    def test_run_fault(self):
+        self.check_fault(run_model)
+
+    def test_import_fault(self):
+        self.check_fault(import_network)
+
+    def test_run_connection_pool(self):
+        self.check_pool(run_model)
+
+    def test_import_connection_pool(self):
+        self.check_pool(import_network)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+"""
+    Tests of the import app against the benchmark's stand-in server.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+import benchmark
+import import_network
+
+def saved_network(state, network_id):
+    """
+        The network as saved by the stand-in server, with the IDs it gave
+        each resource replaced by the resource's name, so networks saved
+        by different imports can be compared.
+    """
+    network = state.networks[network_id]
+
+    names = {}
+    for key in ('nodes', 'links', 'resourcegroups'):
+        for resource in network[key]:
+            names[resource['id']] = resource['name']
+
+    def without_ids(resource):
+        return dict((k, v) for k, v in resource.items() if k != 'id')
+
+    nodes  = dict((n['name'], without_ids(n)) for n in network['nodes'])
+    groups = dict((g['name'], without_ids(g)) for g in network['resourcegroups'])
+    links  = {}
+    for l in network['links']:
+        link = without_ids(l)
+        link['node_1_id'] = names[l['node_1_id']]
+        link['node_2_id'] = names[l['node_2_id']]
+        links[l['name']] = link
+
+    scenarios = {}
+    for s in network['scenarios']:
+        scenario = dict((k, v) for k, v in s.items()
+                        if k not in ('id', 'network_id', 'resourcegroupitems'))
+        scenario['resourcegroupitems'] = sorted((item['ref_key'],
+                                                 names[item['ref_id']],
+                                                 names[item['group_id']])
+                                                for item in s['resourcegroupitems'])
+        scenarios[s['name']] = scenario
+
+    #Each import names the network after the time it was made.
+    details = dict((k, v) for k, v in network.items()
+                   if k not in ('id', 'project_id', 'name', 'nodes', 'links',
+                                'resourcegroups', 'scenarios'))
+    return dict(details=details, nodes=nodes, links=links,
+                groups=groups, scenarios=scenarios)
+
+class ImportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = support.StandIn()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def import_network(self, num_nodes, **options):
+        network  = benchmark.synthetic_network(num_nodes)
+        importer = benchmark._import(self.server.url, network, options)
+        saved = importer.import_network(benchmark.TEMPLATE_ID, None)
+        importer.import_scenarios()
+        importer.connection.close()
+        return saved_network(self.server.state, saved.id)
+
+    def test_batched_import_saves_the_same_network(self):
+        expected = self.import_network(250)
+        self.assertEqual(len(expected['nodes']), 250)
+        self.assertEqual(len(expected['links']), 249)
+        self.assertEqual(len(expected['scenarios']), 1)
+
+        batched = self.import_network(250, batch_size=40)
+        self.assertEqual(batched, expected)
+        self.assertGreater(self.server.state.calls['add_nodes'], 1)
+
+    def test_streamed_import_saves_the_same_network(self):
+        expected = self.import_network(250)
+        self.assertEqual(self.import_network(250, stream=True), expected)
+        self.assertEqual(self.import_network(250, stream=True, batch_size=40), expected)
+
+    def simulations(self, num_nodes, num_simulations):
+        """
+            Simulations of the same synthetic network, as the workbook
+            would give them.
+        """
+        return [benchmark.Component("Simulation %s"%i, 'Simulation',
+                                    network=benchmark.synthetic_network(num_nodes))
+                for i in range(num_simulations)]
+
+    def test_each_simulation_is_a_scenario(self):
+        simulations = self.simulations(50, 2)
+        #The second simulation moves a node to another institution.
+        institutions = simulations[1].network.institutions
+        node = institutions[0].nodes.pop()
+        institutions[1].nodes.append(node)
+
+        importer = import_network.NetworkImporter(url=self.server.url, session_id='test')
+        importer.prepare(benchmark.TEMPLATE_ID, preloaded_simulations=simulations)
+        saved = importer.import_network(benchmark.TEMPLATE_ID, None)
+        importer.import_scenarios()
+        importer.connection.close()
+
+        network = saved_network(self.server.state, saved.id)
+        self.assertEqual(sorted(network['scenarios']), ["Simulation 0", "Simulation 1"])
+        first  = set(network['scenarios']["Simulation 0"]['resourcegroupitems'])
+        second = set(network['scenarios']["Simulation 1"]['resourcegroupitems'])
+        self.assertEqual(first - second, set([('NODE', node.name, institutions[0].name)]))
+        self.assertEqual(second - first, set([('NODE', node.name, institutions[1].name)]))
+
+    def import_simulations(self, simulations, network_id=None):
+        """
+            Import the simulations as a new network, or update the network
+            with network_id to match them. Returns the network's ID.
+        """
+        importer = import_network.NetworkImporter(url=self.server.url, session_id='test')
+        importer.prepare(benchmark.TEMPLATE_ID,
+                         fetch_project=network_id is None,
+                         preloaded_simulations=simulations)
+        if network_id is None:
+            saved = importer.import_network(benchmark.TEMPLATE_ID, None)
+            importer.import_scenarios()
+        else:
+            saved = importer.update_network(benchmark.TEMPLATE_ID, network_id)
+        importer.connection.close()
+        return saved.id
+
+    def test_updated_network_matches_a_new_import(self):
+        network_id = self.import_simulations(self.simulations(250, 2))
+        before = saved_network(self.server.state, network_id)
+
+        simulation = self.simulations(250, 1)[0]
+        network = simulation.network
+        nodes, links, institutions = network.nodes, network.links, network.institutions
+        group = institutions[-1]
+
+        #Move a node, add a node and a link to it, and remove the last
+        #node and its link.
+        nodes[0].x = 500
+        new_node = benchmark.Component("New node", benchmark.NODE_TYPES[0], x=1, y=1)
+        new_link = benchmark.Component("New link", benchmark.LINK_TYPES[0],
+                                       start_node=nodes[1], end_node=new_node)
+        nodes.append(new_node)
+        links.append(new_link)
+        institutions[0].nodes.append(new_node)
+        institutions[0].links.append(new_link)
+        removed_node = nodes.pop(-2)
+        removed_link = links.pop(-2)
+        institutions[2].nodes.remove(removed_node)
+        institutions[2].links.remove(removed_link)
+
+        #Replace an institution with a new one.
+        removed_group = institutions.pop(1)
+        group.institutions.remove(removed_group)
+        new_group = benchmark.Component("New institution", benchmark.GROUP_TYPES[0],
+                                        nodes=nodes[5:7], links=[], institutions=[])
+        institutions.insert(0, new_group)
+        group.institutions.append(new_group)
+
+        self.assertEqual(self.import_simulations([simulation], network_id), network_id)
+        updated = saved_network(self.server.state, network_id)
+        expected = saved_network(self.server.state,
+                                 self.import_simulations([simulation]))
+
+        for key in ('details', 'nodes', 'links', 'groups'):
+            self.assertEqual(updated[key], expected[key])
+        self.assertEqual(self.server.state.calls['update_node'], 1)
+
+        #The single simulation updates the first scenario.
+        self.assertEqual(updated['scenarios']["Simulation 0"]['resourcegroupitems'],
+                         expected['scenarios']["Baseline"]['resourcegroupitems'])
+
+        #The other scenario only loses the items of removed resources.
+        removed = set([removed_node.name, removed_link.name, removed_group.name])
+        self.assertEqual(updated['scenarios']["Simulation 1"]['resourcegroupitems'],
+                         [item for item in before['scenarios']["Simulation 1"]['resourcegroupitems']
+                          if item[1] not in removed and item[2] not in removed])
+
+    def test_coordinates_are_sent_as_given(self):
+        simulation, = self.simulations(5, 1)
+        nodes = simulation.network.nodes
+        nodes[1].y = 900000
+        nodes[2].y = 500000.5
+        network_id = self.import_simulations([simulation])
+
+        saved = saved_network(self.server.state, network_id)['nodes']
+        self.assertEqual([(saved[n.name]['x'], saved[n.name]['y']) for n in nodes],
+                         [('0', '0'), ('1', '-100000'), ('2', '100000.5'),
+                          ('3', '0'), ('4', '0')])
+
+        #So an update from the same simulation changes nothing.
+        self.import_simulations([simulation], network_id)
+        self.assertNotIn('update_node', self.server.state.calls)
+
+    def test_simulations_must_share_a_network(self):
+        simulations = self.simulations(50, 2)
+        network = simulations[1].network
+        network.nodes.append(benchmark.Component("Extra node", benchmark.NODE_TYPES[0],
+                                                 x=0, y=0))
+        network.institutions[0].nodes.append(network.nodes[-1])
+
+        importer = import_network.NetworkImporter(url=self.server.url, session_id='test')
+        try:
+            importer.prepare(benchmark.TEMPLATE_ID, preloaded_simulations=simulations)
+        except import_network.HydraPluginError, e:
+            self.assertIn("Simulation 1 has node Extra node", e.message)
+        else:
+            self.fail("No HydraPluginError raised")
+        importer.connection.close()
+        self.assertNotIn('add_project', self.server.state.calls)
+
+    def check_resumed_import(self, func, failing_call):
+        """
+            Import two simulations, with the failing_call'th request to
+            func failing, then resume the import and check it saved the
+            same network as an import which did not fail, once.
+        """
+        state = self.server.state
+        add = getattr(state, func)
+        calls = []
+        def fail(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == failing_call:
+                raise ValueError("Connection lost")
+            return add(**kwargs)
+        setattr(state, func, fail)
+
+        #Without a cache, the journal is kept in the current directory.
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(work_dir)
+
+        argv = ['-u', self.server.url, '-c', 'test', '-t', str(benchmark.TEMPLATE_ID),
+                '-x', '-b', '40']
+        simulations = self.simulations(250, 2)
+        response = import_network.run(import_network.commandline_parser().parse_args(argv),
+                                      preloaded_simulations=simulations, validate=False)
+        self.assertIn("Connection lost", response)
+        self.assertEqual(len(state.networks), 1)
+
+        setattr(state, func, add)
+        response = import_network.run(import_network.commandline_parser().parse_args(argv + ['-e']),
+                                      preloaded_simulations=simulations, validate=False)
+        self.assertIn("Import Complete", response)
+        self.assertEqual([f for f in os.listdir(work_dir) if f.endswith('.journal')], [])
+
+        self.assertEqual(state.calls['add_project'], 1)
+        self.assertEqual(len(state.networks), 1)
+        network_id, network = state.networks.items()[0]
+        for key in ('nodes', 'links', 'resourcegroups', 'scenarios'):
+            names = [r['name'] for r in network[key]]
+            self.assertEqual(len(names), len(set(names)))
+
+        resumed = saved_network(state, network_id)
+        self.assertEqual(resumed, saved_network(state, self.import_simulations(simulations)))
+
+    def test_resumed_import_after_a_failed_batch(self):
+        self.check_resumed_import('add_links', 2)
+
+    def test_resumed_import_after_a_failed_scenario(self):
+        self.check_resumed_import('add_scenario', 2)
+
+    def test_failed_preparation_creates_no_project(self):
+        importer = import_network.NetworkImporter(url=self.server.url, session_id='test')
+        #No simulations, as if the workbook could not be read.
+        self.assertRaises(IndexError, importer.prepare, benchmark.TEMPLATE_ID,
+                          preloaded_simulations=[])
+        importer.connection.close()
+        self.assertNotIn('add_project', self.server.state.calls)
+
+        importer = import_network.NetworkImporter(url=self.server.url, session_id='test')
+        importer.prepare(benchmark.TEMPLATE_ID,
+                         preloaded_simulations=[benchmark.SyntheticSimulation("Sim", 2)])
+        project = importer.get_project(None)
+        importer.connection.close()
+        self.assertEqual(self.server.state.calls['add_project'], 1)
+        self.assertIn(project.id, self.server.state.projects)
+
+if __name__ == '__main__':
+    unittest.main()
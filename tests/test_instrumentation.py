@@ -0,0 +1,97 @@
+"""
+    Tests of the Instrumentation shared by the apps, which records the time
+    and memory of each phase of a run.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import support
+import import_network
+import run_model
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.target_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.target_dir)
+
+    def check_phases(self, module):
+        instrumentation = module.Instrumentation()
+        with instrumentation.phase('Sleep'):
+            time.sleep(0.05)
+        phase, = instrumentation.phases
+        self.assertTrue(phase['wall_time'] >= 0.05)
+        self.assertTrue(phase['cpu_time'] < phase['wall_time'])
+        if module.resource is not None:
+            self.assertTrue(phase['max_rss_so_far'] > 0)
+            self.assertTrue(phase['max_rss_increase'] >= 0)
+
+        #The process's memory by the end of each phase, and how much
+        #each raised it, from measurements of (wall, cpu, max_rss).
+        measurements = iter([(0, 0, 1000), (2, 1, 5000),
+                             (2, 1, 5000), (3, 1, 5000),
+                             (3, 1, 5000), (4, 2, 6000)])
+        original_measure = module.measure
+        module.measure = lambda: measurements.next()
+        self.addCleanup(setattr, module, 'measure', original_measure)
+
+        instrumentation = module.Instrumentation()
+        with instrumentation.phase('Allocate'):
+            pass
+        with instrumentation.phase('Reuse'):
+            pass
+        try:
+            with instrumentation.phase('Fail'):
+                raise ValueError("Phase failed")
+        except ValueError:
+            pass
+
+        self.assertEqual([(p['phase'], p['wall_time'], p['cpu_time'],
+                           p['max_rss_so_far'], p['max_rss_increase'])
+                          for p in instrumentation.phases],
+                         [('Allocate', 2, 1, 5000, 4000),
+                          ('Reuse', 1, 0, 5000, 0),
+                          ('Fail', 1, 1, 6000, 1000)])
+
+        #Without the memory, only the times are recorded.
+        measurements = iter([(0, 0, None), (1, 1, None)])
+        instrumentation = module.Instrumentation()
+        with instrumentation.phase('Unmeasured'):
+            pass
+        self.assertEqual(instrumentation.phases[0]['max_rss_so_far'], None)
+        self.assertEqual(instrumentation.phases[0]['max_rss_increase'], None)
+
+    def check_summary(self, module):
+        instrumentation = module.Instrumentation()
+        instrumentation.add('Request', 1.0, 0.5, 100, 10)
+        instrumentation.add('Parse', 2.0, 2.0, 200, 100)
+        instrumentation.add('Request', 0.5, 0.25, 200, 0)
+        self.assertEqual(instrumentation.summary(),
+                         "Request (x2): 1.50s, Parse: 2.00s")
+
+        file_name = os.path.join(self.target_dir, 'timings.json')
+        instrumentation.write(file_name)
+        with open(file_name) as timings_file:
+            self.assertEqual(json.load(timings_file), instrumentation.phases)
+
+    def test_run_phases(self):
+        self.check_phases(run_model)
+
+    def test_import_phases(self):
+        self.check_phases(import_network)
+
+    def test_run_summary(self):
+        self.check_summary(run_model)
+
+    def test_import_summary(self):
+        self.check_summary(import_network)
+
+if __name__ == '__main__':
+    unittest.main()
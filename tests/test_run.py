@@ -0,0 +1,475 @@
+"""
+    Tests of the run app against the benchmark's stand-in server, using the
+    benchmark's synthetic simulations in place of the prototype's.
+"""
+
+import bz2
+import copy
+import gzip
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+import unittest
+
+import support
+import benchmark
+import run_model
+
+class FailingSimulation(benchmark.SyntheticSimulation):
+
+    def start(self):
+        raise ValueError("Simulation failed on purpose")
+
+class UntimedSimulation(benchmark.SyntheticSimulation):
+
+    def __init__(self, name, num_nodes):
+        benchmark.SyntheticSimulation.__init__(self, name, num_nodes)
+        self.timesteps = None
+
+    def start(self):
+        for timestep_index in range(benchmark.RUN_TIMESTEPS):
+            self.network.set_timestep(timestep_index, timestep_index)
+            self.network.step()
+
+class UnreturnableSimulation(benchmark.SyntheticSimulation):
+
+    def start(self):
+        benchmark.SyntheticSimulation.start(self)
+        #Can't be pickled back from the worker.
+        self.network.callback = lambda: None
+
+class RunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = support.StandIn()
+        self.target_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.target_dir)
+
+    def runner(self, simulations, **kwargs):
+        runner = run_model.ModelRunner(url=self.server.url,
+                                       session_id='test',
+                                       target_dir=self.target_dir,
+                                       **kwargs)
+        runner.preloaded_simulations = simulations
+        return runner
+
+    def check_failure_isolated(self, num_workers):
+        simulations = [benchmark.SyntheticSimulation("First", 10),
+                       FailingSimulation("Failing", 10),
+                       benchmark.SyntheticSimulation("Last", 10)]
+        runner = self.runner(simulations, num_workers=num_workers)
+        runner.run_model()
+
+        self.assertEqual(len(runner.errors), 1)
+        self.assertIn("Failing", runner.errors[0])
+        self.assertIn("Simulation failed on purpose", runner.errors[0])
+        for index in (0, 2):
+            history = runner.simulations[index].network.nodes[0]._history['demand']
+            self.assertEqual(len(history), benchmark.RUN_TIMESTEPS)
+
+    def test_failed_simulation_is_isolated(self):
+        self.check_failure_isolated(1)
+
+    def test_failed_simulation_is_isolated_in_parallel(self):
+        self.check_failure_isolated(2)
+
+    def test_unreturned_simulations_are_not_cached(self):
+        simulations = [benchmark.SyntheticSimulation("First", 3),
+                       UnreturnableSimulation("Unreturnable", 3)]
+        result_cache = run_model.ResultCache(os.path.join(self.target_dir, 'results'))
+        runner = self.runner(simulations, num_workers=2, result_cache=result_cache)
+        network_id, scenario_id = self.add_network(runner, 3)
+        runner.get_network_data(network_id, scenario_id)
+        runner.run_model()
+
+        self.assertEqual(runner.errors, [])
+        self.assertEqual(len(runner.warnings), 1)
+        self.assertEqual(runner.scenario_results[scenario_id][1], None)
+        self.assertEqual(os.listdir(result_cache.cache_dir), [])
+
+    def test_daemon_runs_each_job_with_its_session(self):
+        simulations = [benchmark.SyntheticSimulation("Daemon", 2)]
+        network_id, scenario_id = self.add_network(self.runner([]), 2)
+
+        #The daemon's simulations, and every connection it makes.
+        connections = []
+        def connect(*args, **kwargs):
+            connections.append(args)
+            return original_connect(*args, **kwargs)
+        original_connect = run_model.connect
+        original_load = run_model.ModelRunner.load_simulations
+        run_model.connect = connect
+        run_model.ModelRunner.load_simulations = lambda runner, setup: copy.deepcopy(simulations)
+        self.addCleanup(setattr, run_model, 'connect', original_connect)
+        self.addCleanup(setattr, run_model.ModelRunner, 'load_simulations', original_load)
+        self.addCleanup(os.chdir, os.getcwd())
+
+        socket_path = os.path.join(self.target_dir, 'run.sock')
+        args = run_model.commandline_parser().parse_args(['-u', self.server.url,
+                                                          '-c', 'daemon', '-x', '-d'])
+        daemon = threading.Thread(target=run_model.serve, args=(args, socket_path))
+        daemon.daemon = True
+        daemon.start()
+        end = time.time() + 10
+        while not os.path.exists(socket_path) and time.time() < end:
+            time.sleep(0.01)
+
+        sessions = self.server.state.sessions
+        before = set(sessions)
+        self.server.state.expired_sessions.add('expired')
+        for session_id in ('first', 'expired'):
+            output = StringIO.StringIO()
+            argv = ['-u', self.server.url, '-c', session_id, '-x', '-m', self.target_dir,
+                    '-n', str(network_id), '-s', str(scenario_id)]
+            self.assertTrue(run_model.send_to_daemon(argv, socket_path, output))
+            self.assertIn("Model Run Complete", output.getvalue())
+            self.assertNotIn("with errors", output.getvalue())
+
+        #Both jobs used the daemon's connection, the first with its own
+        #session and the second with a new login once its own was refused.
+        self.assertEqual(len(connections), 1)
+        self.assertTrue(sessions['first'] > 1)
+        self.assertEqual(sessions['expired'], 1)
+        logged_in = set(sessions) - before - set(['first', 'expired', None])
+        self.assertEqual(len(logged_in), 1)
+
+    def test_sweep_summary_has_each_values_results(self):
+        simulations = [benchmark.SyntheticSimulation("Sweep", 3)]
+        runner = self.runner(simulations, values=[1.0, 4.0])
+        runner.run_model()
+
+        with open(os.path.join(self.target_dir, 'sweep_summary.json')) as summary_file:
+            summary = json.load(summary_file)
+        self.assertEqual([run['value'] for run in summary], [1.0, 4.0])
+
+        finals = []
+        for run in summary:
+            self.assertEqual(run['status'], 'finished')
+            self.assertEqual([(r['resource'], r['property']) for r in run['results']],
+                             [("Node 0", 'demand'), ("Node 1", 'demand'), ("Node 2", 'demand')])
+            result = run['results'][1]
+            self.assertTrue(result['min'] <= result['mean'] <= result['max'])
+            finals.append(result['final'])
+        self.assertNotEqual(finals[0], finals[1])
+
+    def add_network(self, runner, num_nodes, attributes=None, resourcescenarios=None):
+        """
+            Add a network of num_nodes nodes, each with a demand attribute,
+            and a scenario, to the stand-in. The network can be given
+            attributes, and the scenario data. Returns their IDs.
+        """
+        nodes = [dict(id=-i - 1, name="Node %s"%i, x=i, y=0,
+                      attributes=[dict(id=i + 1, attr_id=3)])
+                 for i in range(num_nodes)]
+        network = dict(name="Export", nodes=nodes, links=[], resourcegroups=[],
+                       attributes=attributes or [], types=[dict(name='Network',
+                                                  template_id=benchmark.TEMPLATE_ID)])
+        network_id = runner.call('add_network', {'net':network}).id
+        scenario = dict(name="Baseline", resourcescenarios=resourcescenarios or [])
+        scenario_id = runner.call('add_scenario', {'network_id':network_id,
+                                                   'scen':scenario}).id
+        return network_id, scenario_id
+
+    def export(self, simulations, num_nodes, **kwargs):
+        """
+            Run the simulations against a network of the stand-in and save
+            their results. Returns the runner and the arguments of each
+            update_resourcedata request.
+        """
+        updates = []
+        def update_resourcedata(scenario_id, resource_scenarios):
+            updates.append((scenario_id, resource_scenarios))
+            return []
+        self.server.state.update_resourcedata = update_resourcedata
+
+        runner = self.runner(simulations, **kwargs)
+        network_id, scenario_id = self.add_network(runner, num_nodes)
+        runner.get_network_data(network_id, scenario_id)
+        runner.run_model()
+        runner.export_results()
+        return runner, scenario_id, updates
+
+    def test_results_are_saved_in_batches(self):
+        simulation = benchmark.SyntheticSimulation("Export", 5)
+        max_upload_bytes = 800
+        runner, scenario_id, updates = self.export([simulation], 5,
+                                                   max_upload_bytes=max_upload_bytes)
+
+        self.assertTrue(len(updates) > 1)
+        saved = {}
+        for update_scenario_id, resource_scenarios in updates:
+            self.assertEqual(update_scenario_id, scenario_id)
+            self.assertTrue(sum(len(rs['value']['value']) for rs in resource_scenarios)
+                            <= max_upload_bytes)
+            for rs in resource_scenarios:
+                self.assertEqual(rs['attr_id'], 3)
+                saved[rs['resource_attr_id']] = rs['value']
+
+        self.assertEqual(sorted(saved), [1, 2, 3, 4, 5])
+        history = runner.simulations[0].network.nodes[2]._history['demand']
+        dataset = saved[3]
+        self.assertEqual(dataset['name'], "Node 2 demand")
+        self.assertEqual(dataset['type'], 'timeseries')
+        ts = json.loads(dataset['value'])['0']
+        self.assertEqual([ts[str(t)] for t in range(benchmark.RUN_TIMESTEPS)], history)
+
+    def test_results_without_timesteps_are_saved_as_arrays(self):
+        simulation = UntimedSimulation("Export", 2)
+        runner, scenario_id, updates = self.export([simulation], 2)
+
+        self.assertEqual(len(updates), 1)
+        for rs in updates[0][1]:
+            node = runner.simulations[0].network.nodes[rs['resource_attr_id'] - 1]
+            self.assertEqual(rs['value']['type'], 'array')
+            self.assertEqual(json.loads(rs['value']['value']), node._history['demand'])
+
+    def test_sweep_results_need_a_simulation_chosen(self):
+        simulations = [benchmark.SyntheticSimulation("Sweep", 2)]
+        runner, scenario_id, updates = self.export(simulations, 2, values=[1.0, 4.0])
+        self.assertEqual(updates, [])
+        self.assertEqual(len(runner.warnings), 1)
+        self.assertIn("--save-simulation", runner.warnings[0])
+
+        runner, scenario_id, updates = self.export(simulations, 2, values=[1.0, 4.0],
+                                                   save_simulation=1)
+        saved = dict((rs['resource_attr_id'], json.loads(rs['value']['value'])['0'])
+                     for rs in updates[0][1])
+        chosen = runner.scenario_results[scenario_id][1]
+        self.assertEqual(chosen.network.exogenous_inputs.amman_model_user_input_params[0], 4.0)
+        self.assertEqual([saved[2][str(t)] for t in range(benchmark.RUN_TIMESTEPS)],
+                         chosen.network.nodes[1]._history['demand'])
+
+    def write_network(self, network, **kwargs):
+        """
+            Write the network with the options given, and return what was
+            written, uncompressed.
+        """
+        runner = self.runner([], **kwargs)
+        runner.write_network(network, self.target_dir)
+        path, = runner.files
+        open_file = dict(gzip=gzip.open, bz2=bz2.BZ2File).get(kwargs.get('compression'), open)
+        network_file = open_file(path, 'rb')
+        try:
+            return network_file.read()
+        finally:
+            network_file.close()
+            os.remove(path)
+
+    def test_written_network_reads_back_the_same(self):
+        network = benchmark.hydra_network(250)
+        network['description'] = u'Caf\xe9'
+        for compression in (None, 'gzip', 'bz2'):
+            text = self.write_network(network, compression=compression)
+            self.assertEqual(text, json.dumps(network, sort_keys=True, indent=4,
+                                              separators=(',', ': ')))
+            self.assertEqual(json.loads(text), network)
+
+            text = self.write_network(network, compact=True, compression=compression)
+            self.assertEqual(json.loads(text), network)
+            self.assertNotIn('\n', text)
+
+            text = self.write_network(network, as_xml=True, compression=compression)
+            self.assertEqual(text.decode('utf-8'), run_model.json2xml({'network': network}))
+
+    def test_snapshot_is_refetched_once_the_network_changes(self):
+        cache = run_model.PluginCache(cache_dir=os.path.join(self.target_dir, 'cache'))
+        def fetch():
+            runner = self.runner([], cache=cache, local_snapshot=True)
+            calls = self.server.state.calls.get('get_network', 0)
+            runner.get_network_data(network_id, scenario_id)
+            return runner.network, self.server.state.calls['get_network'] - calls
+
+        network_id, scenario_id = self.add_network(self.runner([]), 3)
+        network, num_calls = fetch()
+        self.assertEqual(num_calls, 2)
+
+        #Only the stamp is fetched while the snapshot is current.
+        network, num_calls = fetch()
+        self.assertEqual(num_calls, 1)
+        self.assertEqual(len(network.nodes), 3)
+
+        self.server.state.add_nodes(network_id, [dict(name="Node 3", x=3, y=0)])
+        network, num_calls = fetch()
+        self.assertEqual(num_calls, 2)
+        self.assertEqual(len(network.nodes), 4)
+
+    def test_snapshot_gives_the_same_network(self):
+        times = ["2015-%02d-01 00:00:00"%(m + 1) for m in range(3)]
+        values = [
+            dict(type='scalar', value='2.5'),
+            dict(type='timeseries', value=json.dumps({'0': dict((t, i + 0.5)
+                                                          for i, t in enumerate(times))})),
+            dict(type='descriptor', value=u'Caf\xe9'),
+            dict(type='array', value='[1, 2]'),
+        ]
+        datasets = [dict(resource_attr_id=i + 1, attr_id=3, value=dict(value, name="D%s"%i))
+                    for i, value in enumerate(values)]
+        network_id, scenario_id = self.add_network(self.runner([]), 4,
+                                                   resourcescenarios=datasets)
+        #The server gives coordinates as strings.
+        for node in self.server.state.networks[network_id]['nodes']:
+            node['x'], node['y'] = str(node['x']), str(node['y'])
+
+        cache = run_model.PluginCache(cache_dir=os.path.join(self.target_dir, 'cache'))
+        runners = [self.runner([]), self.runner([], cache=cache, local_snapshot=True),
+                   self.runner([], cache=cache, local_snapshot=True)]
+        for runner in runners:
+            runner.get_network_data(network_id, scenario_id)
+        live, saved, snapshot = runners
+        self.assertEqual(self.server.state.calls['get_network'], 4)
+
+        self.assertEqual(run_model.layout_hash(snapshot.network),
+                         run_model.layout_hash(live.network))
+        self.assertEqual(snapshot.network.nodes[2].x, 2.0)
+        data = snapshot.scenario_data[scenario_id]
+        for ra_id in range(1, 5):
+            self.assertEqual(data.get(ra_id, 3), live.scenario_data[scenario_id].get(ra_id, 3))
+        self.assertEqual(data.get(5, 3), None)
+        self.assertEqual([rs['value']['name'] for rs in snapshot.network.scenarios[0].resourcescenarios],
+                         ["D0", "D1", "D2", "D3"])
+
+    def run_with_scenario_parameter(self, **kwargs):
+        """
+            Run a simulation whose scenario sets the parameter, through
+            the attribute map, to 3.5. Returns the value it ran with.
+        """
+        runner = self.runner([benchmark.SyntheticSimulation("Scenario", 2)], **kwargs)
+        parameter = [dict(resource_attr_id=100, attr_id=1,
+                          value=dict(type='scalar', value='3.5'))]
+        network_id, scenario_id = self.add_network(runner, 2,
+                                                   attributes=[dict(id=100, attr_id=1)],
+                                                   resourcescenarios=parameter)
+        runner.attribute_map = {
+            'NETWORK': {'flow': 'exogenous_inputs.amman_model_user_input_params[0]'},
+        }
+        runner.get_network_data(network_id, scenario_id)
+        runner.run_model()
+        self.assertEqual(runner.errors, [])
+        return run_model.get_parameter(runner.simulations, run_model.DEFAULT_PARAMETER)
+
+    def test_scenario_data_overrides_the_default_value(self):
+        self.assertEqual(self.run_with_scenario_parameter(), 3.5)
+
+    def test_given_value_overrides_the_scenario_data(self):
+        self.assertEqual(self.run_with_scenario_parameter(values=[4.0]), 4.0)
+
+    def check_scenario_results(self, num_workers):
+        updates = []
+        def update_resourcedata(scenario_id, resource_scenarios):
+            updates.append(scenario_id)
+            return []
+        self.server.state.update_resourcedata = update_resourcedata
+
+        simulations = [benchmark.SyntheticSimulation("Scenario", 2),
+                       FailingSimulation("Failing", 2)]
+        runner = self.runner(simulations, num_workers=num_workers, save_simulation=0)
+        runner.attribute_map = {
+            'NETWORK': {'flow': 'exogenous_inputs.amman_model_user_input_params[0]'},
+        }
+
+        #Each scenario sets the parameter to its own value.
+        values = [2.0, 3.5]
+        parameters = [[dict(resource_attr_id=100, attr_id=1,
+                            value=dict(type='scalar', value=repr(value)))]
+                      for value in values]
+        network_id, first_id = self.add_network(runner, 2,
+                                                attributes=[dict(id=100, attr_id=1)],
+                                                resourcescenarios=parameters[0])
+        second_id = runner.call('add_scenario', {'network_id':network_id,
+                                                 'scen':dict(name="Other",
+                                                             resourcescenarios=parameters[1])}).id
+
+        runner.get_network_data(network_id, [first_id, second_id])
+        runner.run_model()
+        runner.export_results()
+
+        self.assertEqual(len(runner.errors), 2)
+        self.assertEqual(runner.scenario_results.keys(), [first_id, second_id])
+        finals = []
+        for scenario_id, value in zip([first_id, second_id], values):
+            finished, failed = runner.scenario_results[scenario_id]
+            self.assertEqual(failed, None)
+            self.assertEqual(run_model.get_parameter([finished], run_model.DEFAULT_PARAMETER),
+                             value)
+            finals.append(finished.network.nodes[1].demand)
+        self.assertNotEqual(finals[0], finals[1])
+        self.assertEqual(sorted(updates), sorted([first_id, second_id]))
+
+    def test_each_scenario_has_its_results(self):
+        self.check_scenario_results(1)
+
+    def test_each_scenario_has_its_results_in_parallel(self):
+        self.check_scenario_results(2)
+
+    def test_only_the_last_runs_checkpoints_are_resumed(self):
+        network_id, scenario_id = self.add_network(self.runner([]), 2)
+        def run(**kwargs):
+            runner = self.runner([benchmark.SyntheticSimulation("Checkpointed", 2)], **kwargs)
+            runner.get_network_data(network_id, scenario_id)
+            runner.run_model()
+            checkpoint_dir = runner.checkpoint_dir(scenario_id)
+            if not os.path.exists(checkpoint_dir):
+                return []
+            return sorted(os.listdir(checkpoint_dir))
+
+        self.assertEqual(run(checkpoint_interval=4),
+                         ['0_4.checkpoint', '0_8.checkpoint'])
+
+        #Branching from an earlier checkpoint drops the later ones.
+        self.assertEqual(run(resume_from=4), ['0_4.checkpoint'])
+
+        #A run which does not resume leaves nothing to resume from.
+        self.assertEqual(run(), [])
+
+    def test_resumed_progress_counts_the_remaining_timesteps(self):
+        checkpoints = run_model.Checkpoints(os.path.join(self.target_dir, 'checkpoints'), 4)
+        run_model.run_attached(benchmark.SyntheticSimulation("Resumed", 2), 0, checkpoints)
+
+        simulations = [benchmark.SyntheticSimulation("Resumed", 2)]
+        checkpoints.restore(simulations, 8)
+        self.assertEqual(checkpoints.offset(0), 8)
+
+        progress = run_model.Progress(interval=0)
+        progress.add(0, "Resumed", len(simulations[0].timesteps))
+        updates = []
+        def update(key, completed):
+            updates.append(completed)
+        progress.update = update
+        run_model.run_attached(simulations[0], 0, checkpoints, progress, 0)
+
+        remaining = benchmark.RUN_TIMESTEPS - 8
+        self.assertEqual(progress.totals[0], remaining)
+        self.assertEqual(updates, range(remaining) + [remaining])
+        self.assertEqual(len(simulations[0].network.nodes[0]._history['demand']),
+                         benchmark.RUN_TIMESTEPS)
+
+class ParseValuesTest(unittest.TestCase):
+
+    def test_lists(self):
+        self.assertEqual(run_model.parse_values('1,2.5,4'), [1.0, 2.5, 4.0])
+
+    def test_ranges(self):
+        self.assertEqual(run_model.parse_values('1:2:0.5'), [1.0, 1.5, 2.0])
+        self.assertEqual(run_model.parse_values('0:1:0.1')[-1], 1.0)
+        self.assertEqual(len(run_model.parse_values('0:1:0.1')), 11)
+        self.assertEqual(run_model.parse_values('3:3:1'), [3.0])
+
+    def test_ranges_stop_before_passing_stop(self):
+        values = run_model.parse_values('1:2:0.4')
+        self.assertEqual(len(values), 3)
+        self.assertTrue(values[-1] <= 2.0)
+
+    def test_bad_ranges(self):
+        self.assertRaises(ValueError, run_model.parse_values, '3:1:0.5')
+        self.assertRaises(ValueError, run_model.parse_values, '1:3:0')
+        self.assertRaises(ValueError, run_model.parse_values, '1:3:-1')
+
+if __name__ == '__main__':
+    unittest.main()
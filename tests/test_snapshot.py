@@ -0,0 +1,101 @@
+"""
+    Tests of the SimulationSnapshot shared by the apps, which saves the
+    simulations loaded from a workbook so later runs can skip parsing it.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+import benchmark
+import import_network
+import run_model
+
+class SimulationSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.workbook = os.path.join(self.snapshot_dir, 'models_input.xlsx')
+        with open(self.workbook, 'wb') as workbook_file:
+            workbook_file.write('Workbook')
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+
+    def simulations(self):
+        simulations = [benchmark.SyntheticSimulation("First", 3),
+                       benchmark.SyntheticSimulation("Second", 5)]
+        simulations[1].start()
+        return simulations
+
+    def check_round_trip(self, module):
+        simulations = self.simulations()
+        snapshot = module.SimulationSnapshot(self.workbook, 'test', self.snapshot_dir)
+        self.assertEqual(snapshot.load(), None)
+        snapshot.save(simulations)
+
+        loaded = module.SimulationSnapshot(self.workbook, 'test', self.snapshot_dir).load()
+        self.assertEqual([s.name for s in loaded], ["First", "Second"])
+        for simulation, loaded_simulation in zip(simulations, loaded):
+            self.assertEqual(loaded_simulation.timesteps, simulation.timesteps)
+            self.assertEqual([(n.name, n.component_type, n.demand, n._history)
+                              for n in loaded_simulation.network.nodes],
+                             [(n.name, n.component_type, n.demand, n._history)
+                              for n in simulation.network.nodes])
+
+        #Snapshots of the same workbook under other names are kept apart,
+        #and refreshing one ignores it.
+        self.assertEqual(module.SimulationSnapshot(self.workbook, 'other',
+                                                   self.snapshot_dir).load(), None)
+        self.assertEqual(module.SimulationSnapshot(self.workbook, 'test', self.snapshot_dir,
+                                                   refresh=True).load(), None)
+
+    def check_changed_workbook(self, module):
+        module.SimulationSnapshot(self.workbook, 'test', self.snapshot_dir).save(
+                                                                    self.simulations())
+        mtime = os.path.getmtime(self.workbook)
+
+        #Changed, but with the same modification time.
+        with open(self.workbook, 'wb') as workbook_file:
+            workbook_file.write('Changed')
+        os.utime(self.workbook, (mtime, mtime))
+        self.assertEqual(module.SimulationSnapshot(self.workbook, 'test',
+                                                   self.snapshot_dir).load(), None)
+
+        #Saved again, then only touched.
+        module.SimulationSnapshot(self.workbook, 'test', self.snapshot_dir).save(
+                                                                    self.simulations())
+        os.utime(self.workbook, (mtime + 10, mtime + 10))
+        self.assertEqual(module.SimulationSnapshot(self.workbook, 'test',
+                                                   self.snapshot_dir).load(), None)
+
+    def check_unpicklable(self, module):
+        simulations = self.simulations()
+        simulations[0].network.callback = lambda: None
+        snapshot = module.SimulationSnapshot(self.workbook, 'test', self.snapshot_dir)
+        snapshot.save(simulations)
+        self.assertFalse(os.path.exists(snapshot.path))
+        self.assertEqual(snapshot.load(), None)
+
+    def test_run_round_trip(self):
+        self.check_round_trip(run_model)
+
+    def test_import_round_trip(self):
+        self.check_round_trip(import_network)
+
+    def test_run_changed_workbook(self):
+        self.check_changed_workbook(run_model)
+
+    def test_import_changed_workbook(self):
+        self.check_changed_workbook(import_network)
+
+    def test_run_unpicklable(self):
+        self.check_unpicklable(run_model)
+
+    def test_import_unpicklable(self):
+        self.check_unpicklable(import_network)
+
+if __name__ == '__main__':
+    unittest.main()